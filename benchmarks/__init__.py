@@ -0,0 +1,3 @@
+"""
+Benchmarks for the monitoring and analysis code. Run the modules with python -m benchmarks.<name>
+"""
@@ -0,0 +1,68 @@
+"""
+Benchmark suite for the chaos detectors (reporting.py and change_point.py)
+
+Every detector runs on synthetic runs with known fault windows (chaos_lib_utils/detector_evaluation.py) and,
+with --logs, on recorded runs labelled by their injection timeline. For every detector the suite reports
+- precision and recall of the detected chaos events
+- the error of the recovery time of the found events (mean absolute and mean signed, in seconds)
+- the throughput in samples per second (best of --repeat calls)
+
+Usage (from the repository root):
+python -m benchmarks.bench_detectors
+python -m benchmarks.bench_detectors --samples 10000 100000 --seeds 5 --by-scenario
+python -m benchmarks.bench_detectors --detectors pelt cusum --logs experiments/runs --output detectors.csv
+"""
+import argparse
+import glob
+import os
+
+from chaos_lib_utils.detector_evaluation import (DETECTORS, SCENARIOS, synthetic_cases, labelled_cases, evaluate_detectors,
+                                                 summarize_evaluation, format_evaluation)
+
+DEFAULT_SAMPLES = [10000]
+
+
+def _log_files(paths: list[str]) -> list[str]:
+    log_files = []
+    for path in paths:
+        log_files.extend(sorted(glob.glob(os.path.join(path, "*.log"))) if os.path.isdir(path) else [path])
+    return log_files
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the accuracy and speed of the chaos detectors")
+    parser.add_argument("--samples", type=int, nargs="+", default=DEFAULT_SAMPLES, help="Samples per synthetic run")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="Only use these synthetic scenarios")
+    parser.add_argument("--seeds", type=int, default=3, help="Synthetic runs per scenario and size")
+    parser.add_argument("--detectors", nargs="+", choices=list(DETECTORS), help="Only benchmark these")
+    parser.add_argument("--logs", nargs="+", default=[], help="Recorded runs (logs or folders) with an injection timeline")
+    parser.add_argument("--no-synthetic", action="store_true", help="Only use the recorded runs")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions, the best one is reported")
+    parser.add_argument("--by-scenario", action="store_true", help="One row per detector and scenario")
+    parser.add_argument("--output", help="Also write the scores of every run to this csv file")
+    args = parser.parse_args(argv)
+
+    cases = []
+    if not args.no_synthetic:
+        for samples in args.samples:
+            cases.extend(synthetic_cases(args.scenarios, samples, args.seeds))
+    if args.logs:
+        recorded = labelled_cases(_log_files(args.logs))
+        print(f"{len(recorded)} recorded runs with an injection timeline")
+        cases.extend(recorded)
+    if not cases:
+        print("No runs to evaluate")
+        return 2
+
+    detectors = {name: DETECTORS[name] for name in args.detectors} if args.detectors else DETECTORS
+    print(f"Evaluating {len(detectors)} detectors on {len(cases)} runs")
+    results = evaluate_detectors(cases, detectors, args.repeat)
+
+    print(format_evaluation(summarize_evaluation(results, ["detector", "scenario"] if args.by_scenario else ["detector"])))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,196 @@
+"""
+End-to-end benchmark of the fetch path against the local Prometheus stand-in (chaos_lib_utils/prometheus_standin.py).
+
+Two scenarios are measured for every combination of metric count and window size:
+- single: one get_logs call for the whole time range (what the runners do after the last window)
+- loop: the fetch loop of the runners, one get_logs call per window of DATA_FETCH_INTERVAL_SECONDS
+  (without the sleep in between, the time range lies in the past)
+
+With --decode the HTTP part is left out: a range query result with that many series is decoded in memory, once with
+response.json() and an f-string per sample (the old fetch path) and once with the streaming parser (matrix_stream.py).
+
+Usage (from the repository root):
+python -m benchmarks.bench_fetch --metrics 1 10 --window 30 300 --windows 20
+python -m benchmarks.bench_fetch --replay experiments/runs --error-rate 0.05 --latency 0.01
+python -m benchmarks.bench_fetch --decode 1 100 500 --decode-samples 3600
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from chaos_lib_utils.prometheus_standin import start_standin_server
+from chaos_lib_utils.prometheus_utils import get_logs
+from chaos_lib_utils.matrix_stream import parse_matrix
+
+
+def build_metric_queries(number_of_metrics: int) -> list[list[str]]:
+    """
+    Returns number_of_metrics distinct [name, query] pairs, the stand-in serves a different series for each
+    """
+    return [[f"Lag_Input_Topic_{i}", f"sum by(consumergroup, topic) (kafka_consumergroup_lag{{partition=\"{i}\"}} >= 0)"]
+            for i in range(number_of_metrics)]
+
+
+def count_rows(logfile_path: str) -> int:
+    with open(logfile_path, "r") as f:
+        return sum(1 for _ in f) - 1
+
+
+def run_scenario(server, scenario: str, metrics: list[list[str]], window: float, windows: int, step: float) -> dict:
+    """
+    Runs a single scenario and returns the measured numbers
+
+    Parameters:
+    server: The running stand-in server
+    scenario: str: "single" or "loop"
+    metrics: list[list[str]]: [name, query] pairs to fetch
+    window: float: Size of a fetch window in seconds
+    windows: int: Number of windows
+    step: float: Step of the range queries (TIME_GRANULARITY)
+
+    Returns:
+    dict: The measurement, including if the scenario failed
+    """
+    handle, logfile_path = tempfile.mkstemp(suffix=".log")
+    os.close(handle)
+    with open(logfile_path, "w") as f:
+        f.write("Metric,Time,Value\n")
+
+    counters_before = dict(server.state.counters)
+    end_of_range = time.time()
+    start_of_range = end_of_range - window * windows
+    error = None
+
+    started = time.perf_counter()
+    try:
+        if scenario == "single":
+            get_logs(logfile_path, start_time=start_of_range, end_time=end_of_range, data_source_url=server.url,
+                     time_granularity=step, metrics=metrics)
+        else:
+            start_time = start_of_range
+            for i in range(windows):
+                end_time = start_time + window
+                get_logs(logfile_path, start_time=start_time, end_time=end_time, data_source_url=server.url,
+                         time_granularity=step, metrics=metrics)
+                start_time = end_time
+    except Exception as e:
+        error = str(e).splitlines()[0][:60]
+    elapsed = time.perf_counter() - started
+
+    rows = count_rows(logfile_path)
+    os.remove(logfile_path)
+    counters = {key: server.state.counters[key] - counters_before[key] for key in counters_before}
+    return {
+        "scenario": scenario,
+        "metrics": len(metrics),
+        "window": window,
+        "seconds": elapsed,
+        "requests": counters["requests"],
+        "errors": counters["injected_errors"],
+        "rows": rows,
+        "rows_per_second": rows / elapsed if elapsed > 0 else 0.0,
+        "megabytes": counters["bytes"] / 1e6,
+        "error": error,
+    }
+
+
+def build_matrix_body(number_of_series: int, samples: int) -> bytes:
+    """
+    Returns the compact JSON of a range query result, as Prometheus sends it
+    """
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(1700000000, 1700000000 + samples)
+    result = [{"metric": {"consumergroup": "heuristics-miner", "topic": f"input-{i}"},
+               "values": [[int(t), str(int(v))] for t, v in zip(timestamps, rng.integers(0, 100000, samples))]}
+              for i in range(number_of_series)]
+    return json.dumps({"status": "success", "data": {"resultType": "matrix", "result": result}}, separators=(",", ":")).encode("utf-8")
+
+
+def _decode_json(body: bytes) -> int:
+    rows = []
+    for series in json.loads(body)["data"]["result"]:
+        rows.append("".join(f"Lag_Input_Topic,{val[0]},{val[1]}\n" for val in series["values"]))
+    return sum(len(r) for r in rows)
+
+
+def _decode_stream(body: bytes) -> int:
+    chunks = (body[i:i + 65536] for i in range(0, len(body), 65536))
+    return sum(len(series.rows) for series in parse_matrix(chunks, b"Lag_Input_Topic,"))
+
+
+def run_decode(number_of_series: int, samples: int) -> list[dict]:
+    """
+    Decodes the same body with both decoders, returns the time and the peak of the allocated memory of each
+    """
+    body = build_matrix_body(number_of_series, samples)
+    results = []
+    for name, decode in (("json", _decode_json), ("stream", _decode_stream)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        size = decode(body)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({"decoder": name, "series": number_of_series, "samples": number_of_series * samples, "seconds": elapsed,
+                        "samples_per_second": number_of_series * samples / elapsed, "body_mb": len(body) / 1e6,
+                        "peak_mb": peak / 1e6, "rows_mb": size / 1e6})
+    return results
+
+
+def print_decode_results(results: list[dict]) -> None:
+    header = f"{'decoder':<8} {'series':>7} {'samples':>9} {'seconds':>8} {'samples/s':>11} {'body MB':>8} {'peak MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['decoder']:<8} {r['series']:>7} {r['samples']:>9} {r['seconds']:>8.3f} {r['samples_per_second']:>11.0f} "
+              f"{r['body_mb']:>8.1f} {r['peak_mb']:>8.1f}")
+
+
+def print_results(results: list[dict]) -> None:
+    header = f"{'scenario':<8} {'metrics':>7} {'window':>7} {'seconds':>8} {'requests':>8} {'errors':>6} {'rows':>9} {'rows/s':>10} {'MB':>7}  failure"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<8} {r['metrics']:>7} {r['window']:>7.0f} {r['seconds']:>8.3f} {r['requests']:>8} "
+              f"{r['errors']:>6} {r['rows']:>9} {r['rows_per_second']:>10.0f} {r['megabytes']:>7.2f}  {r['error'] or ''}")
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark get_logs and the fetch loop against the Prometheus stand-in")
+    parser.add_argument("--metrics", type=int, nargs="+", default=[1, 10], help="Number of metric queries")
+    parser.add_argument("--window", type=float, nargs="+", default=[30, 300], help="Fetch window sizes in seconds")
+    parser.add_argument("--windows", type=int, default=10, help="Number of windows per run")
+    parser.add_argument("--step", type=float, default=1.0, help="Step of the range queries in seconds")
+    parser.add_argument("--replay", help="Replay recorded runs from this folder instead of synthetic data")
+    parser.add_argument("--latency", type=float, default=0.0, help="Injected latency per request in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of an injected 503")
+    parser.add_argument("--scenario", choices=["single", "loop", "both"], default="both")
+    parser.add_argument("--decode", type=int, nargs="+", help="Only benchmark the decoding of results with this many series")
+    parser.add_argument("--decode-samples", type=int, default=3600, help="Samples per series for --decode")
+    args = parser.parse_args(argv)
+
+    if args.decode:
+        print_decode_results([r for number_of_series in args.decode for r in run_decode(number_of_series, args.decode_samples)])
+        return
+
+    server = start_standin_server(args.replay, latency=args.latency, error_rate=args.error_rate)
+    scenarios = ["single", "loop"] if args.scenario == "both" else [args.scenario]
+    results = []
+    try:
+        for number_of_metrics in args.metrics:
+            metrics = build_metric_queries(number_of_metrics)
+            for window in args.window:
+                for scenario in scenarios:
+                    results.append(run_scenario(server, scenario, metrics, window, args.windows, args.step))
+    finally:
+        server.stop()
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
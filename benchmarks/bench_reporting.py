@@ -0,0 +1,224 @@
+"""
+Benchmark suite for the analysis hot paths in chaos_lib_utils/reporting.py
+
+For every function and problem size the suite measures
+- the best wall time over a few repetitions
+- the peak memory allocated during one call (tracemalloc)
+- if the result equals the frozen original implementation (benchmarks/reference_reporting.py)
+
+The input are synthetic lag series (chaos_lib_utils/synthetic_data.py) with the same shape as our recorded runs.
+Sizes that exceed --max-cells (samples x runs) are skipped, the original implementations are slow.
+
+Usage (from the repository root):
+python -m benchmarks.bench_reporting
+python -m benchmarks.bench_reporting --samples 1000 100000 --runs 1 100 --functions average_df
+python -m benchmarks.bench_reporting --full --output bench_output.csv   # 10^3 - 10^7 samples, 1 - 1000 runs
+"""
+import argparse
+import copy
+import csv
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import reference_reporting as reference
+from chaos_lib_utils import reporting
+from chaos_lib_utils.synthetic_data import generate_lag_series, generate_runs, write_log_file
+
+DEFAULT_SAMPLES = [1000, 10000, 100000]
+DEFAULT_RUNS = [1, 10, 100]
+FULL_SAMPLES = [1000, 10000, 100000, 1000000, 10000000]
+FULL_RUNS = [1, 10, 100, 1000]
+
+
+def _faults_for(samples: int) -> int:
+    # Roughly one fault every 10 minutes, like our recorded runs
+    return max(1, samples // 600)
+
+
+def _chaos_df(samples: int) -> pd.DataFrame:
+    times, values, windows = generate_lag_series(samples, num_faults=_faults_for(samples))
+    df = pd.DataFrame({"Metric": "Lag_Input_Topic", "Time": times, "Value": values.astype(np.int64)})
+    df["Chaos"] = 0
+    for start, end in windows:
+        df.loc[start:end, "Chaos"] = 1
+    return df
+
+
+def _runs_with_events(samples: int, runs: int) -> tuple[list[pd.DataFrame], list]:
+    dataframes = generate_runs(runs, samples, num_faults=_faults_for(samples))
+    chaos_events_list = []
+    for i in range(runs):
+        _, _, windows = generate_lag_series(samples, num_faults=_faults_for(samples), seed=i)
+        chaos_events_list.append([[[int(s), int(e)] for s, e in windows]])
+    return dataframes, chaos_events_list
+
+
+def _ragged_runs(samples: int, runs: int) -> list[pd.DataFrame]:
+    rng = np.random.default_rng(runs)
+    dataframes = generate_runs(runs, samples, num_faults=_faults_for(samples))
+    # Runs never have the same length
+    return [df.iloc[:samples - int(rng.integers(0, max(1, samples // 10)))][["Time", "Value"]].copy() for df in dataframes]
+
+
+def _frames_equal(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    try:
+        pd.testing.assert_frame_equal(a.reset_index(drop=True), b.reset_index(drop=True), check_dtype=False)
+        return True
+    except AssertionError:
+        return False
+
+
+class Case:
+    """
+    A benchmarked function.
+    setup(samples, runs) builds the input, call(data) / reference_call(data) run the current and the
+    original implementation on a copy of it and compare(a, b) checks their results.
+    """
+    def __init__(self, name, setup, call, reference_call, compare, multi_run=False):
+        self.name = name
+        self.setup = setup
+        self.call = call
+        self.reference_call = reference_call
+        self.compare = compare
+        self.multi_run = multi_run
+
+
+def _setup_read_csv(samples, runs):
+    folder = tempfile.mkdtemp()
+    times, values, _ = generate_lag_series(samples, num_faults=_faults_for(samples))
+    path = os.path.join(folder, "single_100_bench.log")
+    write_log_file(path, times, values)
+    return path
+
+
+CASES = [
+    Case("read_csv", _setup_read_csv,
+         lambda path: reporting.read_csv(path),
+         lambda path: reference.read_csv(os.path.basename(path), os.path.dirname(path)),
+         _frames_equal),
+    Case("find_number_of_chaos_groups", lambda samples, runs: _chaos_df(samples),
+         lambda df: reporting.find_number_of_chaos_groups(df),
+         lambda df: reference.find_number_of_chaos_groups(df),
+         lambda a, b: a == b),
+    Case("identify_chaos_around_maxima", lambda samples, runs: _chaos_df(samples).drop(columns=["Chaos"]),
+         lambda df: reporting.identify_chaos_around_maxima(df, "Value", prominence=50),
+         lambda df: reference.identify_chaos_around_maxima(df, "Value", prominence=50),
+         _frames_equal),
+    Case("allign_chaos_evnets", _runs_with_events,
+         lambda data: reporting.allign_chaos_evnets(*data),
+         lambda data: reference.allign_chaos_evnets(*data),
+         lambda a, b: a[1] == b[1] and all(_frames_equal(x, y) for x, y in zip(a[0], b[0])),
+         multi_run=True),
+    Case("average_df", _ragged_runs,
+         lambda dfs: reporting.average_df(dfs),
+         lambda dfs: reference.average_df(dfs),
+         _frames_equal,
+         multi_run=True),
+]
+
+
+def measure(function, data, repeat: int) -> tuple[float, float, object]:
+    """
+    Runs function on fresh copies of data.
+
+    Returns:
+    best_seconds: float: The fastest of repeat calls
+    peak_megabytes: float: Peak memory allocated during a single call
+    result: The result of the last call
+    """
+    tracemalloc.start()
+    result = function(copy.deepcopy(data))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = float("inf")
+    for _ in range(repeat):
+        argument = copy.deepcopy(data)
+        started = time.perf_counter()
+        result = function(argument)
+        best = min(best, time.perf_counter() - started)
+    return best, peak / 1e6, result
+
+
+def run_case(case: Case, samples: int, runs: int, repeat: int, max_reference_cells: int) -> dict:
+    data = case.setup(samples, runs)
+    seconds, peak, result = measure(case.call, data, repeat)
+
+    matches = "skipped"
+    reference_seconds = None
+    if samples * runs <= max_reference_cells:
+        reference_seconds, _, reference_result = measure(case.reference_call, data, 1)
+        matches = "yes" if case.compare(result, reference_result) else "NO"
+
+    if case.name == "read_csv":
+        shutil.rmtree(os.path.dirname(data))
+
+    return {
+        "function": case.name,
+        "samples": samples,
+        "runs": runs,
+        "seconds": seconds,
+        "peak_mb": peak,
+        "reference_seconds": reference_seconds,
+        "matches_reference": matches,
+    }
+
+
+def print_results(results: list[dict]) -> None:
+    header = f"{'function':<30} {'samples':>9} {'runs':>5} {'seconds':>10} {'peak MB':>9} {'ref seconds':>12}  matches"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        reference_seconds = f"{r['reference_seconds']:.4f}" if r["reference_seconds"] is not None else "-"
+        print(f"{r['function']:<30} {r['samples']:>9} {r['runs']:>5} {r['seconds']:>10.4f} {r['peak_mb']:>9.2f} "
+              f"{reference_seconds:>12}  {r['matches_reference']}")
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the analysis functions of chaos_lib_utils.reporting")
+    parser.add_argument("--samples", type=int, nargs="+", default=DEFAULT_SAMPLES, help="Samples per run")
+    parser.add_argument("--runs", type=int, nargs="+", default=DEFAULT_RUNS, help="Runs for the multi-run functions")
+    parser.add_argument("--full", action="store_true", help="Use 10^3 - 10^7 samples and 1 - 1000 runs")
+    parser.add_argument("--functions", nargs="+", choices=[case.name for case in CASES], help="Only benchmark these")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions, the best one is reported")
+    parser.add_argument("--max-cells", type=int, help="Skip sizes with more samples x runs (default 2*10^5, 10^8 with --full)")
+    parser.add_argument("--max-reference-cells", type=int, default=200_000, help="Only compare against the original implementation up to this size")
+    parser.add_argument("--output", help="Also write the results to this csv file")
+    args = parser.parse_args(argv)
+
+    samples_list = FULL_SAMPLES if args.full else args.samples
+    runs_list = FULL_RUNS if args.full else args.runs
+    max_cells = args.max_cells
+    if max_cells is None:
+        max_cells = 100_000_000 if args.full else 200_000
+
+    results = []
+    for case in CASES:
+        if args.functions and case.name not in args.functions:
+            continue
+        for samples in samples_list:
+            for runs in (runs_list if case.multi_run else [1]):
+                if samples * runs > max_cells:
+                    continue
+                print(f"Benchmarking {case.name} with {samples} samples and {runs} runs")
+                results.append(run_case(case, samples, runs, args.repeat, args.max_reference_cells))
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+    # A mismatch with the original implementation is a failure
+    return 1 if any(r["matches_reference"] == "NO" for r in results) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
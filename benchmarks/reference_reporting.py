@@ -0,0 +1,130 @@
+"""
+Frozen copies of the analysis functions from chaos_lib_utils/reporting.py, as they were when the benchmarks were added.
+bench_reporting.py checks the current implementations against these, so an optimized version has to
+produce exactly the same results as the original one.
+
+Do not optimize this file!
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks
+
+
+def read_csv(filename: str, log_folder: str) -> pd.DataFrame:
+    filename = os.path.join(os.getcwd(), log_folder, filename)
+    df = pd.read_csv(filename)
+    return df
+
+
+def time_normalization(df: pd.DataFrame) -> pd.DataFrame:
+    df['Time'] = df['Time'] - df['Time'].iloc[0]
+    return df
+
+
+def compute_td(df: pd.DataFrame, start: int, end: int, col: str = "Time") -> float:
+    td = df[col].iloc[end] - df[col].iloc[start]
+    return td
+
+
+def find_number_of_chaos_groups(df: pd.DataFrame) -> tuple[int, list[list[int]]]:
+    number_of_chaos_groups = 0
+    chaos_groups = []
+
+    prev = False
+    for index, value in enumerate(df['Chaos']):
+        if value == 1 and prev == False:
+            number_of_chaos_groups += 1
+            chaos_groups.append([index])
+
+        if value == 0 and prev == True or index == len(df)-1 and value == 1:
+            chaos_groups[-1].append(index-1)
+        prev = value
+
+    return number_of_chaos_groups, chaos_groups
+
+
+def allign_chaos_evnets(dataframes: list[pd.DataFrame], chaos_events_list: list) -> list[pd.DataFrame]:
+    assert len(dataframes) == len(chaos_events_list), "Dataframes and chaos events list must have the same length"
+    for chaos_events in chaos_events_list:
+        assert len(chaos_events) == len(chaos_events_list[0]), "All chaos events lists must have the same length"
+
+    first_chaos_events = []
+    differences = []
+    for i, all_chaos_events in enumerate(chaos_events_list):
+        assert type(all_chaos_events[0][0]) == list, "Chaos events must be a list of lists"
+        assert len(all_chaos_events[0][0]) == 2, "Chaos events must be a list of lists with two elements"
+        assert type(all_chaos_events[0][0][0]) == int and type(all_chaos_events[0][0][1] == int), "Chaos events must be a list of lists with two integers"
+        first_chaos_events.append(all_chaos_events[0][0])
+    for i, df in enumerate(dataframes):
+        df = time_normalization(df)
+        differences.append(compute_td(df, 0, first_chaos_events[i][0]))
+
+    min_diff = min(differences)
+
+    alligned_dataframes = []
+    for i, df in enumerate(dataframes):
+        df_time_diff = compute_td(df, 0, first_chaos_events[i][0])
+
+        start_index = first_chaos_events[i][0]
+        while df_time_diff > min_diff:
+            start_index -= 1
+            df_time_diff = compute_td(df, 0, start_index)
+
+        alligned_dataframes.append(df.iloc[start_index:])
+
+    return alligned_dataframes, chaos_events_list
+
+
+def average_df(dataframes: list[pd.DataFrame]) -> pd.DataFrame:
+    longest_df = max(dataframes, key=lambda x: len(x))
+    result_df = pd.DataFrame(longest_df['Time'])
+    result_df['Value'] = 0.0
+
+    for i in range(len(longest_df)):
+        value_sum = 0.0
+        num_df_with_value = 0
+
+        for df in dataframes:
+            if i < len(df) and pd.notna(df.iloc[i]['Value']):
+                value_sum += df.iloc[i]['Value']
+                num_df_with_value += 1
+
+        if num_df_with_value > 0:
+            result_df.at[i, 'Value'] = value_sum / num_df_with_value
+
+    return result_df
+
+
+def identify_chaos_around_maxima(df: pd.DataFrame, column: str, median_fraction: float = 1, prominence: float = 1, num_peaks: int = None) -> pd.DataFrame:
+    median_value = df[column].median()
+
+    peaks, _ = find_peaks(df[column].values, prominence=prominence)
+
+    if num_peaks is not None and len(peaks) > num_peaks:
+        peaks = peaks[np.argsort(df[column].values[peaks])[-num_peaks:]]
+
+    df['Chaos'] = 0
+
+    for peak in peaks:
+        assert type(peak) == np.int64, f"Peak is not an integer: {peak}"
+        start = peak
+        end = peak
+
+        while start > 0:
+            if df.loc[start, column] < median_value * median_fraction:
+                    break
+            start -= 1
+
+        while end < len(df) - 1:
+            if df.loc[end, column] < median_value * median_fraction:
+                break
+            end += 1
+
+        if start == end:
+            continue
+
+        df.loc[start:end, 'Chaos'] = 1
+
+    return df
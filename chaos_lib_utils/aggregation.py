@@ -0,0 +1,256 @@
+"""
+This module aggregates the recovery times of many runs, e.g. recovery time vs. latency (RQ2 in the notebook).
+
+All statistics work on the table of chaos events (one row per event, like df_rq2 in the notebook:
+File, Latency, Event, RecoveryTime) and are vectorized over all groups and bootstrap replicates:
+- summarize_by_parameter: count, mean, median, std, quantiles and bootstrap confidence intervals per parameter value
+- linear_regression: slope, intercept, r, p and a bootstrap confidence interval of the slope (like scipy.stats.linregress)
+The bootstrap replicates are drawn in batches, the batches are spread over worker processes.
+
+build_summary computes all tables once and stores them as csv files in the log folder (summaries/<key>/).
+The key is a hash of the analysed logs (name, size, modification time) and the parameters,
+so re-running a notebook only reads the tables again.
+
+The module contains the following functions:
+- collect_events: The table of chaos events of all matching runs (through run_archive)
+- bootstrap_group_statistics: Bootstrap distribution of the mean / median of every group
+- summarize_by_parameter: Summary table per parameter value
+- per_run_table: One row per run (mean recovery time and number of events)
+- linear_regression: Regression of the recovery time on a parameter
+- build_summary: All tables, cached
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from chaos_lib_utils.constants import LOG_FOLDER
+
+EVENT_COLUMNS = ["File", "Latency", "Event", "RecoveryTime"]
+
+
+def collect_events(patterns: list[str] = None, prominence: float = 50, min_rows: int = 300, workers: int = None,
+                   log_folder: str = LOG_FOLDER) -> pd.DataFrame:
+    """
+    Detects the chaos events of all runs matching the patterns and returns them as one table
+
+    Returns:
+    pd.DataFrame: File, Latency, Event, RecoveryTime
+    """
+    from chaos_lib_utils.reporting import analyze_run
+    from chaos_lib_utils.run_archive import RunArchive
+
+    archive = RunArchive(log_folder)
+    analyze = partial(analyze_run, prominence=prominence)
+    rows = []
+    for chunk in archive.stream(analyze, workers=workers, patterns=patterns, min_rows=min_rows):
+        rows.extend(row for run_rows in chunk for row in run_rows)
+    return pd.DataFrame(rows, columns=EVENT_COLUMNS)
+
+
+def _group(values: np.ndarray, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Sorts the values by group and returns (group keys, sorted values, start of every group, size of every group)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    values = values[order]
+    group_keys, starts, sizes = np.unique(keys, return_index=True, return_counts=True)
+    return group_keys, values, starts, sizes
+
+
+def _bootstrap_batch(values: np.ndarray, starts: np.ndarray, sizes: np.ndarray, statistic: str, replicates: int,
+                     seed: np.random.SeedSequence) -> np.ndarray:
+    """
+    Draws replicates bootstrap samples of every group at once and returns the statistic, shape (replicates, groups)
+    """
+    rng = np.random.default_rng(seed)
+    codes = np.repeat(np.arange(len(sizes)), sizes)
+    # Resampling within every group: index = start of the group + uniform offset inside the group
+    offsets = (rng.random((replicates, len(values))) * sizes[codes]).astype(np.int64)
+    resampled = values[starts[codes] + offsets]
+
+    if statistic == "mean":
+        return np.add.reduceat(resampled, starts, axis=1) / sizes
+    if statistic == "median":
+        result = np.empty((replicates, len(sizes)))
+        for i, (start, size) in enumerate(zip(starts, sizes)):
+            result[:, i] = np.median(resampled[:, start:start + size], axis=1)
+        return result
+    raise ValueError(f"Unknown statistic {statistic}, expected mean or median")
+
+
+def bootstrap_group_statistics(values: np.ndarray, keys: np.ndarray, statistic: str = "mean", replicates: int = 2000,
+                               seed: int = 0, workers: int = 1, batch_size: int = 500) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Bootstrap distribution of a statistic for every group
+
+    Parameters:
+    values: np.ndarray: The values (e.g. recovery times)
+    keys: np.ndarray: The group of every value (e.g. latency)
+    statistic: str: mean or median
+    replicates: int: Number of bootstrap replicates
+    seed: int: Seed, the result does not depend on the number of workers
+    workers: int: Worker processes for the batches (1 computes everything in this process)
+    batch_size: int: Replicates per batch, bounds the memory (batch_size * len(values) floats)
+
+    Returns:
+    tuple: The group keys and the bootstrap statistics, shape (replicates, groups)
+    """
+    group_keys, values, starts, sizes = _group(np.asarray(values, dtype=float), np.asarray(keys))
+    batches = [min(batch_size, replicates - i) for i in range(0, replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    compute = partial(_bootstrap_batch, values, starts, sizes, statistic)
+
+    if workers == 1 or len(batches) == 1:
+        results = [compute(n, s) for n, s in zip(batches, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(compute, batches, seeds))
+    return group_keys, np.concatenate(results)
+
+
+def summarize_by_parameter(events: pd.DataFrame, parameter: str = "Latency", value: str = "RecoveryTime",
+                           replicates: int = 2000, confidence: float = 0.95, seed: int = 0, workers: int = 1) -> pd.DataFrame:
+    """
+    Summary of the distribution of value for every value of parameter
+
+    Returns:
+    pd.DataFrame: indexed by parameter with count, mean, std, median, p05, p25, p75, p95 and the bootstrap
+    confidence intervals mean_ci_low, mean_ci_high, median_ci_low, median_ci_high
+    """
+    events = events.dropna(subset=[parameter, value])
+    values = events[value].to_numpy(dtype=float)
+    keys = events[parameter].to_numpy()
+    if len(values) == 0:
+        return pd.DataFrame(columns=["count", "mean", "std", "median", "p05", "p25", "p75", "p95",
+                                     "mean_ci_low", "mean_ci_high", "median_ci_low", "median_ci_high"])
+
+    group_keys, sorted_values, starts, sizes = _group(values, keys)
+    summary = pd.DataFrame(index=pd.Index(group_keys, name=parameter))
+    summary["count"] = sizes
+    summary["mean"] = np.add.reduceat(sorted_values, starts) / sizes
+    squared = np.add.reduceat(sorted_values ** 2, starts) / sizes
+    # sample standard deviation, NaN for single values like pandas
+    with np.errstate(invalid="ignore", divide="ignore"):
+        summary["std"] = np.sqrt(np.maximum(squared - summary["mean"] ** 2, 0) * sizes / (sizes - 1))
+    quantiles = [np.quantile(sorted_values[s:s + n], [0.5, 0.05, 0.25, 0.75, 0.95]) for s, n in zip(starts, sizes)]
+    summary[["median", "p05", "p25", "p75", "p95"]] = np.array(quantiles)
+
+    alpha = (1 - confidence) / 2
+    for statistic in ["mean", "median"]:
+        _, boot = bootstrap_group_statistics(values, keys, statistic, replicates, seed, workers)
+        summary[f"{statistic}_ci_low"] = np.quantile(boot, alpha, axis=0)
+        summary[f"{statistic}_ci_high"] = np.quantile(boot, 1 - alpha, axis=0)
+    return summary
+
+
+def per_run_table(events: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per run: File, Latency, Events (number of chaos events) and the mean / median recovery time
+    """
+    return (events.groupby(["File", "Latency"])["RecoveryTime"]
+            .agg(Events="count", MeanRecoveryTime="mean", MedianRecoveryTime="median")
+            .reset_index())
+
+
+def linear_regression(x: np.ndarray, y: np.ndarray, replicates: int = 2000, confidence: float = 0.95, seed: int = 0) -> dict:
+    """
+    Least squares regression of y on x, with the same results as scipy.stats.linregress
+    plus a bootstrap confidence interval of the slope (pairs are resampled, all replicates at once)
+
+    Returns:
+    dict: n, slope, intercept, r, r_squared, p_value, stderr, slope_ci_low, slope_ci_high
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n < 3 or np.ptp(x) == 0:
+        raise ValueError("A regression needs at least 3 points and different x values")
+
+    from scipy import stats
+
+    x_mean, y_mean = x.mean(), y.mean()
+    sxx = ((x - x_mean) ** 2).sum()
+    sxy = ((x - x_mean) * (y - y_mean)).sum()
+    syy = ((y - y_mean) ** 2).sum()
+    slope = sxy / sxx
+    r = sxy / np.sqrt(sxx * syy) if syy > 0 else 0.0
+    residual_variance = max(syy - slope * sxy, 0) / (n - 2)
+    stderr = np.sqrt(residual_variance / sxx)
+    t = slope / stderr if stderr > 0 else np.inf
+    p_value = 2 * stats.t.sf(abs(t), n - 2)
+
+    # Bootstrap: the sums of every replicate are computed in one go
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, n, size=(replicates, n))
+    bx, by = x[index], y[index]
+    bx_centered = bx - bx.mean(axis=1, keepdims=True)
+    bxx = (bx_centered ** 2).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        boot_slopes = (bx_centered * (by - by.mean(axis=1, keepdims=True))).sum(axis=1) / bxx
+    boot_slopes = boot_slopes[bxx > 0]
+    alpha = (1 - confidence) / 2
+
+    return {
+        "n": n,
+        "slope": float(slope),
+        "intercept": float(y_mean - slope * x_mean),
+        "r": float(r),
+        "r_squared": float(r ** 2),
+        "p_value": float(p_value),
+        "stderr": float(stderr),
+        "slope_ci_low": float(np.quantile(boot_slopes, alpha)),
+        "slope_ci_high": float(np.quantile(boot_slopes, 1 - alpha)),
+    }
+
+
+def _summary_key(log_files: list[str], parameters: dict) -> str:
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+    for log_file in sorted(log_files):
+        stat = os.stat(log_file)
+        digest.update(f"{os.path.basename(log_file)}:{stat.st_size}:{stat.st_mtime}".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def build_summary(patterns: list[str] = None, prominence: float = 50, min_rows: int = 300, replicates: int = 2000,
+                  confidence: float = 0.95, seed: int = 0, workers: int = None, log_folder: str = LOG_FOLDER,
+                  cache: bool = True) -> dict[str, pd.DataFrame]:
+    """
+    Computes all tables for the runs matching the patterns, or reads them from the cache if nothing changed
+
+    Returns:
+    dict: events (one row per chaos event), runs (one row per run), by_latency (summary per latency)
+    and regression (recovery time on latency, a single row)
+    """
+    from chaos_lib_utils.run_archive import RunArchive
+
+    log_files = RunArchive(log_folder).log_files(patterns)
+    parameters = {"prominence": prominence, "min_rows": min_rows, "replicates": replicates, "confidence": confidence, "seed": seed}
+    cache_folder = os.path.join(log_folder, "summaries", _summary_key(log_files, parameters))
+    names = ["events", "runs", "by_latency", "regression"]
+
+    if cache and all(os.path.exists(os.path.join(cache_folder, f"{name}.csv")) for name in names):
+        tables = {name: pd.read_csv(os.path.join(cache_folder, f"{name}.csv")) for name in names}
+        tables["by_latency"] = tables["by_latency"].set_index("Latency")
+        return tables
+
+    events = collect_events(patterns, prominence, min_rows, workers, log_folder)
+    tables = {
+        "events": events,
+        "runs": per_run_table(events),
+        "by_latency": summarize_by_parameter(events, "Latency", "RecoveryTime", replicates, confidence, seed, workers or 1),
+    }
+    try:
+        regression = linear_regression(events["Latency"], events["RecoveryTime"], replicates, confidence, seed)
+    except ValueError:
+        regression = {}
+    tables["regression"] = pd.DataFrame([regression])
+
+    if cache:
+        os.makedirs(cache_folder, exist_ok=True)
+        for name in names:
+            tables[name].to_csv(os.path.join(cache_folder, f"{name}.csv"), index=(name == "by_latency"))
+    return tables
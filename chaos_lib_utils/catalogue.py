@@ -0,0 +1,225 @@
+"""
+This module holds an index (SQLite) over all runs in the log folder.
+
+Every run is a row with its experiment, latency, start time, status and the summary of its detected events,
+taken from the run manifest (<log name>.meta.json, see run_manifest.py). For logs without a manifest
+(older runs) the experiment, latency and start time are taken from the file name (single_{latency}_{datetime}.log,
+with @{cluster} before .log for runs of a cluster pool, see cluster_pool.py).
+The catalogue is updated incrementally, only logs and manifests that changed since the last update are read.
+
+Example:
+update_catalogue()
+query_runs(min_latency=200, since=time.time() - 7 * 24 * 3600)
+
+The module contains the following functions:
+- connect: Opens (and creates) the catalogue
+- parse_log_name: Experiment, latency and start time from the name of a log
+- index_run: Adds or updates a single run
+- update_catalogue: Indexes all new or changed runs of the log folder
+- query_runs: Returns the runs matching some filters
+"""
+import json
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+from chaos_lib_utils.constants import LOG_FOLDER, CATALOGUE_FILE
+from chaos_lib_utils.file_utils import get_sidecar_path, load_run_metadata
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    log_file TEXT PRIMARY KEY,
+    experiment TEXT,
+    latency_ms REAL,
+    started_at REAL,
+    finished_at REAL,
+    status TEXT,
+    yaml_sha256 TEXT,
+    cleanup_strategy TEXT,
+    steady INTEGER,
+    events INTEGER,
+    mean_recovery_time REAL,
+    has_manifest INTEGER,
+    indexed_mtime REAL,
+    manifest TEXT,
+    cluster TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_latency ON runs (latency_ms);
+CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at);
+CREATE INDEX IF NOT EXISTS runs_experiment ON runs (experiment, started_at);
+"""
+
+COLUMNS = ["log_file", "experiment", "latency_ms", "started_at", "finished_at", "status", "yaml_sha256", "cleanup_strategy",
+           "steady", "events", "mean_recovery_time", "has_manifest", "indexed_mtime", "manifest", "cluster"]
+
+LOG_NAME_PATTERN = re.compile(r"^(?P<experiment>.+)_(?P<datetime>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:@(?P<cluster>[^@]+))?\.log$")
+
+
+def get_catalogue_path(log_folder: str = LOG_FOLDER) -> str:
+    return CATALOGUE_FILE if os.path.isabs(CATALOGUE_FILE) else os.path.join(log_folder, CATALOGUE_FILE)
+
+
+def connect(db_path: str = None) -> sqlite3.Connection:
+    """
+    Opens the catalogue, the tables and indexes are created if they do not exist
+    and columns that were added later are added to older catalogues
+    """
+    if db_path is None:
+        db_path = get_catalogue_path()
+    # the runs of a cluster pool finish at the same time, wait for the other writers
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    existing = {row["name"] for row in conn.execute("PRAGMA table_info(runs)")}
+    for column in COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE runs ADD COLUMN {column}")
+    return conn
+
+
+def parse_log_name(log_file: str) -> dict:
+    """
+    Reads experiment, latency and start time from the name of a log
+    e.g. single_100_2024-12-19_13-47-23@kind-2.log -> single_100, 100, timestamp of 2024-12-19 13:47:23 (local time), kind-2
+    Unknown parts are None
+    """
+    match = LOG_NAME_PATTERN.match(os.path.basename(log_file))
+    if match is None:
+        return {"experiment": os.path.splitext(os.path.basename(log_file))[0], "latency_ms": None, "started_at": None, "cluster": None}
+    latency = re.match(r"single_(\d+)$", match.group("experiment"))
+    return {
+        "experiment": match.group("experiment"),
+        "latency_ms": float(latency.group(1)) if latency else None,
+        "started_at": datetime.strptime(match.group("datetime"), "%Y-%m-%d_%H-%M-%S").timestamp(),
+        "cluster": match.group("cluster"),
+    }
+
+
+def _run_mtime(logfile_path: str) -> float:
+    meta_path = get_sidecar_path(logfile_path, ".meta.json")
+    mtime = os.path.getmtime(logfile_path)
+    if os.path.exists(meta_path):
+        mtime = max(mtime, os.path.getmtime(meta_path))
+    return mtime
+
+
+def build_row(logfile_path: str) -> dict:
+    """
+    Builds the catalogue row of a run from its manifest, falling back to the file name
+    """
+    row = {column: None for column in COLUMNS}
+    row.update(parse_log_name(logfile_path))
+    row["log_file"] = os.path.basename(logfile_path)
+    row["indexed_mtime"] = _run_mtime(logfile_path)
+
+    manifest = load_run_metadata(logfile_path)
+    row["has_manifest"] = int("experiment" in manifest and isinstance(manifest["experiment"], dict))
+    if row["has_manifest"]:
+        experiment = manifest["experiment"]
+        row["experiment"] = experiment.get("name", row["experiment"])
+        parameters = experiment.get("parameters", {})
+        if parameters.get("latency_ms") is not None:
+            row["latency_ms"] = parameters["latency_ms"]
+        row["yaml_sha256"] = experiment.get("yaml_sha256")
+        row["cleanup_strategy"] = experiment.get("cleanup_strategy")
+        timings = manifest.get("timings", {})
+        row["started_at"] = timings.get("started_at", row["started_at"])
+        row["finished_at"] = timings.get("finished_at")
+        row["status"] = manifest.get("status")
+        cluster = (manifest.get("config") or {}).get("cluster")
+        if cluster is not None:
+            row["cluster"] = cluster["name"]
+    if "baseline" in manifest:
+        row["steady"] = int(bool(manifest["baseline"].get("steady")))
+    if manifest.get("events") is not None:
+        # measured events of a run whose lag did not recover have no recovery time
+        recovery_times = [event["recovery_time"] for event in manifest["events"] if event["recovery_time"] is not None]
+        row["events"] = len(manifest["events"])
+        row["mean_recovery_time"] = sum(recovery_times) / len(recovery_times) if recovery_times else None
+    row["manifest"] = json.dumps(manifest) if manifest else None
+    return row
+
+
+def index_run(conn: sqlite3.Connection, logfile_path: str) -> None:
+    """
+    Adds a run to the catalogue, replacing an older entry of the same log
+    """
+    row = build_row(logfile_path)
+    conn.execute(f"INSERT OR REPLACE INTO runs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                 [row[column] for column in COLUMNS])
+    conn.commit()
+
+
+def update_catalogue(log_folder: str = LOG_FOLDER, db_path: str = None) -> int:
+    """
+    Indexes all logs in the log folder that are new or changed since the last update,
+    runs whose log was deleted are removed from the catalogue.
+
+    Returns:
+    int: Number of runs that were (re-)indexed
+    """
+    if db_path is None:
+        db_path = get_catalogue_path(log_folder)
+    conn = connect(db_path)
+    indexed = {row["log_file"]: row["indexed_mtime"] for row in conn.execute("SELECT log_file, indexed_mtime FROM runs")}
+
+    log_files = [f for f in os.listdir(log_folder) if f.endswith(".log")]
+    rows = []
+    for log_file in log_files:
+        logfile_path = os.path.join(log_folder, log_file)
+        if indexed.get(log_file) == _run_mtime(logfile_path):
+            continue
+        row = build_row(logfile_path)
+        rows.append([row[column] for column in COLUMNS])
+
+    with conn:
+        conn.executemany(f"INSERT OR REPLACE INTO runs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+        removed = set(indexed) - set(log_files)
+        conn.executemany("DELETE FROM runs WHERE log_file = ?", [[log_file] for log_file in removed])
+    conn.close()
+    return len(rows)
+
+
+def query_runs(db_path: str = None, experiment: str = None, min_latency: float = None, max_latency: float = None,
+               since: float = None, until: float = None, status: str = None, cluster: str = None, with_manifest: bool = False) -> list[dict]:
+    """
+    Returns the runs matching all given filters, ordered by start time
+
+    Parameters:
+    db_path: str: Path of the catalogue (defaults to the catalogue in the log folder)
+    experiment: str: Experiment name, * and ? work as wildcards (e.g. "single_*")
+    min_latency / max_latency: float: Bounds for the latency in milliseconds (inclusive)
+    since / until: float: Bounds for the start of the run (unix timestamps, inclusive)
+    status: str: Status of the run (completed, incomplete)
+    cluster: str: Name of the cluster of a cluster pool the run was done on
+    with_manifest: bool: Include the full manifest of every run
+
+    Returns:
+    list[dict]: One dict per run with the columns of the catalogue
+    """
+    conditions = []
+    params = []
+    if experiment is not None:
+        conditions.append("experiment GLOB ?")
+        params.append(experiment)
+    for column, operator, value in [("latency_ms", ">=", min_latency), ("latency_ms", "<=", max_latency),
+                                    ("started_at", ">=", since), ("started_at", "<=", until), ("status", "=", status),
+                                    ("cluster", "=", cluster)]:
+        if value is not None:
+            conditions.append(f"{column} {operator} ?")
+            params.append(value)
+
+    columns = COLUMNS if with_manifest else [column for column in COLUMNS if column != "manifest"]
+    sql = f"SELECT {', '.join(columns)} FROM runs"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY started_at"
+
+    conn = connect(db_path)
+    rows = [dict(row) for row in conn.execute(sql, params)]
+    conn.close()
+    if with_manifest:
+        for row in rows:
+            row["manifest"] = json.loads(row["manifest"]) if row["manifest"] else None
+    return rows
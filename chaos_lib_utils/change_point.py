@@ -0,0 +1,274 @@
+"""
+This module detects chaos events with change point detection instead of thresholds that are tuned per experiment.
+
+The lag of a run is seen as a sequence of segments with a constant mean (a fault turns into a staircase of segments
+while the lag grows and drains). The noise level sigma is estimated from the first differences (robust against the
+events themselves), so the defaults work for all experiment families:
+- PELT (Killick et al. 2012) finds the segmentation with the minimal squared error plus a penalty per change point,
+  exactly and in linear time (candidates that can not be the last change point any more are pruned). The costs of
+  all remaining candidates are computed at once from cumulative sums. Long runs are segmented on a grid of every
+  jump-th sample, every change point is then moved to the exact best split around it.
+  Segments whose mean is more than k sigma above the baseline (median of the run) are chaos.
+- CUSUM is for the streaming case (e.g. while a run is fetched): an upper CUSUM raises an alarm once the lag rose by
+  more than k sigma for long enough (h), the event started where the CUSUM last left 0. A lower CUSUM then waits
+  until the lag is back at the baseline. The recursion max(0, S + x) is computed for a whole block at once
+  (cumulative sum minus its running minimum).
+
+Both return a 'Chaos' column like the detectors in reporting.py, so find_number_of_chaos_groups, compute_td and
+the plots work with them.
+
+The module contains the following classes and functions:
+- estimate_noise: Robust standard deviation of the noise of a series
+- pelt: Change points of a series (PELT with pruning)
+- segments_to_chaos: Chaos column from change points (segments above a threshold)
+- identify_chaos_events_pelt: Chaos column of a dataframe with PELT
+- CusumDetector: Streaming detector, feed it samples and it returns the finished events
+- identify_chaos_events_cusum: Chaos column of a dataframe with CUSUM
+"""
+import numpy as np
+import pandas as pd
+
+# PELT runs on at most this many grid points, longer runs use a coarser grid (refined afterwards)
+MAX_GRID_POINTS = 5000
+# Samples processed at once by the CUSUM, bounds the work that is repeated after every alarm
+CUSUM_BLOCK_SIZE = 1 << 14
+
+
+def estimate_noise(values: np.ndarray) -> float:
+    """
+    Standard deviation of the noise from the median absolute first difference (MAD / 0.6745 / sqrt(2)),
+    level shifts and slow trends barely change it
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        return 0.0
+    diff = np.diff(values)
+    sigma = np.median(np.abs(diff - np.median(diff))) / 0.6745 / np.sqrt(2)
+    if sigma == 0:
+        # e.g. an integer lag that mostly stays the same, fall back to the standard deviation of the differences
+        sigma = diff.std() / np.sqrt(2)
+    return float(sigma)
+
+
+def _segment_cost(s1: np.ndarray, s2: np.ndarray, start, end):
+    # squared error of the samples [start, end) around their mean, from the cumulative sums (start / end can be arrays)
+    length = end - start
+    total = s1[end] - s1[start]
+    return (s2[end] - s2[start]) - total * total / length
+
+
+def pelt(values: np.ndarray, penalty: float = None, min_size: int = 2, jump: int = None) -> np.ndarray:
+    """
+    Finds the change points of the mean with PELT
+
+    Parameters:
+    values: np.ndarray: The series
+    penalty: float: Cost of a change point, defaults to 2 sigma^2 log(n) (BIC)
+    min_size: int: Minimal length of a segment
+    jump: int: Only every jump-th sample is a candidate, the change points are refined exactly afterwards
+    (defaults to 1, or so that at most MAX_GRID_POINTS are used)
+
+    Returns:
+    np.ndarray: Indices where a new segment starts (without 0)
+    """
+    x = np.asarray(values, dtype=np.float64)
+    n = len(x)
+    if n < 2 * min_size:
+        return np.empty(0, dtype=np.int64)
+    # centered, so the cumulative sums stay small
+    x = x - np.median(x)
+    if penalty is None:
+        penalty = 2 * max(estimate_noise(x), 1e-12) ** 2 * np.log(n)
+    if jump is None:
+        jump = max(1, -(-n // MAX_GRID_POINTS))
+    jump = max(1, int(jump))
+
+    s1 = np.concatenate([[0.0], np.cumsum(x)])
+    s2 = np.concatenate([[0.0], np.cumsum(x * x)])
+    grid = np.arange(0, n, jump, dtype=np.int64)
+    grid = np.append(grid, n) if grid[-1] != n else grid
+
+    # best[i]: cost of the best segmentation of [0, grid[i]), previous[i]: grid index of its last change point
+    best = np.empty(len(grid))
+    best[0] = -penalty
+    previous = np.zeros(len(grid), dtype=np.int64)
+    candidates = np.array([0], dtype=np.int64)
+    for i in range(1, len(grid)):
+        end = grid[i]
+        starts = grid[candidates]
+        costs = best[candidates] + _segment_cost(s1, s2, starts, end)
+        admissible = end - starts >= min_size
+        if admissible.any():
+            total = np.where(admissible, costs + penalty, np.inf)
+            j = int(np.argmin(total))
+            best[i] = total[j]
+            previous[i] = candidates[j]
+        else:
+            best[i] = np.inf
+        # a candidate that is worse than the optimum now can never be the last change point (pruning, K = 0)
+        candidates = np.append(candidates[~admissible | (costs <= best[i])], i)
+
+    change_points = []
+    i = len(grid) - 1
+    while i > 0:
+        i = previous[i]
+        if i > 0:
+            change_points.append(int(grid[i]))
+    change_points = np.array(change_points[::-1], dtype=np.int64)
+    if jump > 1 and len(change_points):
+        change_points = _refine(s1, s2, change_points, n, jump, min_size)
+    return change_points
+
+
+def _refine(s1: np.ndarray, s2: np.ndarray, change_points: np.ndarray, n: int, jump: int, min_size: int) -> np.ndarray:
+    # moves every change point to the best split within one grid step, between its neighbours
+    bounds = np.concatenate([[0], change_points, [n]])
+    refined = change_points.copy()
+    for i in range(len(change_points)):
+        left, right = refined[i - 1] if i > 0 else 0, bounds[i + 2]
+        splits = np.arange(max(left + min_size, change_points[i] - jump + 1), min(right - min_size, change_points[i] + jump - 1) + 1)
+        if len(splits):
+            costs = _segment_cost(s1, s2, left, splits) + _segment_cost(s1, s2, splits, right)
+            refined[i] = splits[int(np.argmin(costs))]
+    return refined
+
+
+def segments_to_chaos(values: np.ndarray, change_points: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Marks the samples of every segment whose mean is above the threshold
+
+    Returns:
+    np.ndarray: 1 for chaos, 0 otherwise (int64, like the Chaos column of reporting.py)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    bounds = np.concatenate([[0], change_points, [len(values)]]).astype(np.int64)
+    sums = np.add.reduceat(values, bounds[:-1])
+    means = sums / np.diff(bounds)
+    return np.repeat((means > threshold).astype(np.int64), np.diff(bounds))
+
+
+def identify_chaos_events_pelt(df: pd.DataFrame, column: str, k: float = 3, median_fraction: float = 1, penalty: float = None,
+                               min_size: int = 2, jump: int = None) -> pd.DataFrame:
+    """
+    Identify chaos events as the segments (PELT) whose mean is more than k sigma above the baseline
+
+    Parameters:
+    df: A pandas dataframe
+    column: string (column name to monitor for chaos events)
+    k: float: Distance from the baseline in noise standard deviations
+    median_fraction: float: The baseline is median_fraction times the median of the column
+    penalty, min_size, jump: see pelt
+
+    Returns:
+    df: pd.DataFrame with a new column 'Chaos' indicating chaos events
+    """
+    values = df[column].to_numpy(dtype=np.float64)
+    change_points = pelt(values, penalty, min_size, jump)
+    threshold = np.median(values) * median_fraction + k * estimate_noise(values) if len(values) else 0
+    df['Chaos'] = segments_to_chaos(values, change_points, threshold)
+    return df
+
+
+class CusumDetector:
+    """
+    Streaming CUSUM detector for the lag.
+
+    Parameters:
+    baseline: float: Lag without chaos (e.g. the mean of the steady state window)
+    sigma: float: Standard deviation of the noise (see estimate_noise)
+    k: float: Allowance in sigma, shifts smaller than k sigma are ignored
+    h: float: Decision threshold in sigma, higher values raise fewer false alarms but detect later
+    """
+    def __init__(self, baseline: float, sigma: float, k: float = 1, h: float = 10):
+        self.baseline = baseline
+        self.sigma = max(sigma, 1e-12)
+        self.k = k
+        self.h = h
+        self.statistic = 0.0
+        self.in_event = False
+        self.start = None
+        # index of the last sample where the statistic was 0 (where an event started / ended)
+        self.last_zero = -1
+        self.samples = 0
+
+    def update(self, values: np.ndarray) -> list[list[int]]:
+        """
+        Processes the next samples
+
+        Returns:
+        list[list[int]]: [start, end] (indices since the first sample) of the events that ended in these samples
+        """
+        z = (np.asarray(values, dtype=np.float64) - self.baseline) / self.sigma
+        events = []
+        for block_start in range(0, len(z), CUSUM_BLOCK_SIZE):
+            events.extend(self._update_block(z[block_start:block_start + CUSUM_BLOCK_SIZE]))
+        return events
+
+    def _update_block(self, z: np.ndarray) -> list[list[int]]:
+        events = []
+        position = 0
+        while position < len(z):
+            # upper CUSUM while waiting for an event, lower CUSUM (back at the baseline) during an event
+            increments = self.k - z[position:] if self.in_event else z[position:] - self.k
+            # Lindley recursion S_t = max(0, S_t-1 + x_t) for the whole block
+            cumulative = self.statistic + np.cumsum(increments)
+            statistic = cumulative - np.minimum(np.minimum.accumulate(cumulative), 0)
+            alarms = np.flatnonzero(statistic > self.h)
+            checked = alarms[0] if len(alarms) else len(statistic)
+            zeros = np.flatnonzero(statistic[:checked] == 0)
+            if len(zeros):
+                self.last_zero = self.samples + position + int(zeros[-1])
+            if len(alarms) == 0:
+                self.statistic = float(statistic[-1])
+                break
+
+            alarm = self.samples + position + int(alarms[0])
+            if self.in_event:
+                # the lag was last above the allowance where the lower CUSUM left 0
+                events.append([self.start, max(self.last_zero, self.start)])
+            else:
+                self.start = self.last_zero + 1
+            self.in_event = not self.in_event
+            self.statistic = 0.0
+            self.last_zero = alarm
+            position += int(alarms[0]) + 1
+        self.samples += len(z)
+        return events
+
+    def finish(self) -> list[list[int]]:
+        """
+        Ends the stream, an event that did not recover ends with the last sample
+        """
+        if not self.in_event:
+            return []
+        self.in_event = False
+        return [[self.start, self.samples - 1]]
+
+
+def identify_chaos_events_cusum(df: pd.DataFrame, column: str, k: float = 1, h: float = 10, median_fraction: float = 1,
+                                baseline: float = None) -> pd.DataFrame:
+    """
+    Identify chaos events with a CUSUM over the whole column (see CusumDetector)
+
+    Parameters:
+    df: A pandas dataframe
+    column: string (column name to monitor for chaos events)
+    k, h: float: Allowance and decision threshold in noise standard deviations
+    median_fraction: float: The baseline is median_fraction times the median of the column (if baseline is None)
+    baseline: float: Lag without chaos
+
+    Returns:
+    df: pd.DataFrame with a new column 'Chaos' indicating chaos events
+    """
+    values = df[column].to_numpy(dtype=np.float64)
+    chaos = np.zeros(len(values), dtype=np.int64)
+    if len(values):
+        if baseline is None:
+            baseline = np.median(values) * median_fraction
+        detector = CusumDetector(baseline, estimate_noise(values), k, h)
+        for start, end in detector.update(values) + detector.finish():
+            chaos[start:end + 1] = 1
+    df['Chaos'] = chaos
+    return df
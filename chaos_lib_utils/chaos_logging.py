@@ -3,8 +3,8 @@ This module contains functions for tracking the chaos experiments.
 This involves a thread that runs in the background an keeps track of time and the state of the experiment.
 """
 import time
-import os
 from chaos_lib_utils.constants import NUMBER_OF_RUNS, OFFSET_IN_SECONDS, OFFSET_IN_MINUTES
+from chaos_lib_utils.instrumentation import instrumented, timed_system
 import threading
 import re
 from datetime import datetime, timedelta
@@ -12,18 +12,22 @@ from datetime import datetime, timedelta
 def monitor_chaos_tests(yaml_file: str, stop_event: threading.Event, number_of_runs: int = NUMBER_OF_RUNS, time_per_run: int = OFFSET_IN_SECONDS)->None:
     """
     Monitor the chaos tests by counting number of runs and waiting for the full duration!
+    Returns early once stop_event is set.
 
     Returns:
     None
     """
     runs = 0
     while runs < number_of_runs:
-        time.sleep(time_per_run)
+        if stop_event.wait(time_per_run):
+            print(f"Monitoring stopped after {runs} of {number_of_runs} runs")
+            return
         runs += 1
-    
-    time.sleep(time_per_run)
+
+    if stop_event.wait(time_per_run):
+        return
     print("All runs completed, waiting for a bit to be in sync with logs")
-    
+
 def has_cron_schedule(yaml_file: str)->bool:
     """
     Check if the yaml file has a cron schedule
@@ -65,6 +69,27 @@ def round_time_to_next_cron(current_time: time.struct_time, minutes: int) -> tim
     new_dt = dt + timedelta(minutes=minute_increment)
     return new_dt.timetuple()
 
+def seconds_until_good_time(yaml_file: str) -> float:
+    """
+    Seconds to wait before applying yaml_file: until right after the next cron interval (plus a safety time of
+    2 seconds, that way checking seconds becomes irrelevant) if it has a cron schedule, 0 otherwise.
+    """
+    if not has_cron_schedule(yaml_file):
+        return 0
+    time_to_wait_until = round_time_to_next_cron(time.localtime(), OFFSET_IN_MINUTES)
+    dt_to_wait_until = datetime.fromtimestamp(time.mktime(time_to_wait_until))
+    return max((dt_to_wait_until - datetime.now()).total_seconds(), 0) + 2
+
+
+def apply_manifest(yaml_file: str) -> None:
+    """
+    kubectl apply of a chaos test. Raises an exception if kubectl fails, otherwise the run would log a cluster without chaos.
+    """
+    if timed_system(f'kubectl apply -f {yaml_file}') != 0:
+        raise Exception(f"kubectl apply -f {yaml_file} failed, the chaos test was not started")
+
+
+@instrumented
 def apply_chaos_tests_at_good_time(yaml_file: str) -> None:
     """
     Normally the chaos includes a cron schedule.
@@ -78,21 +103,14 @@ def apply_chaos_tests_at_good_time(yaml_file: str) -> None:
     Returns:
     None.
     """
-    if has_cron_schedule(yaml_file):
+    seconds = seconds_until_good_time(yaml_file)
+    if seconds > 0:
         print("Waiting for cron schedule to be over so we have a clean start")
-
-        current_time = time.localtime()
-        time_to_wait_until = round_time_to_next_cron(current_time, OFFSET_IN_MINUTES)
-        dt_to_wait_until = datetime.fromtimestamp(time.mktime(time_to_wait_until))
-
-        while datetime.now() < dt_to_wait_until:
-            time.sleep(5)
-        # Wait for a safety time of 2 seconds -> that way checking seconds becomes irrelevant
-        time.sleep(2)
+        time.sleep(seconds)
     else:
         print("No cron schedule detected, applying chaos tests immediately")
 
     # Run the chaos tests
-    os.system(f'kubectl apply -f {yaml_file}')
+    apply_manifest(yaml_file)
     print("Chaos tests started")
     
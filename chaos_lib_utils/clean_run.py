@@ -7,6 +7,7 @@ import subprocess
 import re
 import time
 from chaos_lib_utils.constants import NAMESPACE_ENV, MAX_POD_RECREATION_TIME_SECONDS
+from chaos_lib_utils.instrumentation import instrumented, timed_run, sleep
 
 def get_namespace_deployment_yaml(namespace: str = NAMESPACE_ENV) -> str:
     """
@@ -22,11 +23,12 @@ def get_namespace_deployment_yaml(namespace: str = NAMESPACE_ENV) -> str:
     """
     cmd = f"kubectl get deployments -n {namespace} -o yaml"
     try:
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+        result = timed_run(cmd, shell=True, stdout=subprocess.PIPE)
         return result.stdout.decode('utf-8')
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error getting deployments in namespace {namespace}: {e}")
 
+@instrumented
 def cleanup_containers(namespace:str = NAMESPACE_ENV)-> None:
     """
     Deletes and re-create all deployments that are in the specified namespace to clean up in between different chaos tests.
@@ -41,24 +43,20 @@ def cleanup_containers(namespace:str = NAMESPACE_ENV)-> None:
     Returns:
     None
     """
-    all_deployments_yaml = get_namespace_deployment_yaml()
-    
-    # write this yaml to a file and apply it to the cluster
-    with open("all_deployments.yaml", "w") as f:
-        f.write(all_deployments_yaml)
+    all_deployments_yaml = get_namespace_deployment_yaml(namespace)
     
     # Delete all deployments
     cmd = f"kubectl delete deployments --all -n {namespace}"
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        timed_run(cmd, shell=True, check=True)
         
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error deleting deployments in namespace {namespace}: {e}")
     
-    # Re-create all deployments    
-    cmd = f"kubectl apply -f all_deployments.yaml"
+    # Re-create all deployments (from stdin, a file in the working directory would be shared by all clusters of a pool)
+    cmd = f"kubectl apply -f -"
     try:
-        subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timed_run(cmd, shell=True, check=True, input=all_deployments_yaml.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                     
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error re-creating deployments in namespace {namespace}: {e}")
@@ -81,7 +79,7 @@ def probe_all_pods_ready(namespace: str = NAMESPACE_ENV) -> bool:
     # ...
     
     try: 
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+        result = timed_run(cmd, shell=True, stdout=subprocess.PIPE)
         output = result.stdout.decode('utf-8')
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error getting deployments in namespace {namespace}: {e}")
@@ -99,6 +97,7 @@ def probe_all_pods_ready(namespace: str = NAMESPACE_ENV) -> bool:
                 return False
     return True
     
+@instrumented
 def wait_for_pods_ready(namespace: str = NAMESPACE_ENV, waiting_treshhold: str = MAX_POD_RECREATION_TIME_SECONDS) -> None:
     """
     This function probes pods in the defined namespace all 5 seconds until all are ready.
@@ -121,9 +120,10 @@ def wait_for_pods_ready(namespace: str = NAMESPACE_ENV, waiting_treshhold: str =
         # If the waiting time exceeds the threshold, raise an exception
         if time.time() - start_waiting_time > 300:
             raise Exception(f"Waiting for pods to be ready exceeded threshold of {waiting_treshhold} seconds")
-        time.sleep(5)
+        sleep(5)
     return None
         
+@instrumented
 def delete_running_chaos_tests(namespace: str = NAMESPACE_ENV) -> None:
     """
     Delete all chaos tests running in the cluster
@@ -135,7 +135,7 @@ def delete_running_chaos_tests(namespace: str = NAMESPACE_ENV) -> None:
     # Get all chaos tests from chaos mesh, with "kubectl get apiresources"
     # filter for lines that have chaos-mesh.org in them
     cmd = "kubectl api-resources"
-    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE)
     output = result.stdout.decode('utf-8')
     # Get types of chaos tests
     chaos_test_types = [line.split(" ")[0] for line in output.split('\n') if "chaos-mesh.org" in line]
@@ -144,7 +144,7 @@ def delete_running_chaos_tests(namespace: str = NAMESPACE_ENV) -> None:
     chaos_tests_in_cluster = []
     for chaos_test_type in chaos_test_types:
         cmd = f"kubectl get {chaos_test_type} -A"
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         output = result.stdout.decode('utf-8')
     
         if output.startswith("No resources found"):
@@ -165,7 +165,7 @@ def delete_running_chaos_tests(namespace: str = NAMESPACE_ENV) -> None:
     # Delete old chaos tests in cluster
     for chaos_test_type, name, _ in chaos_tests_in_cluster:
         cmd = f"kubectl delete {chaos_test_type} {name} -n {namespace}"
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+        result = timed_run(cmd, shell=True, stdout=subprocess.PIPE)
         print(f"Deleted old chaos test {name} in {namespace}")
 
 
@@ -0,0 +1,334 @@
+"""
+This module decides how the cluster is reset before a run.
+Deleting and re-creating every deployment (cleanup_containers) makes Kafka, Flink, producers and sinks cold start
+on every run. Usually it is enough to restart what the chaos test touched.
+
+The reset compares the live deployments against a baseline snapshot (taken once, when the setup is healthy):
+- deployments missing in the cluster are created from the snapshot
+- deployments whose spec drifted from the snapshot are re-applied from the snapshot
+- the deployments targeted by the chaos test (and the drifted ones) are reset with the strategy of the experiment
+
+Strategies:
+- recreate: delete all deployments and re-create them from the baseline (deployments that are not in the baseline
+  are re-created from their sanitized live spec)
+- rollout-restart: rolling restart of only the affected deployments
+- scale: scale the affected deployments to 0 and back to their baseline replicas
+- reset-offsets: like scale, but resets the kafka consumer group offsets to the latest offset while scaled down,
+  so the consumers start without a backlog
+
+The strategy is chosen per experiment with the annotation "chaos-wizard/cleanup-strategy" in the metadata of the
+experiment yaml, otherwise CLEANUP_STRATEGY from config.env is used.
+
+The module contains the following functions:
+- sanitize_deployment: Removes the server side fields (status, resourceVersion, ...) from a deployment
+- get_baseline_snapshot_path: The baseline of the current cluster (one file per cluster of a cluster pool)
+- save_baseline_snapshot / load_baseline_snapshot: Store and load the baseline
+- diff_against_baseline: Compares the live deployments with the baseline
+- recreate_deployments: Deletes all deployments and applies the given ones
+- get_affected_deployments: Deployments selected by the chaos test
+- reset_cluster: Resets the cluster for an experiment with its strategy
+"""
+import json
+import os
+import subprocess
+import threading
+
+import yaml
+
+from chaos_lib_utils.constants import (NAMESPACE_ENV, CLEANUP_STRATEGY, BASELINE_SNAPSHOT_FILE, KAFKA_CONSUMER_GROUPS,
+                                       KAFKA_BOOTSTRAP_SERVER, KAFKA_POD_SELECTOR, KAFKA_CONSUMER_GROUPS_SCRIPT)
+from chaos_lib_utils.clean_run import wait_for_pods_ready, probe_all_pods_ready
+from chaos_lib_utils.instrumentation import instrumented, timed_run
+from chaos_lib_utils.cluster_pool import get_log_suffix
+
+CLEANUP_STRATEGIES = ["recreate", "rollout-restart", "scale", "reset-offsets"]
+STRATEGY_ANNOTATION = "chaos-wizard/cleanup-strategy"
+
+# Fields set by the api server, applying them again fails or pins stale state
+SERVER_SIDE_METADATA = ["resourceVersion", "uid", "creationTimestamp", "generation", "managedFields", "selfLink"]
+SERVER_SIDE_ANNOTATIONS = ["kubectl.kubernetes.io/last-applied-configuration", "deployment.kubernetes.io/revision",
+                           "kubectl.kubernetes.io/restartedAt"]
+
+
+def sanitize_deployment(deployment: dict) -> dict:
+    """
+    Returns a copy of a deployment without status and server side metadata, so it can be applied again
+
+    Parameters:
+    deployment: dict: A deployment as returned by kubectl get -o json
+
+    Returns:
+    dict: The sanitized deployment
+    """
+    deployment = json.loads(json.dumps(deployment))
+    deployment.pop("status", None)
+    metadata = deployment.get("metadata", {})
+    for field in SERVER_SIDE_METADATA:
+        metadata.pop(field, None)
+    for owner in [metadata, deployment.get("spec", {}).get("template", {}).get("metadata", {})]:
+        annotations = owner.get("annotations")
+        if annotations is None:
+            continue
+        for annotation in SERVER_SIDE_ANNOTATIONS:
+            annotations.pop(annotation, None)
+        # a restarted deployment keeps an empty map, the baseline has none
+        if len(annotations) == 0:
+            owner.pop("annotations")
+    return deployment
+
+
+def get_live_deployments(namespace: str = NAMESPACE_ENV) -> dict[str, dict]:
+    """
+    Returns all deployments in the namespace by name (as returned by kubectl, not sanitized)
+    """
+    cmd = f"kubectl get deployments -n {namespace} -o json"
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"Error getting deployments in namespace {namespace}: {result.stderr.decode('utf-8')}")
+    items = json.loads(result.stdout.decode('utf-8'))["items"]
+    return {item["metadata"]["name"]: item for item in items}
+
+
+def get_baseline_snapshot_path(snapshot_file: str = BASELINE_SNAPSHOT_FILE) -> str:
+    """
+    Path of the baseline of the current cluster, e.g. experiments/baseline_deployments@kind-2.json
+    (every cluster of a pool has its own setup, see cluster_pool.py)
+    """
+    root, extension = os.path.splitext(snapshot_file)
+    return f"{root}{get_log_suffix()}{extension}"
+
+
+def save_baseline_snapshot(namespace: str = NAMESPACE_ENV, snapshot_file: str = None) -> dict[str, dict]:
+    """
+    Stores the sanitized deployments of the namespace as the baseline.
+    Take the snapshot when the setup is healthy (all pods ready, load running).
+    The file is replaced at once, other workers never read a half written snapshot.
+    """
+    if snapshot_file is None:
+        snapshot_file = get_baseline_snapshot_path()
+    baseline = {name: sanitize_deployment(deployment) for name, deployment in get_live_deployments(namespace).items()}
+    tmp_path = f"{snapshot_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"namespace": namespace, "deployments": baseline}, f, indent=1)
+    os.replace(tmp_path, snapshot_file)
+    return baseline
+
+
+def load_baseline_snapshot(snapshot_file: str = None) -> dict[str, dict]:
+    """
+    Loads the baseline deployments, None if there is no snapshot yet
+    """
+    if snapshot_file is None:
+        snapshot_file = get_baseline_snapshot_path()
+    if not os.path.exists(snapshot_file):
+        return None
+    with open(snapshot_file, "r") as f:
+        return json.load(f)["deployments"]
+
+
+def diff_against_baseline(live: dict[str, dict], baseline: dict[str, dict]) -> dict[str, list[str]]:
+    """
+    Compares the live deployments against the baseline
+
+    Returns:
+    dict with the deployment names that are
+    - missing: in the baseline but not in the cluster
+    - changed: the spec differs from the baseline
+    - unready: fewer ready replicas than desired
+    - extra: in the cluster but not in the baseline (left alone)
+    """
+    diff = {"missing": [], "changed": [], "unready": [], "extra": []}
+    for name, deployment in baseline.items():
+        if name not in live:
+            diff["missing"].append(name)
+            continue
+        # both sides sanitized, snapshots of older versions can still hold the server side annotations
+        if sanitize_deployment(live[name]).get("spec") != sanitize_deployment(deployment).get("spec"):
+            diff["changed"].append(name)
+        status = live[name].get("status", {})
+        if status.get("readyReplicas", 0) != live[name].get("spec", {}).get("replicas", 1):
+            diff["unready"].append(name)
+    diff["extra"] = sorted(name for name in live if name not in baseline)
+    return diff
+
+
+def _find_label_selectors(node) -> list[dict]:
+    # Every chaos kind keeps its target in a "selector", workflows and schedules nest them
+    selectors = []
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "selector" and isinstance(value, dict):
+                selectors.append(value.get("labelSelectors") or {})
+            else:
+                selectors.extend(_find_label_selectors(value))
+    elif isinstance(node, list):
+        for value in node:
+            selectors.extend(_find_label_selectors(value))
+    return selectors
+
+
+def load_experiment(yaml_file: str) -> dict:
+    with open(yaml_file, "r") as f:
+        return yaml.safe_load(f) or {}
+
+
+def get_cleanup_strategy(experiment: dict, default: str = CLEANUP_STRATEGY) -> str:
+    """
+    Returns the cleanup strategy of an experiment (annotation) or the default
+    """
+    annotations = experiment.get("metadata", {}).get("annotations") or {}
+    strategy = annotations.get(STRATEGY_ANNOTATION, default)
+    if strategy not in CLEANUP_STRATEGIES:
+        raise Exception(f"Unknown cleanup strategy {strategy}, expected one of {CLEANUP_STRATEGIES}")
+    return strategy
+
+
+def get_affected_deployments(experiment: dict, deployments: dict[str, dict]) -> list[str]:
+    """
+    Returns the deployments whose pods are selected by the chaos test.
+    A selector without labels (e.g. a network delay on the whole namespace) affects all deployments.
+    """
+    selectors = _find_label_selectors(experiment.get("spec", {}))
+    if len(selectors) == 0 or any(len(selector) == 0 for selector in selectors):
+        return sorted(deployments)
+
+    affected = []
+    for name, deployment in deployments.items():
+        labels = deployment.get("spec", {}).get("template", {}).get("metadata", {}).get("labels", {})
+        if any(all(labels.get(key) == str(value) for key, value in selector.items()) for selector in selectors):
+            affected.append(name)
+    return sorted(affected)
+
+
+def _apply_deployments(deployments: list[dict], namespace: str) -> None:
+    manifest = {"apiVersion": "v1", "kind": "List", "items": deployments}
+    result = timed_run(f"kubectl apply -n {namespace} -f -", shell=True, input=json.dumps(manifest).encode("utf-8"),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"Error applying deployments in namespace {namespace}: {result.stderr.decode('utf-8')}")
+
+
+def _kubectl(cmd: str, error: str) -> None:
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"{error}: {result.stderr.decode('utf-8')}")
+
+
+@instrumented
+def recreate_deployments(deployments: list[dict], namespace: str = NAMESPACE_ENV) -> None:
+    """
+    Deletes all deployments of the namespace and applies the given (sanitized) ones
+    """
+    _kubectl(f"kubectl delete deployments --all -n {namespace}", f"Error deleting deployments in namespace {namespace}")
+    if len(deployments) > 0:
+        _apply_deployments(deployments, namespace)
+
+
+@instrumented
+def rollout_restart(names: list[str], namespace: str = NAMESPACE_ENV) -> None:
+    """
+    Rolling restart of the deployments, waits until the rollouts are done
+    """
+    if len(names) == 0:
+        return
+    deployments = " ".join(f"deployment/{name}" for name in names)
+    _kubectl(f"kubectl rollout restart {deployments} -n {namespace}", "Error restarting deployments")
+    for name in names:
+        _kubectl(f"kubectl rollout status deployment/{name} -n {namespace} --timeout=300s", f"Rollout of {name} did not finish")
+
+
+@instrumented
+def scale_deployments(names: list[str], replicas: dict[str, int], namespace: str = NAMESPACE_ENV) -> None:
+    """
+    Scales every deployment to replicas[name]
+    """
+    for name in names:
+        _kubectl(f"kubectl scale deployment/{name} --replicas={replicas[name]} -n {namespace}", f"Error scaling {name}")
+
+
+@instrumented
+def reset_consumer_group_offsets(consumer_groups: list[str] = KAFKA_CONSUMER_GROUPS, namespace: str = NAMESPACE_ENV) -> None:
+    """
+    Resets the offsets of the kafka consumer groups to the latest offset of all topics.
+    The consumers of the groups have to be stopped, kafka refuses the reset for active groups.
+    """
+    cmd = f"kubectl get pods -n {namespace} -l {KAFKA_POD_SELECTOR} -o jsonpath=\"{{.items[0].metadata.name}}\""
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    kafka_pod = result.stdout.decode('utf-8').strip()
+    if result.returncode != 0 or kafka_pod == "":
+        raise Exception(f"No kafka pod found with {KAFKA_POD_SELECTOR} in namespace {namespace}")
+
+    for group in consumer_groups:
+        _kubectl(f"kubectl exec -n {namespace} {kafka_pod} -- {KAFKA_CONSUMER_GROUPS_SCRIPT} --bootstrap-server {KAFKA_BOOTSTRAP_SERVER} "
+                 f"--group {group} --reset-offsets --to-latest --all-topics --execute", f"Error resetting offsets of {group}")
+
+
+@instrumented
+def reset_cluster(yaml_file: str, namespace: str = NAMESPACE_ENV, strategy: str = None, snapshot_file: str = None,
+                  companion_yaml_file: str = None) -> str:
+    """
+    Resets the cluster before running the experiment in yaml_file.
+    If there is no baseline snapshot yet, it is taken now (if all pods are ready) and the deployments are re-created.
+
+    Parameters:
+    yaml_file: str: The experiment that will run next
+    namespace: str: The namespace of the setup
+    strategy: str: Overrides the strategy of the experiment
+    snapshot_file: str: Path of the baseline snapshot (defaults to the one of the current cluster)
+    companion_yaml_file: str: Chaos test applied together with yaml_file, its targets are reset as well
+
+    Returns:
+    str: The strategy that was used
+    """
+    experiment = load_experiment(yaml_file)
+    if strategy is None:
+        strategy = get_cleanup_strategy(experiment)
+    if snapshot_file is None:
+        snapshot_file = get_baseline_snapshot_path()
+
+    baseline = load_baseline_snapshot(snapshot_file)
+    if baseline is None:
+        if probe_all_pods_ready(namespace):
+            print(f"No baseline snapshot found, storing the current deployments in {snapshot_file}")
+            baseline = save_baseline_snapshot(namespace, snapshot_file)
+        strategy = "recreate"
+
+    if strategy == "reset-offsets" and len(KAFKA_CONSUMER_GROUPS) == 0:
+        # check before scaling anything down
+        raise Exception("reset-offsets needs the consumer groups to reset, set KAFKA_CONSUMER_GROUPS in config.env")
+
+    live = get_live_deployments(namespace)
+    if strategy == "recreate":
+        # never the live dump itself, its status and resourceVersion would be applied again
+        deployments = [deployment for deployment in (baseline or {}).values()]
+        deployments += [sanitize_deployment(deployment) for name, deployment in live.items() if name not in (baseline or {})]
+        recreate_deployments(deployments, namespace)
+        wait_for_pods_ready(namespace)
+        return strategy
+
+    diff = diff_against_baseline(live, baseline)
+    print(f"Cluster diff against baseline: {', '.join(f'{k}={v}' for k, v in diff.items() if v) or 'no differences'}")
+
+    # Bring back the baseline for everything that drifted or disappeared
+    drifted = diff["missing"] + diff["changed"]
+    if len(drifted) > 0:
+        _apply_deployments([baseline[name] for name in drifted], namespace)
+
+    affected = set(get_affected_deployments(experiment, baseline)) | set(diff["changed"]) | set(diff["unready"])
+    if companion_yaml_file is not None:
+        affected |= set(get_affected_deployments(load_experiment(companion_yaml_file), baseline))
+    affected = sorted(affected)
+    affected = [name for name in affected if name not in diff["missing"]]
+    print(f"Resetting {affected} with strategy {strategy}")
+
+    if strategy == "rollout-restart":
+        rollout_restart(affected, namespace)
+    else:
+        scale_deployments(affected, {name: 0 for name in affected}, namespace)
+        if strategy == "reset-offsets":
+            reset_consumer_group_offsets(namespace=namespace)
+        replicas = {name: baseline[name].get("spec", {}).get("replicas", 1) for name in affected}
+        scale_deployments(affected, replicas, namespace)
+
+    wait_for_pods_ready(namespace)
+    return strategy
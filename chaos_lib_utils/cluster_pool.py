@@ -0,0 +1,161 @@
+"""
+This module lets a sweep run on several clusters at once (e.g. identical minikube / kind profiles on one host).
+
+Every worker of a sweep is bound to a cluster: a kubeconfig context and the Prometheus URL of that cluster.
+The binding is a context variable, so nothing has to pass the cluster around:
+- timed_run / timed_system add --context (kubectl) or --kube-context (helm) to every command (kube_command)
+- Prometheus clients for the default PROMETHEUS_URL use the URL of the cluster instead (resolve_prometheus_url)
+- log names get the cluster as suffix, so two clusters can run the same experiment in the same second
+  (single_100_2024-12-19_13-47-23@kind-2.log), the catalogue has a cluster column
+asyncio tasks and asyncio.to_thread copy the context variables, so the kubectl calls of a run (which run in threads)
+use the cluster of the worker that started the run. All clusters write into the same log folder and catalogue.
+
+The experiments are sharded over the workers (all runs of an experiment on the same cluster, so the runs of an
+experiment are comparable), a worker whose shard is empty steals the last run of the fullest shard of another worker.
+So a sweep of 20 latencies x 3 runs on 4 clusters takes about a quarter of the time, also if some runs take longer.
+
+Example (config.env or --clusters of the sweep command):
+CLUSTER_CONTEXTS=kind-1=http://localhost:9091, kind-2=http://localhost:9092
+
+The module contains the following classes and functions:
+- Cluster: Name, kube context and Prometheus URL of a worker
+- parse_clusters: Clusters from "context=prometheus_url" entries
+- use_cluster: Binds the current code (thread / task) to a cluster
+- kube_command: Adds the kube context of the current cluster to a shell command
+- resolve_prometheus_url: The Prometheus URL of the current cluster
+- get_log_suffix: Suffix of the log names of the current cluster
+- WorkStealingQueue: Runs sharded by experiment, with work stealing
+"""
+import contextlib
+import contextvars
+import re
+import shlex
+from collections import deque
+from typing import NamedTuple
+
+
+class Cluster(NamedTuple):
+    # used in log names and the catalogue
+    name: str
+    context: str
+    # None uses PROMETHEUS_URL
+    prometheus_url: str = None
+
+
+current_cluster = contextvars.ContextVar("current_cluster", default=None)
+
+# kubectl / helm at the start of a (sub)command of a shell command line
+_KUBE_COMMAND = re.compile(r"(^|[;&|(]\s*)(kubectl|helm)(?=\s|$)")
+
+
+def parse_clusters(entries: list[str]) -> list[Cluster]:
+    """
+    Parses "context=prometheus_url" (or only "context") entries, the name is the context without
+    characters that do not belong in a file name
+
+    Raises:
+    Exception: If two entries have the same name
+    """
+    clusters = []
+    for entry in entries:
+        context, _, url = entry.strip().partition("=")
+        name = re.sub(r"[^A-Za-z0-9_.-]", "-", context.strip())
+        clusters.append(Cluster(name, context.strip(), url.strip() or None))
+    names = [cluster.name for cluster in clusters]
+    if len(set(names)) != len(names):
+        raise Exception(f"Every cluster needs its own kube context: {entries}")
+    return clusters
+
+
+@contextlib.contextmanager
+def use_cluster(cluster: Cluster):
+    """
+    Runs the block against cluster (None is the current kubectl context and PROMETHEUS_URL)
+    """
+    token = current_cluster.set(cluster)
+    try:
+        yield cluster
+    finally:
+        current_cluster.reset(token)
+
+
+def kube_command(cmd: str) -> str:
+    """
+    Adds the kube context of the current cluster to every kubectl and helm call of a shell command
+    e.g. "kubectl get pods | wc -l" -> "kubectl --context kind-2 get pods | wc -l"
+    """
+    cluster = current_cluster.get()
+    if cluster is None:
+        return cmd
+    context = shlex.quote(cluster.context)
+
+    def add_context(match: re.Match) -> str:
+        flag = "--context" if match.group(2) == "kubectl" else "--kube-context"
+        return f"{match.group(1)}{match.group(2)} {flag} {context}"
+
+    return _KUBE_COMMAND.sub(add_context, cmd)
+
+
+def resolve_prometheus_url(url: str) -> str:
+    """
+    Returns the Prometheus URL of the current cluster if url is the default PROMETHEUS_URL,
+    explicitly given URLs are kept
+    """
+    cluster = current_cluster.get()
+    if cluster is None or cluster.prometheus_url is None:
+        return url
+    from chaos_lib_utils.constants import PROMETHEUS_URL
+    return cluster.prometheus_url if url.rstrip("/") == PROMETHEUS_URL.rstrip("/") else url
+
+
+def get_log_suffix() -> str:
+    """
+    Suffix of the log names of the current cluster ("" without a cluster)
+    """
+    cluster = current_cluster.get()
+    return "" if cluster is None else f"@{cluster.name}"
+
+
+class WorkStealingQueue:
+    """
+    A deque of runs per worker. The experiments are distributed round robin over the workers, a worker takes its
+    runs from the front of its own deque and, once it is empty, steals from the back of the fullest other deque.
+    Only used from the event loop, so there is no lock.
+
+    Parameters:
+    workers: int: Number of workers
+    """
+    def __init__(self, workers: int):
+        self.deques = [deque() for _ in range(max(1, workers))]
+        self.stolen = 0
+
+    def shard(self, yaml_files: list[str], number_of_runs: int) -> None:
+        """
+        Adds number_of_runs runs (yaml_file, run_number) of every experiment, all runs of an experiment to the same worker
+        """
+        for i, yaml_file in enumerate(yaml_files):
+            self.deques[i % len(self.deques)].extend((yaml_file, run_number) for run_number in range(1, number_of_runs + 1))
+
+    def push(self, worker: int, run: tuple) -> None:
+        """
+        Adds a run to the back of the deque of a worker (e.g. a repeated run)
+        """
+        self.deques[worker].append(run)
+
+    def pop(self, worker: int) -> tuple:
+        """
+        Returns the next run of a worker, stolen if its own deque is empty
+
+        Returns:
+        tuple: (yaml_file, run_number), None if there are no runs left at all
+        """
+        if self.deques[worker]:
+            return self.deques[worker].popleft()
+        victim = max(self.deques, key=len)
+        if not victim:
+            return None
+        self.stolen += 1
+        return victim.pop()
+
+    def __len__(self) -> int:
+        return sum(len(d) for d in self.deques)
@@ -1,12 +1,94 @@
 """
 This module holds all shared constants and provides a function to load the comstans from a file (config.env)
+
+Importing this module does not read the config file, it is read once on the first access of a constant through the
+settings object. Most modules import their constants at the top ("from chaos_lib_utils.constants import NUMBER_OF_RUNS"),
+so in practice the config is read when the first of them is imported and the values are fixed from then on:
+changing config.env needs a restart of the CLI.
+The log folder is created by ensure_log_folder() when a run actually writes logs.
 """
 import os
-from dotenv import load_dotenv
 
-# Load the config file
-# Get the namespace from the config file
-load_dotenv('config.env')
+CONFIG_FILE = 'config.env'
+
+
+def csv_list(value: str) -> list[str]:
+    # type for comma separated settings, e.g. "a, b" -> ["a", "b"]
+    return [item.strip() for item in value.split(",") if item.strip()] if isinstance(value, str) else list(value)
+
+
+# Name of the constant, name in the config file, default value, type
+# If a value is not found in the config file, the default value is used
+SETTINGS_SPEC = [
+    ("NUMBER_OF_RUNS", "NUMBER_OF_RUNS", 2, int),
+    ("OFFSET_IN_MINUTES", "OFFSET_IN_MINUTES", 3, float),
+    ("PROMETHEUS_URL", "PROMETHEUS_URL", "http://localhost:9090", None),
+    ("TIME_GRANULARITY", "TIME_GRANULARITY", 1, float),
+    ("DATA_FETCH_INTERVAL_SECONDS", "DATA_FETCH_INTERVAL_SECONDS", 60, float),
+    ("NAMESPACE_ENV", "CHAOS_TESTING_NAMESPACE", "kafka", None),
+    ("JSONNET_FOLDER", "JSONNET_FOLDER", "experiments/jsonnet_templates", None),
+    ("YAML_FOLDER", "YAML_FOLDER", "experiments", None),
+    ("MAX_POD_RECREATION_TIME_SECONDS", "MAX_POD_RECREATION_TIME_SECONDS", 300, float),
+    ("PROMETHEUS_CUSTOM_RESOURCE_NAME", "PROMETHEUS_CUSTOM_RESOURCE_NAME", "prometheus-kube-prometheus-prometheus", None),
+    ("PROMETHEUS_TIME_GRANULARITY", "PROMETHEUS_TIME_GRANULARITY", 5, int),
+    ("PROMETHEUS_NAMESPACE", "PROMETHEUS_NAMESPACE", "monitoring", None),
+    # Fetching from prometheus: timeout per request, retries with exponential backoff and a circuit breaker
+    ("FETCH_TIMEOUT_SECONDS", "FETCH_TIMEOUT_SECONDS", 10, float),
+    ("FETCH_MAX_RETRIES", "FETCH_MAX_RETRIES", 5, int),
+    ("FETCH_BACKOFF_BASE_SECONDS", "FETCH_BACKOFF_BASE_SECONDS", 1, float),
+    ("FETCH_BACKOFF_MAX_SECONDS", "FETCH_BACKOFF_MAX_SECONDS", 30, float),
+    ("CIRCUIT_BREAKER_FAILURES", "CIRCUIT_BREAKER_FAILURES", 5, int),
+    ("CIRCUIT_BREAKER_RESET_SECONDS", "CIRCUIT_BREAKER_RESET_SECONDS", 60, float),
+    # Bulk export of the exact samples after a run via remote read (1 enables it), polling is then only a preview
+    ("REMOTE_READ_EXPORT", "REMOTE_READ_EXPORT", 0, int),
+    ("PREVIEW_TIME_GRANULARITY", "PREVIEW_TIME_GRANULARITY", 15, float),
+    ("REMOTE_READ_WINDOW_SECONDS", "REMOTE_READ_WINDOW_SECONDS", 3600, float),
+    # Injection timeline: Chaos Mesh records and pod events are polled during a run (0 disables it), see injection_timeline.py
+    ("INJECTION_POLL_SECONDS", "INJECTION_POLL_SECONDS", 5, float),
+    ("RECOVERY_BASELINE_SECONDS", "RECOVERY_BASELINE_SECONDS", 60, float),
+    ("RECOVERY_MEDIAN_FRACTION", "RECOVERY_MEDIAN_FRACTION", 1, float),
+    # Load sweep: the rate in the config of the load generator is replaced with a regex (group "rate"), see load_sweep.py
+    ("LOAD_CONFIGMAP", "LOAD_CONFIGMAP", "def-load", None),
+    ("LOAD_CONFIGMAP_KEY", "LOAD_CONFIGMAP_KEY", "load", None),
+    ("LOAD_RATE_PATTERN", "LOAD_RATE_PATTERN", r"rate\W*(?P<rate>\d+(?:\.\d+)?)", None),
+    ("LOAD_DEPLOYMENT", "LOAD_DEPLOYMENT", "load-generator", None),
+    ("INPUT_RATE_QUERY", "INPUT_RATE_QUERY", 'sum(rate(kafka_topic_partition_current_offset{topic=~".*input.*"}[1m]))', None),
+    ("LOAD_RATE_TOLERANCE", "LOAD_RATE_TOLERANCE", 0.1, float),
+    ("LOAD_STEADY_WINDOW_SECONDS", "LOAD_STEADY_WINDOW_SECONDS", 120, float),
+    ("LOAD_STEADY_TIMEOUT_SECONDS", "LOAD_STEADY_TIMEOUT_SECONDS", 900, float),
+    ("LOAD_MAX_RECOVERY_SECONDS", "LOAD_MAX_RECOVERY_SECONDS", 300, float),
+    # Prometheus watchdog: probes /-/ready and the query latency, restarts the pod and re-installs as last resort
+    ("PROMETHEUS_POD_SELECTOR", "PROMETHEUS_POD_SELECTOR", "app.kubernetes.io/name=prometheus", None),
+    ("WATCHDOG_INTERVAL_SECONDS", "WATCHDOG_INTERVAL_SECONDS", 15, float),
+    ("WATCHDOG_MAX_QUERY_SECONDS", "WATCHDOG_MAX_QUERY_SECONDS", 5, float),
+    ("WATCHDOG_RETRIES", "WATCHDOG_RETRIES", 3, int),
+    ("WATCHDOG_POD_RESTARTS", "WATCHDOG_POD_RESTARTS", 2, int),
+    ("WATCHDOG_RECOVERY_SECONDS", "WATCHDOG_RECOVERY_SECONDS", 180, float),
+    # Resetting the cluster before a run, see cleanup_strategies.py
+    ("CLEANUP_STRATEGY", "CLEANUP_STRATEGY", "recreate", None),
+    ("BASELINE_SNAPSHOT_FILE", "BASELINE_SNAPSHOT_FILE", "experiments/baseline_deployments.json", None),
+    ("KAFKA_CONSUMER_GROUPS", "KAFKA_CONSUMER_GROUPS", "", csv_list),
+    ("KAFKA_POD_SELECTOR", "KAFKA_POD_SELECTOR", "app.kubernetes.io/name=kafka", None),
+    ("KAFKA_BOOTSTRAP_SERVER", "KAFKA_BOOTSTRAP_SERVER", "localhost:9092", None),
+    ("KAFKA_CONSUMER_GROUPS_SCRIPT", "KAFKA_CONSUMER_GROUPS_SCRIPT", "kafka-consumer-groups.sh", None),
+    # Steady state gate before the chaos test is applied, see steady_state.py (a timeout of 0 disables the gate)
+    ("STEADY_STATE_WINDOW_SECONDS", "STEADY_STATE_WINDOW_SECONDS", 60, float),
+    ("STEADY_STATE_MAX_MEAN", "STEADY_STATE_MAX_MEAN", 1000, float),
+    ("STEADY_STATE_MAX_STD", "STEADY_STATE_MAX_STD", 500, float),
+    ("STEADY_STATE_TIMEOUT_SECONDS", "STEADY_STATE_TIMEOUT_SECONDS", 600, float),
+    ("STEADY_STATE_POLL_SECONDS", "STEADY_STATE_POLL_SECONDS", 10, float),
+    # Sweeps on several clusters: "kube context=prometheus url" per cluster, one run at a time per cluster, see cluster_pool.py
+    ("CLUSTER_CONTEXTS", "CLUSTER_CONTEXTS", "", csv_list),
+    # Index over all runs, relative to the log folder, see catalogue.py
+    ("CATALOGUE_FILE", "CATALOGUE_FILE", "catalogue.sqlite", None),
+    # Results of the manifest validation by hash of the manifest, see manifest_validation.py
+    ("VALIDATION_CACHE_FILE", "VALIDATION_CACHE_FILE", "experiments/.validation_cache.json", None),
+]
+
+# runtime vars
+logfile_path = None
+monitoring_start_time = None
+
 
 # helper function to get the environment variables
 def get_env_var(name, default=None, cast_type=None):
@@ -24,26 +106,62 @@ def get_csv_list_env_var(name, default=None):
         return [item.strip() for item in value.split(",") if item.strip()]
     return []
 
-# Load constants from env, if not found use default values
-NUMBER_OF_RUNS = get_env_var("NUMBER_OF_RUNS", 2, int)
-OFFSET_IN_MINUTES = get_env_var("OFFSET_IN_MINUTES", 3, float)
-OFFSET_IN_SECONDS = OFFSET_IN_MINUTES * 60
-
-PROMETHEUS_URL = get_env_var("PROMETHEUS_URL", "http://localhost:9090")
-TIME_GRANULARITY = get_env_var("TIME_GRANULARITY", 1, float)
-LOG_FOLDER = os.path.join(os.getcwd(), get_env_var("LOG_FOLDER", "experiments/runs"))
-DATA_FETCH_INTERVAL_SECONDS = get_env_var("DATA_FETCH_INTERVAL_SECONDS", 60, float)
-NAMESPACE_ENV = get_env_var("CHAOS_TESTING_NAMESPACE", "kafka")
-JSONNET_FOLDER = get_env_var("JSONNET_FOLDER", "experiments/jsonnet_templates")
-YAML_FOLDER = get_env_var("YAML_FOLDER", "experiments")
-MAX_POD_RECREATION_TIME_SECONDS = get_env_var("MAX_POD_RECREATION_TIME_SECONDS", 300, float)
-PROMETHEUS_CUSTOM_RESOURCE_NAME = get_env_var("PROMETHEUS_CUSTOM_RESOURCE_NAME", "prometheus-kube-prometheus-prometheus")
-PROMETHEUS_TIME_GRANULARITY = get_env_var("PROMETHEUS_TIME_GRANULARITY", 5, int)
-PROMETHEUS_NAMESPACE = get_env_var("PROMETHEUS_NAMESPACE", "monitoring")
-# runtime vars
-logfile_path = None
-monitoring_start_time = None
 
-# Create the log folder if it does not exist
-if not os.path.exists(LOG_FOLDER):
-    os.makedirs(LOG_FOLDER)
\ No newline at end of file
+class Settings:
+    """
+    Loads the config file on first access and holds all constants.
+
+    Example:
+    settings.NUMBER_OF_RUNS -> loads config.env (once) and returns the number of runs
+    """
+    def __init__(self, config_file: str = CONFIG_FILE):
+        self._config_file = config_file
+        self._values = None
+
+    def load(self) -> dict:
+        """
+        Loads the config file (only the first time it is called) and returns all constants
+        """
+        if self._values is None:
+            from dotenv import load_dotenv
+            load_dotenv(self._config_file)
+
+            values = {}
+            for name, env_name, default, cast_type in SETTINGS_SPEC:
+                values[name] = get_env_var(env_name, default, cast_type)
+            values["OFFSET_IN_SECONDS"] = values["OFFSET_IN_MINUTES"] * 60
+            values["LOG_FOLDER"] = os.path.join(os.getcwd(), get_env_var("LOG_FOLDER", "experiments/runs"))
+            self._values = values
+        return self._values
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.load()
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self.load()[name]
+        except KeyError:
+            raise AttributeError(f"Unknown setting {name}")
+
+
+settings = Settings()
+
+
+def __getattr__(name: str):
+    # Module level constants (NUMBER_OF_RUNS, LOG_FOLDER, ...) are forwarded to the settings object
+    if name.isupper() and name in settings:
+        return getattr(settings, name)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def ensure_log_folder(log_folder: str = None) -> str:
+    """
+    Create the log folder if it does not exist and return its path
+    """
+    if log_folder is None:
+        log_folder = settings.LOG_FOLDER
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+    return log_folder
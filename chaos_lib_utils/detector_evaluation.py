@@ -0,0 +1,250 @@
+"""
+This module measures how well the chaos detectors find the chaos events of a run, against a known ground truth.
+
+The ground truth are the fault windows of synthetic runs (synthetic_data.py, from the start of the fault until the
+backlog is drained) or, for recorded runs, the events measured from the injection timeline of Chaos Mesh
+(injection_timeline.py, from the injection until the lag is back at the baseline).
+
+Every detector sets the Chaos column, the detected events are the chaos groups (find_number_of_chaos_groups),
+the same way the notebook and analyze_run use them. Detected and true events are matched one to one by their overlap
+(the pair with the largest overlap first), so an event that is split into several detected events counts once and the
+other parts are false positives. Per detector and run:
+- precision: matched / detected events, recall: matched / true events
+- recovery time error: detected minus true duration of the matched events (in seconds, like compute_td)
+- throughput: samples per second of the detector itself (the Chaos column, without grouping)
+
+Example:
+cases = synthetic_cases(["baseline", "noisy"], samples=10000, seeds=3)
+results = evaluate_detectors(cases)
+print(format_evaluation(summarize_evaluation(results)))
+
+The module contains the following functions:
+- synthetic_cases: Synthetic runs with known fault windows for some scenarios
+- labelled_cases: Recorded runs labelled by their injection timeline
+- match_events: One to one matching of detected and true events
+- evaluate_detector: Scores of a detector on a single run
+- evaluate_detectors: Scores of several detectors on several runs
+- summarize_evaluation: Precision, recall, F1, recovery time error and throughput per detector
+- format_evaluation: The summary as a table for the terminal
+"""
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from chaos_lib_utils import change_point, reporting
+from chaos_lib_utils.synthetic_data import generate_lag_series
+
+# Detectors with the parameters we use for our runs (the lag is in messages, noise of about 50 around a baseline of 300)
+DETECTORS = {
+    "derivative": partial(reporting.identify_chaos_events_derivative, threshold=1000),
+    "quantiles": partial(reporting.identify_chaos_events_quantiles, upper_quantile=0.9),
+    "moving_average": partial(reporting.identify_chaos_events_moving_average, window_size=60, k=2),
+    "maxima": partial(reporting.identify_chaos_around_maxima, prominence=50),
+    "pelt": change_point.identify_chaos_events_pelt,
+    "cusum": change_point.identify_chaos_events_cusum,
+}
+
+# Keyword arguments of generate_lag_series, the number of faults depends on the length of the run
+SCENARIOS = {
+    "baseline": {},
+    # noise in the order of a small fault
+    "noisy": {"noise": 500},
+    # the miner drains slowly, long events that are easily split
+    "slow_drain": {"drain_rate": 500},
+    # low input rate, the events barely stand out of the noise
+    "small_faults": {"input_rate": 100},
+    # backlog of the re-created deployments at the start of the run, not an event
+    "warmup_backlog": {"warmup_backlog": 300000},
+}
+
+
+def synthetic_cases(scenarios: list[str] = None, samples: int = 10000, seeds: int = 1, fault_every: int = 600) -> list[dict]:
+    """
+    Generates synthetic runs with known fault windows
+
+    Parameters:
+    scenarios: list[str]: Names of SCENARIOS (all by default)
+    samples: int: Samples per run
+    seeds: int: Runs per scenario (different noise)
+    fault_every: int: One fault per this many samples
+
+    Returns:
+    list[dict]: name, scenario, times, values and windows ([start, end] indices) of every run
+    """
+    cases = []
+    for scenario in scenarios or SCENARIOS:
+        for seed in range(seeds):
+            times, values, windows = generate_lag_series(samples, num_faults=max(1, samples // fault_every), seed=seed,
+                                                         **SCENARIOS[scenario])
+            cases.append({"name": f"{scenario}_{seed}", "scenario": scenario, "times": times, "values": values,
+                          "windows": windows})
+    return cases
+
+
+def labelled_cases(log_files: list[str]) -> list[dict]:
+    """
+    Recorded runs labelled by the events measured from their injection timeline.
+    Runs without recorded injections are skipped, an event that did not recover lasts until the end of the run.
+
+    Returns:
+    list[dict]: See synthetic_cases, the scenario is "recorded"
+    """
+    from chaos_lib_utils.injection_timeline import measure_recovery
+    from chaos_lib_utils.run_archive import RunView
+
+    cases = []
+    for logfile_path in log_files:
+        run = RunView(logfile_path)
+        timeline = run.metadata.get("injections")
+        if not timeline or not timeline.get("injections") or len(run) == 0:
+            continue
+        times, values = np.asarray(run.times, dtype=np.float64), np.asarray(run.values, dtype=np.float64)
+        windows = []
+        for event in measure_recovery(times, values, timeline["injections"]):
+            start = int(np.searchsorted(times, event["start"]))
+            end = len(times) - 1 if event["end"] is None else int(np.searchsorted(times, event["end"]))
+            if start < len(times):
+                windows.append([start, min(end, len(times) - 1)])
+        cases.append({"name": run.name, "scenario": "recorded", "times": times, "values": values, "windows": windows})
+    return cases
+
+
+def match_events(detected: list[list[int]], truth: list[list[int]]) -> list[tuple[int, int]]:
+    """
+    Matches detected and true events ([start, end] indices, inclusive) one to one, the largest overlap first
+
+    Returns:
+    list[tuple[int, int]]: (index of the detected event, index of the true event) of every match
+    """
+    if not detected or not truth:
+        return []
+    detected = np.asarray(detected, dtype=np.int64).reshape(-1, 2)
+    truth = np.asarray(truth, dtype=np.int64).reshape(-1, 2)
+    # overlap of every pair in samples
+    overlap = (np.minimum(detected[:, None, 1], truth[None, :, 1]) - np.maximum(detected[:, None, 0], truth[None, :, 0]) + 1)
+    pairs = np.argwhere(overlap > 0)
+    pairs = pairs[np.argsort(-overlap[pairs[:, 0], pairs[:, 1]], kind="stable")]
+
+    matches = []
+    used_detected, used_truth = set(), set()
+    for i, j in pairs:
+        if i not in used_detected and j not in used_truth:
+            used_detected.add(i)
+            used_truth.add(j)
+            matches.append((int(i), int(j)))
+    return sorted(matches, key=lambda match: match[1])
+
+
+def evaluate_detector(detector, times: np.ndarray, values: np.ndarray, windows: list[list[int]], repeat: int = 1) -> dict:
+    """
+    Runs a detector on a run and scores its events against the true windows
+
+    Parameters:
+    detector: Function (df, column) -> df with the Chaos column
+    times / values: np.ndarray: The run
+    windows: list[list[int]]: The true events ([start, end] indices)
+    repeat: int: Timed calls, the fastest one is used for the throughput
+
+    Returns:
+    dict: detected, true, matched, precision, recall, recovery_error (mean absolute, seconds),
+    recovery_bias (mean signed, seconds), seconds and samples_per_second
+    """
+    seconds = float("inf")
+    for _ in range(max(1, repeat)):
+        # the detectors add columns, every call gets a fresh dataframe
+        df = pd.DataFrame({"Metric": "Lag_Input_Topic", "Time": times, "Value": values})
+        started = time.perf_counter()
+        df = detector(df, "Value")
+        seconds = min(seconds, time.perf_counter() - started)
+
+    _, detected = reporting.find_number_of_chaos_groups(df)
+    matches = match_events(detected, windows)
+    errors = np.array([(times[detected[i][1]] - times[detected[i][0]]) - (times[windows[j][1]] - times[windows[j][0]])
+                       for i, j in matches])
+    return {
+        "detected": len(detected),
+        "true": len(windows),
+        "matched": len(matches),
+        # no events detected and none expected is perfect
+        "precision": len(matches) / len(detected) if detected else float(not windows),
+        "recall": len(matches) / len(windows) if windows else 1.0,
+        "recovery_error": float(np.abs(errors).mean()) if len(errors) else None,
+        "recovery_bias": float(errors.mean()) if len(errors) else None,
+        "seconds": seconds,
+        "samples_per_second": len(values) / seconds if seconds > 0 else float("inf"),
+    }
+
+
+def evaluate_detectors(cases: list[dict], detectors: dict = None, repeat: int = 1) -> pd.DataFrame:
+    """
+    Scores every detector on every run
+
+    Parameters:
+    cases: list[dict]: See synthetic_cases / labelled_cases
+    detectors: dict: name -> detector (DETECTORS by default)
+    repeat: int: See evaluate_detector
+
+    Returns:
+    pd.DataFrame: One row per detector and run, the columns of evaluate_detector plus detector, scenario, run and samples
+    """
+    detectors = DETECTORS if detectors is None else detectors
+    rows = []
+    for name, detector in detectors.items():
+        for case in cases:
+            row = {"detector": name, "scenario": case["scenario"], "run": case["name"], "samples": len(case["values"])}
+            row.update(evaluate_detector(detector, case["times"], case["values"], case["windows"], repeat))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def summarize_evaluation(results: pd.DataFrame, by: list[str] = ["detector"]) -> pd.DataFrame:
+    """
+    Aggregates the scores of evaluate_detectors (e.g. by detector, or by detector and scenario).
+    Precision and recall are pooled over all events, the recovery time error is weighted by the matched events
+    and the throughput is the total of the samples divided by the total of the time.
+
+    Returns:
+    pd.DataFrame: by, runs, detected, true, matched, precision, recall, f1, recovery_error, recovery_bias, samples_per_second
+    """
+    results = results.assign(
+        weighted_error=results["recovery_error"].astype(float).fillna(0) * results["matched"],
+        weighted_bias=results["recovery_bias"].astype(float).fillna(0) * results["matched"],
+    )
+    summary = results.groupby(by, sort=False).agg(
+        runs=("run", "count"), detected=("detected", "sum"), true=("true", "sum"), matched=("matched", "sum"),
+        weighted_error=("weighted_error", "sum"), weighted_bias=("weighted_bias", "sum"),
+        samples=("samples", "sum"), seconds=("seconds", "sum"),
+    ).reset_index()
+
+    matched = summary["matched"].replace(0, np.nan)
+    summary["precision"] = np.where(summary["detected"] > 0, summary["matched"] / summary["detected"].replace(0, 1),
+                                    (summary["true"] == 0).astype(float))
+    summary["recall"] = np.where(summary["true"] > 0, summary["matched"] / summary["true"].replace(0, 1), 1.0)
+    total = summary["precision"] + summary["recall"]
+    summary["f1"] = np.where(total > 0, 2 * summary["precision"] * summary["recall"] / total.replace(0, 1), 0.0)
+    summary["recovery_error"] = summary["weighted_error"] / matched
+    summary["recovery_bias"] = summary["weighted_bias"] / matched
+    summary["samples_per_second"] = summary["samples"] / summary["seconds"]
+    return summary[by + ["runs", "detected", "true", "matched", "precision", "recall", "f1", "recovery_error",
+                         "recovery_bias", "samples_per_second"]]
+
+
+def format_evaluation(summary: pd.DataFrame) -> str:
+    """
+    Formats the summary of summarize_evaluation as a table, the best F1 first
+    """
+    keys = [column for column in summary.columns if column in ("detector", "scenario")]
+    order = [key for key in keys if key != "detector"] + ["f1"]
+    summary = summary.sort_values(order, ascending=[True] * (len(order) - 1) + [False])
+    header = (" ".join(f"{key:<16}" for key in keys) +
+              f" {'events':>7} {'found':>6} {'precision':>9} {'recall':>7} {'F1':>6} {'error s':>8} {'bias s':>8} {'samples/s':>11}")
+    lines = [header, "-" * len(header)]
+    for _, row in summary.iterrows():
+        error = f"{row['recovery_error']:.1f}" if pd.notna(row["recovery_error"]) else "-"
+        bias = f"{row['recovery_bias']:+.1f}" if pd.notna(row["recovery_bias"]) else "-"
+        lines.append(" ".join(f"{row[key]:<16}" for key in keys) +
+                     f" {row['true']:>7} {row['detected']:>6} {row['precision']:>9.2f} {row['recall']:>7.2f} {row['f1']:>6.2f}"
+                     f" {error:>8} {bias:>8} {row['samples_per_second']:>11.3g}")
+    return "\n".join(lines)
@@ -0,0 +1,240 @@
+"""
+This module contains a resilient client for the Prometheus HTTP API.
+
+- Every request has a timeout
+- Failed requests (connection errors, timeouts, 5xx, 429) are retried with exponential backoff and full jitter
+- A circuit breaker stops hammering a Prometheus that is down: after CIRCUIT_BREAKER_FAILURES failed requests
+  in a row, calls fail immediately for CIRCUIT_BREAKER_RESET_SECONDS, then a single trial request is let through
+- Range queries can be parsed while they are downloaded (query_range_stream, see matrix_stream.py)
+
+The module contains the following functions:
+- get_prometheus_client: Returns the shared client for a Prometheus URL (so the circuit state is kept between fetches)
+"""
+import random
+import threading
+import time
+
+from chaos_lib_utils.constants import (PROMETHEUS_URL, FETCH_TIMEOUT_SECONDS, FETCH_MAX_RETRIES, FETCH_BACKOFF_BASE_SECONDS,
+                                       FETCH_BACKOFF_MAX_SECONDS, CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_SECONDS)
+from chaos_lib_utils.instrumentation import span, count
+from chaos_lib_utils.cluster_pool import resolve_prometheus_url
+from chaos_lib_utils.matrix_stream import parse_matrix
+
+# Bytes read from a streamed response at once
+STREAM_CHUNK_SIZE = 1 << 16
+
+# Status codes that are worth retrying, everything else in 4xx means the request itself is wrong
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """
+    Raised when a request failed and retrying does not help (anymore)
+    """
+
+
+class CircuitOpenError(FetchError):
+    """
+    Raised without sending a request, while the circuit breaker considers Prometheus to be down
+    """
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures and opens after failure_threshold of them.
+    While open, allow_request() is False until reset_timeout has passed, then a single trial request is allowed
+    (half open). A success closes the circuit again, a failure re-opens it.
+    """
+    def __init__(self, failure_threshold: int = CIRCUIT_BREAKER_FAILURES, reset_timeout: float = CIRCUIT_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class PrometheusClient:
+    """
+    Client for the Prometheus HTTP API with timeouts, retries and a circuit breaker.
+
+    Parameters:
+    base_url: str: URL of Prometheus, e.g. http://localhost:9090
+    timeout: float: Timeout of a single request in seconds
+    max_retries: int: Retries after the first attempt
+    backoff_base: float: Backoff before the first retry in seconds, doubled for every retry
+    backoff_max: float: Upper bound for the backoff in seconds
+    circuit_breaker: CircuitBreaker: Circuit breaker to use (a new one by default)
+    """
+    def __init__(self, base_url: str = PROMETHEUS_URL, timeout: float = FETCH_TIMEOUT_SECONDS, max_retries: int = FETCH_MAX_RETRIES,
+                 backoff_base: float = FETCH_BACKOFF_BASE_SECONDS, backoff_max: float = FETCH_BACKOFF_MAX_SECONDS,
+                 circuit_breaker: CircuitBreaker = None):
+        # a worker of a cluster pool talks to the Prometheus of its cluster
+        self.base_url = resolve_prometheus_url(base_url).rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        # requests is imported here, it is slow to import and not needed to show the CLI menu
+        import requests
+        self.session = requests.Session()
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter: uniform in [0, min(backoff_max, backoff_base * 2^attempt)]
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get(self, path: str, params: dict, stream: bool = False) -> "requests.Response":
+        """
+        Sends a GET request, see request
+        """
+        return self.request("GET", path, params=params, stream=stream)
+
+    def post(self, path: str, data: bytes, headers: dict = None) -> "requests.Response":
+        """
+        Sends a POST request, see request
+        """
+        return self.request("POST", path, data=data, headers=headers)
+
+    def request(self, method: str, path: str, params: dict = None, data: bytes = None, headers: dict = None,
+                stream: bool = False) -> "requests.Response":
+        """
+        Sends a request, retrying until it succeeds or max_retries is exhausted.
+        With stream, only the headers of a successful response are read, the caller reads (and closes) the body.
+
+        Raises:
+        CircuitOpenError: If the circuit breaker is open
+        FetchError: If the request fails permanently
+        """
+        import requests
+
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                count("fetch_retries")
+                time.sleep(self.backoff(attempt - 1))
+
+            if not self.circuit_breaker.allow_request():
+                raise CircuitOpenError(f"Prometheus at {self.base_url} is unavailable, not sending requests for now. Last error: {last_error}")
+
+            try:
+                with span(f"{method} {path.split('/')[-1]}"):
+                    response = self.session.request(method, f"{self.base_url}{path}", params=params, data=data, headers=headers,
+                                                    timeout=self.timeout, stream=stream)
+            except requests.RequestException as e:
+                self.circuit_breaker.record_failure()
+                last_error = str(e)
+                continue
+
+            if not stream:
+                count("bytes_fetched", len(response.content))
+            if response.status_code == 200:
+                self.circuit_breaker.record_success()
+                return response
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                self.circuit_breaker.record_failure()
+                last_error = f"{response.status_code}: {response.text}"
+                continue
+
+            # Prometheus is reachable but does not like the request, retrying will not change that
+            self.circuit_breaker.record_success()
+            raise FetchError(f"Request to {path} failed with {response.status_code}: {response.text}")
+
+        raise FetchError(f"Request to {path} failed after {self.max_retries + 1} attempts. Last error: {last_error}")
+
+    def query_range(self, query: str, start_time: float, end_time: float, step: float) -> list[dict]:
+        """
+        Runs a range query and returns the result (a list of series with "metric" and "values")
+        """
+        response = self.get("/api/v1/query_range", {"query": query, "start": start_time, "end": end_time, "step": step})
+        return response.json()["data"]["result"]
+
+    def query_range_stream(self, query: str, start_time: float, end_time: float, step: float, row_prefix: bytes = b""):
+        """
+        Runs a range query and parses the body while it is downloaded, without building python objects per sample.
+        Stopping the iteration early (e.g. after the first series) closes the connection.
+
+        Returns:
+        Generator[MatrixSeries]: labels, timestamps and values (float64 arrays) and the log rows of every series
+
+        Raises:
+        FetchError: If the request fails or the connection breaks while the body is read (not retried,
+                    part of the result was already handed out)
+        """
+        import requests
+
+        response = self.get("/api/v1/query_range", {"query": query, "start": start_time, "end": end_time, "step": step}, stream=True)
+        def chunks():
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                count("bytes_fetched", len(chunk))
+                yield chunk
+
+        try:
+            for series in parse_matrix(chunks(), row_prefix):
+                yield series
+        except requests.RequestException as e:
+            self.circuit_breaker.record_failure()
+            raise FetchError(f"Reading the result of {query} failed: {e}")
+        except ValueError as e:
+            raise FetchError(f"Invalid result of {query}: {e}")
+        finally:
+            response.close()
+
+    def query(self, query: str, at: float = None) -> list[dict]:
+        """
+        Runs an instant query and returns the result (a list of series with "metric" and "value")
+        """
+        params = {"query": query}
+        if at is not None:
+            params["time"] = at
+        response = self.get("/api/v1/query", params)
+        return response.json()["data"]["result"]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_prometheus_client(base_url: str = PROMETHEUS_URL) -> PrometheusClient:
+    """
+    Returns the client for a Prometheus URL. The same client is returned for every call,
+    so the circuit breaker remembers failures across fetch windows.
+    """
+    base_url = resolve_prometheus_url(base_url)
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = PrometheusClient(base_url)
+        return _clients[base_url]
@@ -4,10 +4,14 @@ This module contains functions for file operations used in the chaos experiments
 The module contains the following functions:
 - get_file_safe_datetime: Get a datetime string that can be used in a filename
 - get_log_path: Get a log path and log name for the chaos test (subfolder is specified in config.env)
+- get_sidecar_path: Get the path of a file stored next to a log file (e.g. the run timeline)
+- update_run_metadata / load_run_metadata: Read and extend the metadata of a run (<log name>.meta.json)
 """
 from datetime import datetime
+import json
 import os
-from chaos_lib_utils.constants import LOG_FOLDER
+from chaos_lib_utils.constants import LOG_FOLDER, ensure_log_folder
+from chaos_lib_utils.cluster_pool import get_log_suffix
 
 def get_file_safe_datetime() -> str:
     """
@@ -21,8 +25,43 @@ def get_log_path(chaos_test_name: str, folder_path: str = LOG_FOLDER) -> str:
     
     This will work if the input is a full path or just the name of the chaos test
     This will also work for files that are not yaml.
+    Runs of a cluster pool get the cluster as suffix (single_100_2024-12-19_13-47-23@kind-2.log, see cluster_pool.py)
     """
     chaos_test_name = chaos_test_name.split('/')[-1]
     chaos_test_name = chaos_test_name.split('.')[0]
+    ensure_log_folder(folder_path)
 
-    return os.path.join(folder_path, f"{chaos_test_name}_{get_file_safe_datetime()}.log") 
\ No newline at end of file
+    return os.path.join(folder_path, f"{chaos_test_name}_{get_file_safe_datetime()}{get_log_suffix()}.log")
+
+def get_sidecar_path(logfile_path: str, suffix: str) -> str:
+    """
+    Get the path of a file that belongs to a run and is stored next to its log file
+    e.g. experiments/runs/single_100_2024-12-19_13-47-23.log -> experiments/runs/single_100_2024-12-19_13-47-23.timeline.json
+    """
+    base, extension = os.path.splitext(logfile_path)
+    if extension != ".log":
+        base = logfile_path
+    return f"{base}{suffix}"
+
+
+def load_run_metadata(logfile_path: str) -> dict:
+    """
+    Load the metadata of a run (empty if nothing was recorded yet)
+    """
+    meta_path = get_sidecar_path(logfile_path, ".meta.json")
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+def update_run_metadata(logfile_path: str, entries: dict) -> str:
+    """
+    Add entries to the metadata of a run, existing keys are replaced
+    Returns the path of the metadata file
+    """
+    metadata = load_run_metadata(logfile_path)
+    metadata.update(entries)
+    meta_path = get_sidecar_path(logfile_path, ".meta.json")
+    with open(meta_path, "w") as f:
+        json.dump(metadata, f, indent=1)
+    return meta_path
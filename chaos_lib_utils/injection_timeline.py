@@ -0,0 +1,353 @@
+"""
+This module records when Chaos Mesh actually injected and recovered a fault, so the recovery time of a run can be
+measured instead of being guessed from the peaks of the lag.
+
+During a run an InjectionRecorder polls (every INJECTION_POLL_SECONDS):
+- the status of all chaos objects: Chaos Mesh keeps a record per target (pod) with Apply / Recover events and
+  the server side timestamp of each of them (status.experiment.containerRecords)
+- the kubernetes events of the chaos objects (Applied / Recovered, used if a record has no events)
+  and of the pods in the chaos namespaces (Killing, Started, Unhealthy, ...)
+Polling is needed, schedules and workflows delete old chaos objects and kubernetes drops events after an hour.
+
+Chaos Mesh timestamps are taken by the cluster clock, the samples in the log by the clock of Prometheus. Both are
+compared with the local clock (Date header of the API server, time() of Prometheus) and the injections are stored
+in Prometheus time, together with the offsets and their uncertainty (the API server only sends whole seconds).
+
+The injections are stored as "injections" in the manifest of the run (<log name>.meta.json).
+measure_recovery then takes, for every injection, the median lag before it as baseline and measures when the lag
+is back at the baseline after the fault was removed.
+
+The module contains the following classes and functions:
+- InjectionRecorder: Polls the chaos objects and events of a run, blocking (poll) or as asyncio task (record)
+- get_clock_offsets: Offsets of the kubernetes and the Prometheus clock against the local clock
+- build_injections: Merges the Apply / Recover events of all targets into fault intervals
+- measure_recovery: Recovery of the lag after every fault interval
+- measure_run_events: The measured chaos events of a run (None if no injections were recorded)
+"""
+import asyncio
+import json
+import re
+import subprocess
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import numpy as np
+
+from chaos_lib_utils.constants import (NAMESPACE_ENV, PROMETHEUS_URL, INJECTION_POLL_SECONDS, RECOVERY_BASELINE_SECONDS,
+                                       RECOVERY_MEDIAN_FRACTION)
+from chaos_lib_utils.instrumentation import timed_run
+
+# Faults without a recover operation, the fault is over once it was applied
+INSTANT_ACTIONS = {"pod-kill", "container-kill"}
+POD_EVENT_REASONS = {"Killing", "Scheduled", "Pulled", "Created", "Started", "Unhealthy", "BackOff", "Evicted"}
+CHAOS_EVENT_OPERATIONS = {"Applied": "Apply", "Recovered": "Recover"}
+
+
+def parse_k8s_time(value: str) -> float:
+    """
+    RFC 3339 timestamp of kubernetes (2024-12-19T13:47:23Z, also with fractions) as unix timestamp
+    """
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def get_chaos_kinds() -> list[str]:
+    """
+    The chaos kinds (NetworkChaos, PodChaos, ...) of the bundled Chaos Mesh schemas
+    """
+    from chaos_lib_utils.manifest_validation import load_schema
+
+    return sorted(kind for kind in load_schema()["kinds"] if kind.endswith("Chaos"))
+
+
+def _kubectl_json(cmd: str) -> dict:
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"Error running {cmd}: {result.stderr.decode('utf-8')}")
+    return json.loads(result.stdout)
+
+
+def get_chaos_objects() -> list[dict]:
+    """
+    All chaos objects of the cluster (every namespace)
+    """
+    return _kubectl_json(f"kubectl get {','.join(kind.lower() for kind in get_chaos_kinds())} -A -o json")["items"]
+
+
+def get_events(namespace: str) -> list[dict]:
+    """
+    The kubernetes events of a namespace
+    """
+    return _kubectl_json(f"kubectl get events -n {namespace} -o json")["items"]
+
+
+def get_kubernetes_offset() -> tuple[float, float]:
+    """
+    Offset of the clock of the API server against the local clock, from the Date header of a request
+
+    Returns:
+    tuple: offset (server - local) in seconds and its uncertainty (half a second of the header plus half the round trip)
+    """
+    start = time.time()
+    result = timed_run("kubectl get --raw /healthz -v=8", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    end = time.time()
+    match = re.search(r"Date: (\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} GMT)", result.stderr.decode("utf-8"))
+    if result.returncode != 0 or match is None:
+        raise Exception(f"Could not read the time of the API server: {result.stderr.decode('utf-8')[-500:]}")
+    # the header is truncated to the second, in the middle of the second is the best guess
+    server_time = parsedate_to_datetime(match.group(1)).timestamp() + 0.5
+    return server_time - (start + end) / 2, 0.5 + (end - start) / 2
+
+
+def get_prometheus_offset(url: str = PROMETHEUS_URL) -> tuple[float, float]:
+    """
+    Offset of the clock of Prometheus against the local clock, from the evaluation time of the query time()
+
+    Returns:
+    tuple: offset (prometheus - local) in seconds and its uncertainty (half the round trip)
+    """
+    from chaos_lib_utils.fetch_client import get_prometheus_client
+
+    start = time.time()
+    result = get_prometheus_client(url).query("time()")
+    end = time.time()
+    return float(result[0]) - (start + end) / 2, (end - start) / 2
+
+
+def get_clock_offsets(url: str = PROMETHEUS_URL) -> dict:
+    """
+    Offsets of the kubernetes and the Prometheus clock against the local clock (seconds, clock - local).
+    A timestamp t of Chaos Mesh is t - kubernetes_offset + prometheus_offset in Prometheus time.
+    """
+    kubernetes_offset, kubernetes_uncertainty = get_kubernetes_offset()
+    prometheus_offset, prometheus_uncertainty = get_prometheus_offset(url)
+    return {"kubernetes_offset": kubernetes_offset, "prometheus_offset": prometheus_offset,
+            "uncertainty": kubernetes_uncertainty + prometheus_uncertainty, "measured_at": time.time()}
+
+
+def extract_records(chaos_object: dict) -> list[dict]:
+    """
+    The Apply / Recover events of every target (container record) of a chaos object
+    """
+    metadata = chaos_object["metadata"]
+    base = {"kind": chaos_object["kind"], "namespace": metadata.get("namespace"), "name": metadata["name"],
+            "action": (chaos_object.get("spec") or {}).get("action")}
+    records = []
+    for record in ((chaos_object.get("status") or {}).get("experiment") or {}).get("containerRecords") or []:
+        for event in record.get("events") or []:
+            records.append({**base, "target": record.get("id"), "operation": event.get("operation"),
+                            "type": event.get("type"), "time": parse_k8s_time(event["timestamp"]), "source": "record"})
+    return records
+
+
+def _event_time(event: dict) -> float:
+    value = event.get("eventTime") or event.get("lastTimestamp") or event.get("firstTimestamp") or event["metadata"]["creationTimestamp"]
+    return parse_k8s_time(value)
+
+
+def extract_events(events: list[dict], chaos_kinds: list[str]) -> tuple[list[dict], list[dict]]:
+    """
+    Splits kubernetes events into Apply / Recover events of chaos objects and the events of pods
+
+    Returns:
+    tuple: chaos records (like extract_records, without target) and pod events (name, reason, time, message)
+    """
+    chaos_records, pod_events = [], []
+    for event in events:
+        involved = event.get("involvedObject") or {}
+        if involved.get("kind") in chaos_kinds and event.get("reason") in CHAOS_EVENT_OPERATIONS:
+            chaos_records.append({"kind": involved["kind"], "namespace": involved.get("namespace"), "name": involved.get("name"),
+                                  "action": None, "target": None, "operation": CHAOS_EVENT_OPERATIONS[event["reason"]],
+                                  "type": "Succeeded", "time": _event_time(event), "source": "event"})
+        elif involved.get("kind") == "Pod" and event.get("reason") in POD_EVENT_REASONS:
+            pod_events.append({"namespace": involved.get("namespace"), "name": involved.get("name"), "reason": event["reason"],
+                               "time": _event_time(event), "message": event.get("message")})
+    return chaos_records, pod_events
+
+
+def build_injections(records: list[dict]) -> list[dict]:
+    """
+    Pairs the Apply and Recover events of every target and merges the overlapping intervals of all targets.
+    Kubernetes events are only used for chaos objects without any record events.
+
+    Returns:
+    list[dict]: injected_at, recovered_at (None if the fault was not removed during the run), targets and objects
+    """
+    with_records = {(r["kind"], r["namespace"], r["name"]) for r in records if r["source"] == "record"}
+    actions = {(r["kind"], r["namespace"], r["name"]): r["action"] for r in records if r["action"]}
+    targets = {}
+    for record in sorted(records, key=lambda r: r["time"]):
+        key = (record["kind"], record["namespace"], record["name"])
+        if record["type"] != "Succeeded" or (record["source"] == "event" and key in with_records):
+            continue
+        targets.setdefault(key + (record["target"],), []).append(record)
+
+    intervals = []
+    for (kind, namespace, name, target), target_records in targets.items():
+        start = None
+        for record in target_records:
+            if record["operation"] == "Apply" and start is None:
+                start = record["time"]
+                if actions.get((kind, namespace, name)) in INSTANT_ACTIONS:
+                    intervals.append((start, start, f"{kind}/{namespace}/{name}"))
+                    start = None
+            elif record["operation"] == "Recover" and start is not None:
+                intervals.append((start, record["time"], f"{kind}/{namespace}/{name}"))
+                start = None
+        if start is not None:
+            intervals.append((start, None, f"{kind}/{namespace}/{name}"))
+
+    injections = []
+    for start, end, chaos_object in sorted(intervals, key=lambda i: i[0]):
+        current = injections[-1] if injections else None
+        if current is not None and (current["recovered_at"] is None or start <= current["recovered_at"]):
+            if current["recovered_at"] is not None:
+                current["recovered_at"] = None if end is None else max(end, current["recovered_at"])
+            current["targets"] += 1
+            if chaos_object not in current["objects"]:
+                current["objects"].append(chaos_object)
+            continue
+        injections.append({"injected_at": start, "recovered_at": end, "targets": 1, "objects": [chaos_object]})
+    return injections
+
+
+def _to_prometheus_time(timestamp: float, clock: dict) -> float:
+    if timestamp is None or clock is None:
+        return timestamp
+    return timestamp - clock["kubernetes_offset"] + clock["prometheus_offset"]
+
+
+class InjectionRecorder:
+    """
+    Collects the Apply / Recover events of the chaos objects and the pod events of a run.
+
+    Parameters:
+    namespaces: list[str]: Namespaces whose events are recorded (the namespaces of chaos objects are added)
+    interval: float: Seconds between two polls
+    url: str: URL of Prometheus, for the clock offset
+    """
+    def __init__(self, namespaces: list[str] = None, interval: float = INJECTION_POLL_SECONDS, url: str = PROMETHEUS_URL):
+        self.namespaces = list(namespaces or [NAMESPACE_ENV])
+        self.interval = interval
+        self.url = url
+        self.chaos_kinds = get_chaos_kinds()
+        self.records = {}
+        self.pod_events = {}
+        self.clocks = []
+        self.errors = []
+
+    def calibrate(self) -> None:
+        """
+        Measures the clock offsets, failures are recorded and the offsets of other calibrations are used
+        """
+        try:
+            self.clocks.append(get_clock_offsets(self.url))
+        except Exception as e:
+            self.errors.append(f"clock: {e}")
+
+    def poll(self) -> None:
+        """
+        Reads the chaos objects and events once and adds what is new
+        """
+        for chaos_object in get_chaos_objects():
+            namespace = chaos_object["metadata"].get("namespace")
+            if namespace and namespace not in self.namespaces:
+                self.namespaces.append(namespace)
+            for record in extract_records(chaos_object):
+                self.records[tuple(record[k] for k in ("kind", "namespace", "name", "target", "operation", "type", "time"))] = record
+        for namespace in self.namespaces:
+            chaos_records, pod_events = extract_events(get_events(namespace), self.chaos_kinds)
+            for record in chaos_records:
+                self.records[tuple(record[k] for k in ("kind", "namespace", "name", "target", "operation", "type", "time"))] = record
+            for event in pod_events:
+                self.pod_events[(event["namespace"], event["name"], event["reason"], event["time"])] = event
+
+    async def record(self) -> None:
+        """
+        Polls every interval seconds until it is cancelled (run it as asyncio task)
+        """
+        await asyncio.to_thread(self.calibrate)
+        while True:
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception as e:
+                # a missed poll is caught up by the next one, as long as the objects still exist
+                print(f"Recording the injections failed: {e}")
+                self.errors.append(str(e))
+            await asyncio.sleep(self.interval)
+
+    def result(self) -> dict:
+        """
+        The injections in Prometheus time, with the raw records and pod events (cluster time) and the clock offsets
+        """
+        clock = None
+        if self.clocks:
+            # the offsets drift slowly, the mean of the calibrations at start and end of the run is used
+            clock = {key: float(np.mean([c[key] for c in self.clocks])) for key in ("kubernetes_offset", "prometheus_offset", "uncertainty")}
+        injections = build_injections(list(self.records.values()))
+        for injection in injections:
+            injection["injected_at"] = _to_prometheus_time(injection["injected_at"], clock)
+            injection["recovered_at"] = _to_prometheus_time(injection["recovered_at"], clock)
+        return {
+            "clock": clock,
+            "injections": injections,
+            "records": sorted(self.records.values(), key=lambda r: r["time"]),
+            "pod_events": sorted(self.pod_events.values(), key=lambda e: e["time"]),
+            "errors": self.errors[-20:],
+        }
+
+
+def measure_recovery(times: np.ndarray, values: np.ndarray, injections: list[dict], baseline_seconds: float = RECOVERY_BASELINE_SECONDS,
+                     median_fraction: float = RECOVERY_MEDIAN_FRACTION) -> list[dict]:
+    """
+    Measures the recovery of the lag after every injection (all times in Prometheus time)
+
+    Parameters:
+    times / values: np.ndarray: The samples of the run, sorted by time
+    injections: list[dict]: See build_injections
+    baseline_seconds: float: The median lag of this many seconds before the injection is the baseline
+    median_fraction: float: The lag is recovered once it is at most median_fraction * baseline
+
+    Returns:
+    list[dict]: start (injection), end (lag recovered), recovery_time (end - start, like the detected events),
+    fault_removed_at, recovery_latency (end - fault_removed_at) and baseline; end is None if the lag did not recover
+    """
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    events = []
+    for injection in injections:
+        start = injection["injected_at"]
+        removed = injection["recovered_at"]
+        event = {"start": start, "end": None, "recovery_time": None, "fault_removed_at": removed, "recovery_latency": None,
+                 "baseline": None, "source": "injection_timeline"}
+        events.append(event)
+        before = values[np.searchsorted(times, start - baseline_seconds):np.searchsorted(times, start)]
+        if len(before) == 0:
+            before = values
+        if removed is None or len(before) == 0:
+            continue
+        event["baseline"] = float(np.median(before))
+        after = np.searchsorted(times, removed)
+        recovered = np.flatnonzero(values[after:] <= event["baseline"] * median_fraction)
+        if len(recovered) == 0:
+            continue
+        end = float(times[after + recovered[0]])
+        event.update(end=end, recovery_time=end - start, recovery_latency=end - removed)
+    return events
+
+
+def measure_run_events(logfile_path: str) -> list[dict]:
+    """
+    Measures the chaos events of a run from the injections in its manifest
+
+    Returns:
+    list[dict]: See measure_recovery, None if no injections were recorded for the run
+    """
+    from chaos_lib_utils.file_utils import load_run_metadata
+    from chaos_lib_utils.run_archive import RunView
+
+    timeline = load_run_metadata(logfile_path).get("injections")
+    if not timeline or not timeline.get("injections"):
+        return None
+    run = RunView(logfile_path)
+    return measure_recovery(run.times, run.values, timeline["injections"])
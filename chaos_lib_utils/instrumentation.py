@@ -0,0 +1,287 @@
+"""
+This module records where the time of a run goes.
+A run timeline holds timing spans (phases like cleanup_containers, every kubectl and HTTP call, sleeping)
+and counters (retries, bytes fetched). It is written next to the log file as <log name>.timeline.json
+
+The module contains the following functions:
+- start_run_timeline: Starts recording a new run
+- finish_run_timeline: Stops recording and writes the timeline next to the log file
+- span: Context manager that times a block
+- instrumented: Decorator that times every call of a function
+- count: Increments a counter of the current run
+- timed_run: subprocess.run with a span around it
+- timed_system: os.system with a span around it
+(both run kubectl and helm against the cluster of the current worker, see cluster_pool.py)
+- sleep: time.sleep with a span around it
+- summarize_timelines: Aggregates the overhead of all timelines in a folder
+
+Nothing is recorded if no run timeline is active, so the functions can be used outside of runs.
+The timeline and the span stack are context variables: asyncio tasks (and asyncio.to_thread) of the orchestrator
+each record into the timeline of their own run. Plain threads fall back to the timeline started last.
+
+Print a summary of the archive with:
+python -m chaos_lib_utils.instrumentation summary [--folder experiments/runs]
+"""
+import argparse
+import contextvars
+import functools
+import glob
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from chaos_lib_utils.constants import LOG_FOLDER
+from chaos_lib_utils.cluster_pool import kube_command
+from chaos_lib_utils.file_utils import get_sidecar_path
+
+TIMELINE_SUFFIX = ".timeline.json"
+# Everything that happens before the chaos tests are applied and does not produce data
+SETUP_PHASES = ["adjust_prometheus_fetch_interval", "delete_running_chaos_tests", "reset_cluster", "cleanup_containers", "recreate_deployments",
+                "wait_for_pods_ready", "wait_for_steady_state", "apply_chaos_tests_at_good_time"]
+
+_lock = threading.Lock()
+# Names of the enclosing spans
+_span_stack = contextvars.ContextVar("span_stack", default=())
+# The timeline of the run of the current task, and the one started last for threads without a context
+_timeline = contextvars.ContextVar("timeline", default=None)
+_active_timeline = None
+
+
+class RunTimeline:
+    """
+    Spans and counters of a single run. All times are unix timestamps.
+    """
+    def __init__(self, name: str = None):
+        self.name = name
+        self.start_time = time.time()
+        self.end_time = None
+        self.spans = []
+        self.counters = {}
+        self.status = "running"
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": (self.end_time or time.time()) - self.start_time,
+            "status": self.status,
+            "counters": self.counters,
+            "spans": self.spans,
+        }
+
+
+def start_run_timeline(name: str = None) -> RunTimeline:
+    """
+    Starts recording a new run, replacing any previous one
+
+    Parameters:
+    name: str: Name of the run, e.g. the yaml file of the chaos test
+    """
+    global _active_timeline
+    timeline = RunTimeline(name)
+    with _lock:
+        _active_timeline = timeline
+    _timeline.set(timeline)
+    return timeline
+
+
+def get_active_timeline() -> RunTimeline:
+    return _timeline.get() or _active_timeline
+
+
+def finish_run_timeline(logfile_path: str, status: str = "completed") -> str:
+    """
+    Stops recording the current run and writes the timeline next to the log file
+
+    Parameters:
+    logfile_path: str: Path of the log file of the run
+    status: str: Outcome of the run (completed, failed)
+
+    Returns:
+    str: Path of the timeline file, None if no run was recorded
+    """
+    global _active_timeline
+    timeline = get_active_timeline()
+    with _lock:
+        if _active_timeline is timeline:
+            _active_timeline = None
+    _timeline.set(None)
+    if timeline is None:
+        return None
+
+    timeline.end_time = time.time()
+    timeline.status = status
+    timeline_path = get_sidecar_path(logfile_path, TIMELINE_SUFFIX)
+    with open(timeline_path, "w") as f:
+        json.dump(timeline.to_dict(), f, indent=1)
+    return timeline_path
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times the enclosed block and adds it to the current run timeline.
+    Spans can be nested, the parent of a span is the enclosing span of the same thread (or asyncio task).
+
+    Parameters:
+    name: str: Name of the span (phase or call)
+    attributes: Additional information stored with the span, e.g. the command
+    """
+    stack = _span_stack.get()
+    parent = stack[-1] if stack else None
+    token = _span_stack.set(stack + (name,))
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        _span_stack.reset(token)
+        timeline = get_active_timeline()
+        if timeline is not None:
+            entry = {"name": name, "start": start, "end": end, "duration": end - start, "parent": parent}
+            if attributes:
+                entry["attributes"] = attributes
+            with _lock:
+                timeline.spans.append(entry)
+
+
+def instrumented(function):
+    """
+    Decorator that records a span with the function name around every call
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def count(name: str, amount: int = 1) -> None:
+    """
+    Increments a counter of the current run (e.g. fetch_retries, bytes_fetched)
+    """
+    timeline = get_active_timeline()
+    if timeline is None:
+        return
+    with _lock:
+        timeline.counters[name] = timeline.counters.get(name, 0) + amount
+
+
+def _command_name(cmd: str) -> str:
+    # "kubectl get deployments -n kafka -o yaml" -> "kubectl get"
+    return " ".join(cmd.split()[:2])
+
+
+def timed_run(cmd: str, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run with a span named after the command (e.g. "kubectl get")
+    """
+    # named before the context is added, so the spans of all clusters have the same names
+    name, cmd = _command_name(cmd), kube_command(cmd)
+    with span(name, command=cmd):
+        return subprocess.run(cmd, **kwargs)
+
+
+def timed_system(cmd: str) -> int:
+    """
+    os.system with a span named after the command (e.g. "kubectl apply")
+    """
+    name, cmd = _command_name(cmd), kube_command(cmd)
+    with span(name, command=cmd):
+        return os.system(cmd)
+
+
+def sleep(seconds: float, name: str = "sleep") -> None:
+    """
+    time.sleep with a span around it, so waiting shows up in the timeline
+    """
+    with span(name, seconds=seconds):
+        time.sleep(seconds)
+
+
+def load_timelines(folder: str = LOG_FOLDER) -> list[dict]:
+    """
+    Loads all timelines in a folder
+    """
+    timelines = []
+    for path in sorted(glob.glob(os.path.join(folder, f"*{TIMELINE_SUFFIX}"))):
+        with open(path, "r") as f:
+            timelines.append(json.load(f))
+    return timelines
+
+
+def summarize_timelines(timelines: list[dict]) -> dict:
+    """
+    Aggregates the time spent per span name and the counters across runs.
+
+    Parameters:
+    timelines: list[dict]: Timelines as returned by load_timelines
+
+    Returns:
+    dict with
+    - runs: number of runs
+    - run_seconds: total wall time of all runs
+    - spans: {name: {"calls", "seconds", "mean_seconds", "share"}} where share is the fraction of the total run time
+      (only meaningful for top level spans, nested spans are contained in their parents)
+    - top_level: names of the spans without a parent
+    - setup_share: fraction of the run time spent in SETUP_PHASES
+    - counters: summed counters
+    """
+    run_seconds = sum(t["duration"] for t in timelines)
+    spans = {}
+    top_level = set()
+    counters = {}
+    setup_seconds = 0.0
+    for timeline in timelines:
+        for entry in timeline["spans"]:
+            stats = spans.setdefault(entry["name"], {"calls": 0, "seconds": 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += entry["duration"]
+            if entry["parent"] is None:
+                top_level.add(entry["name"])
+                # nested phases (e.g. cleanup_containers in reset_cluster) are already part of their parent
+                if entry["name"] in SETUP_PHASES:
+                    setup_seconds += entry["duration"]
+        for name, value in timeline["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+
+    for stats in spans.values():
+        stats["mean_seconds"] = stats["seconds"] / stats["calls"]
+        stats["share"] = stats["seconds"] / run_seconds if run_seconds > 0 else 0.0
+
+    return {
+        "runs": len(timelines),
+        "run_seconds": run_seconds,
+        "spans": spans,
+        "top_level": sorted(top_level),
+        "setup_share": setup_seconds / run_seconds if run_seconds > 0 else 0.0,
+        "counters": counters,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f"Runs: {summary['runs']}, total run time: {summary['run_seconds'] / 3600:.2f} h, "
+          f"setup overhead: {summary['setup_share'] * 100:.1f}%")
+    header = f"{'span':<40} {'calls':>7} {'total s':>10} {'mean s':>9} {'share':>7}"
+    print(header)
+    print("-" * len(header))
+    ordered = sorted(summary["spans"].items(), key=lambda item: (item[0] not in summary["top_level"], -item[1]["seconds"]))
+    for name, stats in ordered:
+        label = name if name in summary["top_level"] else f"  {name}"
+        print(f"{label:<40} {stats['calls']:>7} {stats['seconds']:>10.1f} {stats['mean_seconds']:>9.2f} {stats['share'] * 100:>6.1f}%")
+    for name, value in sorted(summary["counters"].items()):
+        print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run timeline tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="Aggregate the overhead of all runs in a folder")
+    summary_parser.add_argument("--folder", default=LOG_FOLDER, help="Folder holding the logs and timelines")
+    args = parser.parse_args()
+
+    print_summary(summarize_timelines(load_timelines(args.folder)))
@@ -0,0 +1,247 @@
+"""
+This module sweeps the input rate of the load generator instead of the chaos test, to find the event rate at which
+the miner stops recovering from a fault.
+
+For every load level:
+1. the rate in the def-load configmap (LOAD_CONFIGMAP, key LOAD_CONFIGMAP_KEY) is replaced, LOAD_RATE_PATTERN is a
+   regex whose group "rate" is the number to replace (the format of the load config is not parsed)
+2. the load generator (LOAD_DEPLOYMENT) is restarted with a rollout, so it reads the new config
+3. the experiment runs as usual, after the cleanup the run also waits until the input rate (INPUT_RATE_QUERY)
+   is steady around the target, the reached rate is stored as "load" in the manifest of the run
+The original config is restored at the end of the sweep.
+
+A level is sustainable if the rate was reached and the lag recovered from every chaos event within
+LOAD_MAX_RECOVERY_SECONDS. The maximum sustainable throughput is the highest reached rate before the first level
+that is not sustainable. The recovery time per level is regressed on the rate (seconds of recovery per event/s).
+
+The module contains the following functions:
+- set_rate: Replaces the rate in the text of the load config
+- apply_load_rate: Writes the rate to the configmap and restarts the load generator
+- wait_for_input_rate: Waits until the input rate is steady around a target
+- run_load_sweep: Runs an experiment at every load level
+- summarize_load_sweep: Table per level, maximum sustainable throughput and the regression on the rate
+- format_load_summary: Text table of summarize_load_sweep
+"""
+import json
+import re
+import shlex
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from chaos_lib_utils.constants import (NAMESPACE_ENV, PROMETHEUS_URL, TIME_GRANULARITY, LOAD_CONFIGMAP, LOAD_CONFIGMAP_KEY,
+                                       LOAD_RATE_PATTERN, LOAD_DEPLOYMENT, INPUT_RATE_QUERY, LOAD_RATE_TOLERANCE,
+                                       LOAD_STEADY_WINDOW_SECONDS, LOAD_STEADY_TIMEOUT_SECONDS, LOAD_MAX_RECOVERY_SECONDS,
+                                       STEADY_STATE_POLL_SECONDS, MAX_POD_RECREATION_TIME_SECONDS)
+from chaos_lib_utils.file_utils import load_run_metadata
+from chaos_lib_utils.instrumentation import instrumented, timed_run
+from chaos_lib_utils.steady_state import poll_window
+
+
+def get_load_config(namespace: str = NAMESPACE_ENV, configmap: str = LOAD_CONFIGMAP, key: str = LOAD_CONFIGMAP_KEY) -> str:
+    """
+    Returns the load config (the entry key of the configmap)
+    """
+    cmd = f"kubectl get configmap {configmap} -n {namespace} -o json"
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"Error getting the configmap {configmap}: {result.stderr.decode('utf-8')}")
+    data = json.loads(result.stdout).get("data") or {}
+    if key not in data:
+        raise Exception(f"The configmap {configmap} has no entry {key} (entries: {sorted(data)})")
+    return data[key]
+
+
+def set_rate(text: str, rate: float, pattern: str = LOAD_RATE_PATTERN) -> str:
+    """
+    Replaces every match of the group "rate" of pattern with the rate (integers without decimals)
+
+    Raises:
+    Exception: If the pattern does not match the config
+    """
+    regex = re.compile(pattern)
+    if "rate" not in regex.groupindex:
+        raise Exception(f"LOAD_RATE_PATTERN needs a group called rate, e.g. rate\\W*(?P<rate>\\d+): {pattern}")
+    value = str(int(rate)) if float(rate).is_integer() else str(rate)
+    # only the group is replaced, the rest of the match (key, separator, ...) is kept
+    new_text, replaced = regex.subn(lambda m: text[m.start():m.start("rate")] + value + text[m.end("rate"):m.end()], text)
+    if replaced == 0:
+        raise Exception(f"LOAD_RATE_PATTERN {pattern} does not match the load config:\n{text}")
+    return new_text
+
+
+@instrumented
+def restart_load_generator(namespace: str = NAMESPACE_ENV, deployment: str = LOAD_DEPLOYMENT,
+                           timeout: float = MAX_POD_RECREATION_TIME_SECONDS) -> None:
+    """
+    Restarts the load generator with a rollout and waits until the rollout is done
+    """
+    for cmd in [f"kubectl rollout restart deployment/{deployment} -n {namespace}",
+                f"kubectl rollout status deployment/{deployment} -n {namespace} --timeout={int(timeout)}s"]:
+        try:
+            timed_run(cmd, shell=True, check=True)
+        except subprocess.CalledProcessError as e:
+            raise Exception(f"Error restarting the load generator {deployment}: {e}")
+
+
+@instrumented
+def apply_load_rate(rate: float, namespace: str = NAMESPACE_ENV, configmap: str = LOAD_CONFIGMAP, key: str = LOAD_CONFIGMAP_KEY,
+                    pattern: str = LOAD_RATE_PATTERN, deployment: str = LOAD_DEPLOYMENT, config: str = None) -> str:
+    """
+    Writes the rate into the load config and restarts the load generator
+
+    Parameters:
+    rate: float: Events per second
+    config: str: The load config to change (read from the configmap if None)
+
+    Returns:
+    str: The load config before the change
+    """
+    if config is None:
+        config = get_load_config(namespace, configmap, key)
+    patch = json.dumps({"data": {key: set_rate(config, rate, pattern)}})
+    cmd = f"kubectl patch configmap {configmap} -n {namespace} --type merge -p {shlex.quote(patch)}"
+    try:
+        timed_run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"Error patching the configmap {configmap}: {e}")
+    print(f"Load rate set to {rate} events/s")
+    restart_load_generator(namespace, deployment)
+    return config
+
+
+def restore_load_config(config: str, namespace: str = NAMESPACE_ENV, configmap: str = LOAD_CONFIGMAP, key: str = LOAD_CONFIGMAP_KEY,
+                        deployment: str = LOAD_DEPLOYMENT) -> None:
+    """
+    Writes the original load config back and restarts the load generator
+    """
+    patch = json.dumps({"data": {key: config}})
+    timed_run(f"kubectl patch configmap {configmap} -n {namespace} --type merge -p {shlex.quote(patch)}", shell=True, check=True,
+              stdout=subprocess.DEVNULL)
+    restart_load_generator(namespace, deployment)
+
+
+@instrumented
+def wait_for_input_rate(target: float, data_source_url: str = PROMETHEUS_URL, query: str = INPUT_RATE_QUERY,
+                        tolerance: float = LOAD_RATE_TOLERANCE, window_seconds: float = LOAD_STEADY_WINDOW_SECONDS,
+                        timeout: float = LOAD_STEADY_TIMEOUT_SECONDS, poll_interval: float = STEADY_STATE_POLL_SECONDS,
+                        time_granularity: float = TIME_GRANULARITY) -> dict:
+    """
+    Waits until the input rate over the last window_seconds is steady around the target:
+    its mean within tolerance (relative) of the target and its standard deviation below tolerance * target.
+
+    Returns:
+    dict: target, reached (False if the timeout was reached), waited_seconds and the stats of the last window
+    (mean is the reached rate, see steady_state.poll_window)
+    """
+    def at_target(stats: dict) -> bool:
+        return abs(stats["mean"] - target) <= tolerance * target and stats["std"] <= tolerance * target
+
+    result = poll_window(at_target, query, data_source_url, window_seconds, timeout, poll_interval, time_granularity,
+                         progress=lambda stats: f"Waiting for the input rate: {stats['mean']} events/s (target {target})",
+                         poll_phase="input_rate_poll")
+    reached = result.pop("passed")
+
+    if reached:
+        print(f"Input rate steady at {result['mean']:.1f} events/s after {result['waited_seconds']:.0f}s")
+    else:
+        print(f"Input rate did not reach {target} events/s after {result['waited_seconds']:.0f}s (last {result['mean']}), continuing anyway")
+    return {"target": target, "reached": reached, "tolerance": tolerance, **result}
+
+
+def run_load_sweep(yaml_file: str, rates: list[float], runs_per_level: int = 1, companion_yaml_file: str = None,
+                   check_prometheus: bool = True, timeout: float = None) -> list[dict]:
+    """
+    Runs the experiment runs_per_level times at every load level (in the given order), the original load config
+    is restored afterwards, also if the sweep fails
+
+    Returns:
+    list[dict]: rate, run_number, logfile_path and status of every run
+    """
+    from chaos_lib_utils.runner import run_experiment
+
+    original = get_load_config()
+    results = []
+    try:
+        for rate in rates:
+            apply_load_rate(rate, config=original)
+            for run_number in range(1, runs_per_level + 1):
+                result = run_experiment(yaml_file, run_number, companion_yaml_file, check_prometheus, timeout=timeout, load_rate=rate)
+                results.append({"rate": rate, "run_number": run_number, **result})
+    finally:
+        print("Restoring the original load config")
+        restore_load_config(original)
+    return results
+
+
+def summarize_load_sweep(log_files: list[str], max_recovery_seconds: float = LOAD_MAX_RECOVERY_SECONDS) -> dict:
+    """
+    Summarizes the runs of a load sweep from their manifests (load and events)
+
+    Parameters:
+    log_files: list[str]: The runs of the sweep
+    max_recovery_seconds: float: A level is only sustainable if every chaos event recovered within this time
+
+    Returns:
+    dict: levels (DataFrame per target rate: reached rate, runs, events, recovered events, mean / max recovery time,
+    sustainable), max_sustainable_rate (None if the first level is not sustainable) and
+    regression (recovery time on the reached rate, see aggregation.linear_regression, empty with less than 3 events)
+    """
+    from chaos_lib_utils.aggregation import linear_regression
+
+    rows = []
+    events = []
+    for log_file in log_files:
+        manifest = load_run_metadata(log_file)
+        load = manifest.get("load")
+        if load is None:
+            continue
+        run_events = manifest.get("events") or []
+        recovery_times = [event["recovery_time"] for event in run_events]
+        rows.append({"Target": load["target"], "Rate": load["mean"], "Reached": bool(load["reached"]), "Events": len(run_events),
+                     "Recovered": sum(t is not None and t <= max_recovery_seconds for t in recovery_times),
+                     "RecoveryTimes": [t for t in recovery_times if t is not None]})
+        events.extend((load["mean"], t) for t in recovery_times if t is not None and load["mean"] is not None)
+
+    runs = pd.DataFrame(rows, columns=["Target", "Rate", "Reached", "Events", "Recovered", "RecoveryTimes"])
+    levels = runs.groupby("Target").agg(Rate=("Rate", "mean"), Runs=("Rate", "size"), Reached=("Reached", "all"),
+                                        Events=("Events", "sum"), Recovered=("Recovered", "sum"),
+                                        RecoveryTimes=("RecoveryTimes", "sum"))
+    levels["MeanRecoveryTime"] = [np.mean(t) if len(t) else np.nan for t in levels["RecoveryTimes"]]
+    levels["MaxRecoveryTime"] = [np.max(t) if len(t) else np.nan for t in levels["RecoveryTimes"]]
+    levels["Sustainable"] = levels["Reached"] & (levels["Events"] > 0) & (levels["Recovered"] == levels["Events"])
+    levels = levels.drop(columns="RecoveryTimes")
+
+    # the highest level before the first one that is not sustainable
+    max_sustainable_rate = None
+    for target, level in levels.iterrows():
+        if not level["Sustainable"]:
+            break
+        max_sustainable_rate = float(level["Rate"])
+
+    try:
+        regression = linear_regression([e[0] for e in events], [e[1] for e in events])
+    except ValueError:
+        regression = {}
+    return {"levels": levels, "max_sustainable_rate": max_sustainable_rate, "regression": regression}
+
+
+def format_load_summary(summary: dict) -> str:
+    """
+    Compact text table of summarize_load_sweep, with the maximum sustainable throughput and the regression
+    """
+    lines = [f"{'target':>8} {'rate':>8} {'runs':>5} {'events':>9} {'mean rec.':>10} {'max rec.':>10}  sustainable"]
+    for target, level in summary["levels"].iterrows():
+        rate = f"{level['Rate']:.1f}" if level["Rate"] is not None and np.isfinite(level["Rate"]) else "-"
+        recovery = [f"{t:.1f}s" if np.isfinite(t) else "-" for t in (level["MeanRecoveryTime"], level["MaxRecoveryTime"])]
+        note = "" if level["Reached"] else " (rate not reached)"
+        lines.append(f"{target:>8.0f} {rate:>8} {level['Runs']:>5} {f'{level.Recovered}/{level.Events}':>9} "
+                     f"{recovery[0]:>10} {recovery[1]:>10}  {'yes' if level['Sustainable'] else 'no'}{note}")
+    rate = summary["max_sustainable_rate"]
+    lines.append(f"Maximum sustainable throughput: {'-' if rate is None else f'{rate:.1f} events/s'}")
+    regression = summary["regression"]
+    if regression:
+        lines.append(f"Recovery time per event/s: {regression['slope']:.3f}s "
+                     f"[{regression['slope_ci_low']:.3f}, {regression['slope_ci_high']:.3f}], r^2 {regression['r_squared']:.2f}")
+    return "\n".join(lines)
@@ -0,0 +1,300 @@
+"""
+This module validates chaos experiments before they are applied, so a sweep does not fail halfway through the night.
+
+Every manifest is checked against:
+- a subset of the Chaos Mesh CRD schemas, bundled in schemas/chaos_mesh_v1alpha1.json (works offline).
+  Unknown fields are errors: kubernetes silently drops them, so a typo would run the experiment with defaults.
+- workflow references: the entry and the children of every template have to exist
+- the cluster: every label selector has to match at least one pod in its namespaces (kubectl get pods)
+
+The results of the schema checks are cached by the sha256 of the manifest (and the schema version) in
+VALIDATION_CACHE_FILE, so unchanged manifests are not validated again.
+
+The module contains the following functions:
+- validate_schema: Validates a value against a (json) schema subset (type, required, properties, enum, ...)
+- validate_manifest: Schema and reference checks of a single manifest
+- check_selectors: Checks the label selectors of a manifest against the pods in the cluster
+- validate_manifests: Validates many manifests in parallel, using the cache
+- validate_before_sweep: Raises if any manifest of a sweep is invalid
+"""
+import contextvars
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from chaos_lib_utils.constants import NAMESPACE_ENV, VALIDATION_CACHE_FILE
+from chaos_lib_utils.instrumentation import timed_run
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "schemas", "chaos_mesh_v1alpha1.json")
+
+_schema = None
+_cache_lock = threading.Lock()
+
+
+def load_schema() -> dict:
+    global _schema
+    if _schema is None:
+        with open(SCHEMA_FILE, "r", encoding="utf-8") as f:
+            _schema = json.load(f)
+    return _schema
+
+
+def _type_matches(value, expected: str) -> bool:
+    if expected == "object":
+        return isinstance(value, dict)
+    if expected == "array":
+        return isinstance(value, list)
+    if expected == "string":
+        return isinstance(value, str)
+    if expected == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if expected == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if expected == "boolean":
+        return isinstance(value, bool)
+    return True
+
+
+def validate_schema(value, schema: dict, definitions: dict, path: str = "") -> list[str]:
+    """
+    Validates a value against a schema, supporting the keywords the bundled schemas use:
+    $ref (to #/definitions/...), type, required, properties, additionalProperties, items, minItems, enum, pattern, maxLength
+
+    Returns:
+    list[str]: The errors, as "path: message"
+    """
+    if "$ref" in schema:
+        schema = definitions[schema["$ref"].split("/")[-1]]
+    location = path or "<root>"
+
+    if "type" in schema and not _type_matches(value, schema["type"]):
+        return [f"{location}: expected {schema['type']}, got {type(value).__name__} ({value!r})"]
+
+    errors = []
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{location}: {value!r} is not one of {schema['enum']}")
+    if "pattern" in schema and isinstance(value, str) and re.search(schema["pattern"], value) is None:
+        errors.append(f"{location}: {value!r} does not match {schema['pattern']}")
+    if "maxLength" in schema and isinstance(value, str) and len(value) > schema["maxLength"]:
+        errors.append(f"{location}: longer than {schema['maxLength']} characters")
+
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{location}: missing required field {name}")
+        additional = schema.get("additionalProperties", True)
+        for name, item in value.items():
+            item_path = f"{path}.{name}" if path else str(name)
+            if name in properties:
+                errors.extend(validate_schema(item, properties[name], definitions, item_path))
+            elif additional is False:
+                errors.append(f"{item_path}: unknown field (expected one of {sorted(properties)})")
+            elif isinstance(additional, dict):
+                errors.extend(validate_schema(item, additional, definitions, item_path))
+
+    if isinstance(value, list):
+        if "minItems" in schema and len(value) < schema["minItems"]:
+            errors.append(f"{location}: needs at least {schema['minItems']} entries")
+        if "items" in schema:
+            for i, item in enumerate(value):
+                errors.extend(validate_schema(item, schema["items"], definitions, f"{path}[{i}]"))
+    return errors
+
+
+def _check_workflow_references(manifest: dict) -> list[str]:
+    spec = manifest.get("spec") or {}
+    templates = spec.get("templates") or []
+    names = [template.get("name") for template in templates if isinstance(template, dict)]
+    errors = [f"spec.templates: template {name} is defined more than once" for name in set(names) if names.count(name) > 1]
+    if spec.get("entry") is not None and spec["entry"] not in names:
+        errors.append(f"spec.entry: there is no template called {spec['entry']}")
+    for i, template in enumerate(templates):
+        if not isinstance(template, dict):
+            continue
+        for child in template.get("children") or []:
+            if child not in names:
+                errors.append(f"spec.templates[{i}].children: there is no template called {child}")
+        # the chaos of a chaos template is configured in the field named after its type (NetworkChaos -> networkChaos)
+        template_type = template.get("templateType", "")
+        if template_type.endswith("Chaos"):
+            field = template_type[0].lower() + template_type[1:]
+            if field not in template:
+                errors.append(f"spec.templates[{i}]: templateType {template_type} needs the field {field}")
+    return errors
+
+
+def _check_schedule_type(spec: dict, path: str) -> list[str]:
+    if not isinstance(spec, dict):
+        return []
+    schema = load_schema()["definitions"]["scheduleSpec"]
+    embedded = [key for key in spec if key not in ("schedule", "type", "concurrencyPolicy", "historyLimit", "startingDeadlineSeconds")
+                and key in schema["properties"]]
+    if "type" not in spec:
+        # without a type the chaos is taken from the single embedded chaos field
+        if len(embedded) != 1:
+            return [f"{path}: a schedule without type needs exactly one chaos field, found {embedded}"]
+        return []
+    field = spec["type"][0].lower() + spec["type"][1:]
+    if field not in spec:
+        return [f"{path}: schedule of type {spec['type']} needs the field {field}"]
+    return []
+
+
+def validate_manifest(manifest: dict) -> list[str]:
+    """
+    Validates a single manifest against the bundled schemas and checks the workflow references
+
+    Returns:
+    list[str]: The errors, empty if the manifest is valid
+    """
+    if not isinstance(manifest, dict):
+        return ["<root>: the manifest is not a mapping"]
+    schema = load_schema()
+    kind = manifest.get("kind")
+    if kind not in schema["kinds"]:
+        return [f"kind: {kind!r} is not one of {sorted(schema['kinds'])}"]
+
+    errors = validate_schema(manifest, schema["kinds"][kind], schema["definitions"])
+    if kind == "Workflow":
+        errors.extend(_check_workflow_references(manifest))
+        for i, template in enumerate((manifest.get("spec") or {}).get("templates") or []):
+            if isinstance(template, dict) and template.get("templateType") == "Schedule":
+                errors.extend(_check_schedule_type(template.get("schedule"), f"spec.templates[{i}].schedule"))
+    if kind == "Schedule":
+        errors.extend(_check_schedule_type(manifest.get("spec"), "spec"))
+    return errors
+
+
+def _find_selectors(node, path: str = ""):
+    # yields (path, selector) for every selector in the manifest
+    if isinstance(node, dict):
+        for key, value in node.items():
+            item_path = f"{path}.{key}" if path else key
+            if key == "selector" and isinstance(value, dict):
+                yield item_path, value
+            else:
+                yield from _find_selectors(value, item_path)
+    elif isinstance(node, list):
+        for i, value in enumerate(node):
+            yield from _find_selectors(value, f"{path}[{i}]")
+
+
+def get_pod_labels(namespace: str) -> list[dict]:
+    """
+    Returns the labels of all pods in a namespace
+    """
+    cmd = f"kubectl get pods -n {namespace} -o json"
+    result = timed_run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"Error getting the pods in namespace {namespace}: {result.stderr.decode('utf-8')}")
+    return [item["metadata"].get("labels") or {} for item in json.loads(result.stdout)["items"]]
+
+
+def check_selectors(manifest: dict, pod_labels: dict[str, list[dict]], default_namespace: str = NAMESPACE_ENV) -> list[str]:
+    """
+    Checks that every label selector of the manifest matches at least one pod in its namespaces
+
+    Parameters:
+    manifest: dict: The manifest
+    pod_labels: dict: namespace -> labels of its pods, missing namespaces are fetched with kubectl and added
+    default_namespace: str: Namespace of selectors without namespaces
+
+    Returns:
+    list[str]: The errors
+    """
+    errors = []
+    for path, selector in _find_selectors(manifest.get("spec") or {}, "spec"):
+        namespaces = selector.get("namespaces") or [default_namespace]
+        labels = selector.get("labelSelectors") or {}
+        for namespace in namespaces:
+            if namespace not in pod_labels:
+                pod_labels[namespace] = get_pod_labels(namespace)
+            if len(pod_labels[namespace]) == 0:
+                errors.append(f"{path}: there are no pods in namespace {namespace}")
+            elif labels and not any(all(pod.get(key) == str(value) for key, value in labels.items()) for pod in pod_labels[namespace]):
+                errors.append(f"{path}.labelSelectors: no pod in namespace {namespace} has the labels {labels}")
+    return errors
+
+
+def _load_cache(cache_file: str) -> dict:
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, "r") as f:
+        return json.load(f)
+
+
+def _save_cache(cache_file: str, cache: dict) -> None:
+    if cache_file is None:
+        return
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_file, cache_file)
+
+
+def validate_manifests(yaml_files: list[str], check_cluster: bool = True, workers: int = 8,
+                       cache_file: str = VALIDATION_CACHE_FILE) -> dict[str, list[str]]:
+    """
+    Validates yaml files in parallel. Schema results are taken from the cache if the file did not change.
+
+    Parameters:
+    yaml_files: list[str]: The manifests
+    check_cluster: bool: Also check the selectors against the pods in the cluster (not cached, the cluster changes)
+    workers: int: Files validated at the same time
+    cache_file: str: Cache of the schema results (None disables the cache)
+
+    Returns:
+    dict: yaml file -> errors (empty list if it is valid)
+    """
+    schema_version = load_schema()["version"]
+    cache = _load_cache(cache_file)
+    pod_labels = {}
+    pod_labels_lock = threading.Lock()
+
+    def validate(yaml_file: str) -> list[str]:
+        with open(yaml_file, "rb") as f:
+            content = f.read()
+        key = hashlib.sha256(schema_version.encode("utf-8") + content).hexdigest()
+        try:
+            manifest = yaml.safe_load(content)
+        except yaml.YAMLError as e:
+            return [f"invalid yaml: {e}"]
+
+        with _cache_lock:
+            errors = cache.get(key)
+        if errors is None:
+            errors = validate_manifest(manifest)
+            with _cache_lock:
+                cache[key] = errors
+        errors = list(errors)
+        if check_cluster and not errors:
+            # one kubectl call per namespace for all files
+            with pod_labels_lock:
+                errors.extend(check_selectors(manifest, pod_labels))
+        return errors
+
+    # the threads of the executor do not inherit the context (the cluster of a cluster pool), every call gets a copy
+    contexts = [contextvars.copy_context() for _ in yaml_files]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(zip(yaml_files, executor.map(lambda context, yaml_file: context.run(validate, yaml_file), contexts, yaml_files)))
+    _save_cache(cache_file, cache)
+    return results
+
+
+def validate_before_sweep(yaml_files: list[str], check_cluster: bool = True) -> None:
+    """
+    Validates all manifests of a sweep and raises an exception listing every error, before anything is applied
+    """
+    results = validate_manifests([f for f in dict.fromkeys(yaml_files) if f is not None], check_cluster)
+    invalid = {yaml_file: errors for yaml_file, errors in results.items() if errors}
+    if invalid:
+        lines = [f"{os.path.basename(yaml_file)}:\n  " + "\n  ".join(errors) for yaml_file, errors in invalid.items()]
+        raise Exception(f"{len(invalid)} of {len(results)} experiments are invalid, not starting the sweep:\n" + "\n".join(lines))
+    print(f"All {len(results)} experiments are valid")
@@ -0,0 +1,164 @@
+"""
+This module parses the JSON of a Prometheus range query (resultType matrix) while it is downloaded.
+
+response.json() builds a list of [timestamp, "value"] lists for every sample, and the log rows were then
+formatted one f-string per sample. With hundreds of series at 1s resolution that is most of the time of a fetch
+and the whole response is in memory twice. The MatrixParser instead takes the body chunk by chunk:
+- the labels of a series are decoded with json (they are small)
+- the samples are never decoded into python objects: every complete part of a "values" array is turned into
+  float64 arrays by numpy and into log rows by a few bytes.translate / bytes.replace calls on the raw text,
+  so the rows keep exactly the timestamps and values Prometheus sent (like the old f-strings did)
+Only the unparsed rest of the current chunk is buffered, the memory of a fetch does not grow with the response.
+The parser expects compact JSON (no whitespace between the brackets), which is what Prometheus sends.
+
+The module contains the following classes and functions:
+- MatrixParser: Incremental parser, feed() it the chunks of the body and it returns the finished series
+- MatrixSeries: A parsed series (labels, timestamps, values and the log rows)
+- parse_matrix: Parses an iterable of chunks (e.g. response.iter_content) into series, lazily
+- drop_rows: Drops the first rows of a series (samples that were already written)
+"""
+import json
+from typing import NamedTuple
+
+import numpy as np
+
+_METRIC_KEY = b'"metric":'
+_VALUES_KEY = b'"values":['
+# Removed before the samples are split, the remaining text is "t,v],t,v]"
+_STRIP = b'[" \t\r\n'
+_decoder = json.JSONDecoder()
+
+
+class MatrixSeries(NamedTuple):
+    labels: dict
+    timestamps: np.ndarray
+    values: np.ndarray
+    # "<row_prefix><timestamp>,<value>\n" per sample, ready to be appended to a log
+    rows: bytes
+
+
+class MatrixParser:
+    """
+    Incremental parser for the body of a range query.
+
+    Parameters:
+    row_prefix: bytes: Put in front of every log row (the metric name and a comma)
+    """
+    def __init__(self, row_prefix: bytes = b""):
+        self.row_prefix = row_prefix
+        self.buffer = b""
+        self.state = "metric"
+        self.labels = None
+        self.arrays = []
+        self.rows = []
+
+    def feed(self, chunk: bytes) -> list[MatrixSeries]:
+        """
+        Parses the next chunk of the body
+
+        Returns:
+        list[MatrixSeries]: The series that were completed by this chunk
+        """
+        self.buffer += chunk
+        finished = []
+        while True:
+            if self.state == "metric":
+                if not self._parse_labels():
+                    break
+            elif self.state == "values_key":
+                start = self.buffer.find(_VALUES_KEY)
+                if start < 0:
+                    break
+                self.buffer = self.buffer[start + len(_VALUES_KEY):]
+                self.state = "values"
+            elif not self._parse_samples(finished):
+                break
+        return finished
+
+    def close(self) -> None:
+        """
+        Raises:
+        ValueError: If the body ended in the middle of a series
+        """
+        if self.state != "metric":
+            raise ValueError(f"The response ended in the middle of a series ({self.labels})")
+
+    def _parse_labels(self) -> bool:
+        start = self.buffer.find(_METRIC_KEY)
+        if start < 0:
+            # keep what could be the beginning of the key
+            self.buffer = self.buffer[-len(_METRIC_KEY):]
+            return False
+        try:
+            text = self.buffer[start + len(_METRIC_KEY):].decode("utf-8")
+            self.labels, end = _decoder.raw_decode(text.lstrip())
+        except (ValueError, UnicodeDecodeError):
+            # the labels are not complete yet (or a chunk ends within a character)
+            return False
+        consumed = len(text) - len(text.lstrip()) + end
+        self.buffer = self.buffer[start + len(_METRIC_KEY) + len(text[:consumed].encode("utf-8")):]
+        self.state = "values_key"
+        return True
+
+    def _parse_samples(self, finished: list) -> bool:
+        # the values array ends with the closing bracket of the last sample followed by its own
+        end = 0 if self.buffer.startswith(b"]") else self.buffer.find(b'"]]')
+        if end == 0:
+            cut, rest = 0, self.buffer[1:]
+        elif end > 0:
+            cut, rest = end + 2, self.buffer[end + 3:]
+        else:
+            # the sample has to be followed by a byte, it could be the last one of the array
+            cut = self.buffer.rfind(b'"]', 0, len(self.buffer) - 1) + 2
+            if cut < 2:
+                return False
+            rest = self.buffer[cut:]
+        self._add_samples(self.buffer[:cut])
+        self.buffer = rest
+        if end < 0:
+            return False
+
+        timestamps, values = (np.concatenate(a) for a in zip(*self.arrays)) if self.arrays else (np.empty(0), np.empty(0))
+        finished.append(MatrixSeries(self.labels, timestamps, values, b"".join(self.rows)))
+        self.labels, self.arrays, self.rows = None, [], []
+        self.state = "metric"
+        return True
+
+    def _add_samples(self, text: bytes) -> None:
+        # text holds complete samples: [t,"v"],[t,"v"] (maybe starting with the comma after the previous part)
+        text = text.translate(None, _STRIP).lstrip(b",")
+        if not text:
+            return
+        numbers = np.fromstring(text.replace(b"],", b",")[:-1].decode("ascii"), sep=",")
+        self.arrays.append((numbers[0::2], numbers[1::2]))
+        self.rows.append(self.row_prefix + text.replace(b"],", b"\n" + self.row_prefix)[:-1] + b"\n")
+
+
+def parse_matrix(chunks, row_prefix: bytes = b""):
+    """
+    Parses the body of a range query chunk by chunk
+
+    Parameters:
+    chunks: Iterable of bytes (e.g. response.iter_content(65536))
+    row_prefix: bytes: Put in front of every log row
+
+    Returns:
+    Generator[MatrixSeries]: The series, as soon as each of them is complete
+
+    Raises:
+    ValueError: If the body is truncated
+    """
+    parser = MatrixParser(row_prefix)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    parser.close()
+
+
+def drop_rows(series: MatrixSeries, number: int) -> MatrixSeries:
+    """
+    Returns the series without its first number samples
+    """
+    if number <= 0:
+        return series
+    rows = series.rows.split(b"\n", number)[number] if number < len(series.timestamps) else b""
+    return MatrixSeries(series.labels, series.timestamps[number:], series.values[number:], rows)
@@ -0,0 +1,369 @@
+"""
+This module drives runs with asyncio instead of a monitor thread that only sleeps and a main thread that sleeps
+between fetches. Every phase of a run is a task of the event loop:
+- setup: prometheus check, cleanup, the input rate of a load sweep (load_sweep.py) and the steady state gate
+  (blocking kubectl calls run in asyncio.to_thread)
+- injection: waits for a good time (asyncio.sleep, no thread) and applies the chaos test
+- monitoring: counts the runs of the chaos test and sets an event once they are over
+- fetching: fetches a window every DATA_FETCH_INTERVAL_SECONDS, and right away once the monitoring is over
+- recording: polls the records of Chaos Mesh and the pod events, so the injections are known exactly (injection_timeline.py)
+- teardown: fetches the rest, stores the injections, deletes the chaos tests, measures (or detects) the chaos events
+  and finishes manifest, timeline and catalogue
+
+With REMOTE_READ_EXPORT the windows are only a preview at PREVIEW_TIME_GRANULARITY, the teardown replaces them with
+the exact samples of the run from the remote read endpoint (remote_read.py).
+
+With check_prometheus, a sweep runs a PrometheusWatchdog task (prometheus_watchdog.py) next to the runs:
+while Prometheus is degraded no new run is started, fetch windows are postponed and the last fetch of a run waits
+for Prometheus to recover.
+
+A run can be cancelled or time out at any point, the teardown always runs (status cancelled / timeout), so no
+chaos test is left behind and the data fetched so far is kept.
+While waiting the loop holds no thread, so one process can drive several experiments at once: run_sweep_async with
+clusters runs a worker per cluster (kube context and Prometheus URL, see cluster_pool.py), the experiments are
+sharded over the workers and idle workers steal runs from the others.
+
+The module contains the following functions:
+- prepare_cluster: Gets the cluster into a clean state for a run
+- monitor_runs: Async version of chaos_logging.monitor_chaos_tests
+- fetch_windows: Fetches the logs in windows until the monitoring is over
+- run_experiment_async: A single run
+- run_sweep_async: Several experiments several times, repeating runs that did not complete
+"""
+import asyncio
+import os
+import time
+
+from chaos_lib_utils.constants import (NUMBER_OF_RUNS, OFFSET_IN_SECONDS, DATA_FETCH_INTERVAL_SECONDS, STEADY_STATE_TIMEOUT_SECONDS,
+                                       TIME_GRANULARITY, REMOTE_READ_EXPORT, PREVIEW_TIME_GRANULARITY, INJECTION_POLL_SECONDS)
+from chaos_lib_utils.clean_run import delete_running_chaos_tests
+from chaos_lib_utils.cleanup_strategies import reset_cluster
+from chaos_lib_utils.prometheus_utils import get_logs, adjust_prometheus_fetch_interval, forget_written_until
+from chaos_lib_utils.prometheus_watchdog import PrometheusWatchdog
+from chaos_lib_utils.fetch_client import FetchError
+from chaos_lib_utils.file_utils import get_log_path, update_run_metadata
+from chaos_lib_utils.steady_state import wait_for_steady_state
+from chaos_lib_utils.run_manifest import start_run_manifest, finish_run_manifest
+from chaos_lib_utils.catalogue import connect, index_run
+from chaos_lib_utils.reporting import save_multiresolution
+from chaos_lib_utils.remote_read import export_run
+from chaos_lib_utils.injection_timeline import InjectionRecorder
+from chaos_lib_utils.load_sweep import wait_for_input_rate
+from chaos_lib_utils.chaos_logging import seconds_until_good_time, apply_manifest
+from chaos_lib_utils.instrumentation import start_run_timeline, finish_run_timeline, span
+from chaos_lib_utils.cluster_pool import Cluster, WorkStealingQueue, current_cluster
+
+
+def prepare_cluster(yaml_file: str, check_prometheus: bool = True, companion_yaml_file: str = None) -> str:
+    """
+    Gets the cluster into a clean state for the next run of yaml_file:
+    prometheus healthy and scraping often, no chaos tests running and the deployments reset
+    with the cleanup strategy of the experiment
+
+    Returns:
+    str: The cleanup strategy that was used
+    """
+    # check if prometheus is healthy, if not repair it (pod restart first, re-install as last resort)
+    if check_prometheus:
+        PrometheusWatchdog().ensure_healthy()
+    # Adjust the prometheus fetch interval, so we get more data points
+    adjust_prometheus_fetch_interval()
+
+    print("Deleting running chaos tests")
+    delete_running_chaos_tests()
+    # Reset the deployments for a clean start
+    strategy = reset_cluster(yaml_file, companion_yaml_file=companion_yaml_file)
+    print(f"All pods are ready (cleanup strategy: {strategy})")
+    return strategy
+
+
+async def apply_at_good_time(yaml_file: str) -> float:
+    """
+    Like chaos_logging.apply_chaos_tests_at_good_time, but waits on the event loop
+
+    Returns:
+    float: Time the chaos test was applied
+    """
+    with span("apply_chaos_tests_at_good_time"):
+        seconds = seconds_until_good_time(yaml_file)
+        if seconds > 0:
+            print("Waiting for cron schedule to be over so we have a clean start")
+            with span("wait_for_cron", seconds=seconds):
+                await asyncio.sleep(seconds)
+        else:
+            print("No cron schedule detected, applying chaos tests immediately")
+        await asyncio.to_thread(apply_manifest, yaml_file)
+    print("Chaos tests started")
+    return time.time()
+
+
+async def monitor_runs(done: asyncio.Event, number_of_runs: int = NUMBER_OF_RUNS, time_per_run: float = OFFSET_IN_SECONDS) -> None:
+    """
+    Waits until all runs of the chaos test are over (plus one more run to be in sync with the logs) and sets done
+    """
+    for _ in range(number_of_runs + 1):
+        await asyncio.sleep(time_per_run)
+    print("All runs completed, waiting for a bit to be in sync with logs")
+    done.set()
+
+
+async def fetch_windows(logfile_path: str, progress: dict, done: asyncio.Event, interval: float = DATA_FETCH_INTERVAL_SECONDS,
+                        watchdog: PrometheusWatchdog = None) -> None:
+    """
+    Fetches the logs from progress["fetched_until"] to now every interval seconds, until done is set.
+    progress["fetched_until"] is moved forward after every written window, a failed window is fetched with the next one,
+    as is a window while the watchdog considers Prometheus degraded.
+    """
+    while not done.is_set():
+        try:
+            with span("fetch_interval", seconds=interval):
+                await asyncio.wait_for(done.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        if done.is_set():
+            # the rest is fetched by the teardown
+            return
+        if watchdog is not None and not watchdog.healthy:
+            print("Prometheus is degraded, fetching this window with the next one")
+            continue
+        end_time = time.time()
+        try:
+            await asyncio.to_thread(get_logs, logfile_path, start_time=progress["fetched_until"], end_time=end_time,
+                                    time_granularity=_fetch_granularity())
+        except FetchError as e:
+            # Nothing of this window was written, it is fetched together with the next window
+            print(f"Fetching logs failed, trying again with the next window: {e}")
+            continue
+        progress["fetched_until"] = end_time
+        print("Logs fetched")
+
+
+async def _inject_and_monitor(yaml_file: str, companion_yaml_file: str, logfile_path: str, progress: dict,
+                              watchdog: PrometheusWatchdog = None) -> None:
+    if companion_yaml_file is None:
+        # For scheduled runs, right after the cron schedule, so our logs start with a warmup before the chaos tests
+        progress["chaos_applied_at"] = await apply_at_good_time(yaml_file)
+    else:
+        # apply the experiment instantly and the scheduled companion at a good time
+        await asyncio.to_thread(apply_manifest, yaml_file)
+        progress["chaos_applied_at"] = await apply_at_good_time(companion_yaml_file)
+
+    # Mark a start and run our offset for chaos tests
+    progress["fetched_until"] = progress["chaos_applied_at"]
+    with span("offset", seconds=OFFSET_IN_SECONDS):
+        await asyncio.sleep(OFFSET_IN_SECONDS)
+
+    # The monitor keeps track of the runs of the chaos test, we fetch logs until it is done
+    done = asyncio.Event()
+    await asyncio.gather(monitor_runs(done), fetch_windows(logfile_path, progress, done, watchdog=watchdog))
+
+
+def _fetch_granularity() -> float:
+    # with the export the windows are only a preview, a coarse step keeps them cheap
+    return PREVIEW_TIME_GRANULARITY if REMOTE_READ_EXPORT else TIME_GRANULARITY
+
+
+def _export(logfile_path: str, progress: dict) -> None:
+    try:
+        summary = export_run(logfile_path, progress["chaos_applied_at"], time.time())
+        print(f"Exported {sum(m['rows'] for m in summary['metrics'].values())} exact samples via remote read")
+    except Exception as e:
+        # the preview stays the log of the run
+        print(f"Remote read export failed, keeping the preview: {e}")
+        update_run_metadata(logfile_path, {"export": {"source": "remote_read", "status": "failed", "error": str(e)}})
+
+
+def _save_injections(logfile_path: str, recorder: InjectionRecorder) -> None:
+    try:
+        # a last poll before the chaos tests are deleted, and a second clock calibration
+        recorder.poll()
+        recorder.calibrate()
+    except Exception as e:
+        print(f"Recording the injections failed: {e}")
+        recorder.errors.append(str(e))
+    result = recorder.result()
+    update_run_metadata(logfile_path, {"injections": result})
+    print(f"Recorded {len(result['injections'])} injections")
+
+
+def _teardown(logfile_path: str, status: str, progress: dict) -> str:
+    # Fetches what is missing and finishes the run, returns the final status
+    if progress.get("fetched_until") is not None:
+        try:
+            get_logs(logfile_path, start_time=progress["fetched_until"], time_granularity=_fetch_granularity())
+        except FetchError as e:
+            # Keep the data we already have
+            print(f"Could not fetch the last logs, the run is incomplete: {e}")
+            if status == "completed":
+                status = "incomplete"
+        if REMOTE_READ_EXPORT and logfile_path is not None:
+            _export(logfile_path, progress)
+    if logfile_path is not None:
+        # nothing is fetched for this log any more
+        forget_written_until(logfile_path)
+
+    if progress.get("recorder") is not None and logfile_path is not None:
+        _save_injections(logfile_path, progress["recorder"])
+    delete_running_chaos_tests()
+    if logfile_path is None:
+        return status
+    timings = {"chaos_applied_at": progress.get("chaos_applied_at"), "monitoring_start_time": progress.get("chaos_applied_at")}
+    finish_run_manifest(logfile_path, status, timings)
+    # Store the 1s / 10s / 60s aggregates with the run, for coarse analyses of long runs
+    save_multiresolution(logfile_path)
+    finish_run_timeline(logfile_path, status=status)
+    conn = connect()
+    index_run(conn, logfile_path)
+    conn.close()
+    return status
+
+
+async def run_experiment_async(yaml_file: str, run_number: int = 1, companion_yaml_file: str = None, check_prometheus: bool = True,
+                               timeout: float = None, watchdog: PrometheusWatchdog = None, load_rate: float = None) -> dict:
+    """
+    Runs a single chaos experiment and writes its log to the log folder.
+
+    Parameters:
+    yaml_file: str: The chaos test to run, the log file is named after it
+    run_number: int: Number of this run (only used for printing)
+    companion_yaml_file: str: Optional scheduled chaos test, that is applied at a good time after yaml_file was applied
+    check_prometheus: bool: Repair prometheus if it is not healthy
+    timeout: float: Seconds after which the injection and monitoring are stopped (status timeout), None waits for all runs
+    watchdog: PrometheusWatchdog: Running watchdog of the sweep, replaces the prometheus check of the setup
+    load_rate: float: Input rate the load generator was set to (load sweep), the run waits until it is reached
+
+    Returns:
+    dict: "logfile_path" and "status" (completed, incomplete, timeout)
+    Raises asyncio.CancelledError after the teardown if the run was cancelled.
+    """
+    print(f"Starting run {run_number} of {os.path.basename(yaml_file)}")
+    # Record the time spent in every phase of the run (the timeline belongs to this task)
+    start_run_timeline(yaml_file)
+    logfile_path = None
+    progress = {"fetched_until": None, "chaos_applied_at": None, "recorder": None}
+    recorder_task = None
+    status = "failed"
+    try:
+        if watchdog is not None:
+            await watchdog.wait_until_healthy()
+        cleanup_strategy = await asyncio.to_thread(prepare_cluster, yaml_file, check_prometheus and watchdog is None,
+                                                   companion_yaml_file)
+
+        # Get a name for the logfile and initialize with headers (csv)
+        logfile_path = get_log_path(yaml_file)
+        with open(logfile_path, 'w') as f:
+            f.write("Metric,Time,Value\n")
+        # the path can be reused (a repeated run in the same second), the samples of the old log are gone
+        forget_written_until(logfile_path)
+        start_run_manifest(logfile_path, yaml_file, run_number, companion_yaml_file, cleanup_strategy)
+
+        # The reset restarted the miner, the input rate has to be back at the level of the load sweep
+        if load_rate is not None:
+            load = await asyncio.to_thread(wait_for_input_rate, load_rate)
+            update_run_metadata(logfile_path, {"load": load})
+
+        # Do not inject chaos while the lag still drains the backlog of the reset
+        if STEADY_STATE_TIMEOUT_SECONDS > 0:
+            baseline = await asyncio.to_thread(wait_for_steady_state)
+            update_run_metadata(logfile_path, {"baseline": baseline})
+
+        # Record when Chaos Mesh actually injects and recovers the faults
+        if INJECTION_POLL_SECONDS > 0:
+            progress["recorder"] = InjectionRecorder()
+            recorder_task = asyncio.create_task(progress["recorder"].record())
+
+        try:
+            await asyncio.wait_for(_inject_and_monitor(yaml_file, companion_yaml_file, logfile_path, progress, watchdog), timeout)
+            status = "completed"
+        except asyncio.TimeoutError:
+            print(f"Run {run_number} of {os.path.basename(yaml_file)} timed out after {timeout} seconds")
+            status = "timeout"
+        # Prometheus still holds the data of the run, wait for it instead of losing the last window
+        if watchdog is not None:
+            await watchdog.wait_until_healthy(watchdog.recovery_seconds)
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    finally:
+        if recorder_task is not None:
+            recorder_task.cancel()
+        # shielded, so a second cancellation does not leave the chaos test running
+        status = await asyncio.shield(asyncio.to_thread(_teardown, logfile_path, status, progress))
+        print(f"Finished run {run_number} of {os.path.basename(yaml_file)} ({status})")
+    return {"logfile_path": logfile_path, "status": status}
+
+
+async def run_sweep_async(yaml_files: list[str], number_of_runs: int = NUMBER_OF_RUNS, companion_yaml_file: str = None,
+                          check_prometheus: bool = True, max_repeats: int = 3, timeout: float = None, concurrency: int = 1,
+                          clusters: list[Cluster] = None) -> list[dict]:
+    """
+    Runs every experiment number_of_runs times, in order.
+    Runs that did not complete are repeated at the end (at most max_repeats times per experiment).
+
+    Parameters:
+    yaml_files: list[str]: The experiments, in the order they should run
+    number_of_runs: int: Runs per experiment
+    companion_yaml_file: str: Scheduled chaos test applied with every experiment
+    check_prometheus: bool: Watch prometheus and repair it if it is not healthy
+    max_repeats: int: How often the runs of an experiment may be repeated
+    timeout: float: Timeout of a single run (see run_experiment_async)
+    concurrency: int: Runs at the same time. Runs on the same cluster reset each other, only use > 1 with separate clusters
+    clusters: list[Cluster]: Run on these clusters, one worker per cluster (replaces concurrency, see cluster_pool.py)
+    With check_prometheus a watchdog probes Prometheus during the whole sweep, no run is started while it is degraded
+    (one watchdog per cluster).
+
+    Returns:
+    list[dict]: The results of all runs, in the order they finished (with the cluster of the run, None without clusters)
+    """
+    workers = clusters if clusters else [None] * max(1, concurrency)
+    queue = WorkStealingQueue(len(workers))
+    queue.shard(yaml_files, number_of_runs)
+    results = []
+    repeats = {}
+
+    # without clusters all workers share the prometheus of the current context
+    shared_watchdog = PrometheusWatchdog() if check_prometheus and not clusters else None
+
+    async def worker(index: int, cluster: Cluster):
+        # the task has its own copy of the context, every kubectl call and Prometheus client of its runs uses the cluster
+        current_cluster.set(cluster)
+        watchdog, watch_task = shared_watchdog, None
+        if check_prometheus and clusters:
+            watchdog = PrometheusWatchdog()
+            await asyncio.to_thread(watchdog.ensure_healthy)
+            watch_task = asyncio.create_task(watchdog.watch())
+        try:
+            # a repeated run is queued by the worker of the failed run, so there is always a worker left to take it
+            while (run := queue.pop(index)) is not None:
+                yaml_file, run_number = run
+                result = await run_experiment_async(yaml_file, run_number, companion_yaml_file, check_prometheus, timeout, watchdog)
+                results.append({**result, "cluster": None if cluster is None else cluster.name})
+                # Complete failed runs, until they failed too often
+                if result["status"] != "completed":
+                    repeats[yaml_file] = repeats.get(yaml_file, 0) + 1
+                    if repeats[yaml_file] > max_repeats:
+                        print(f"Giving up on repeating {yaml_file}")
+                    else:
+                        queue.push(index, (yaml_file, number_of_runs + repeats[yaml_file]))
+        finally:
+            if watch_task is not None:
+                watch_task.cancel()
+                await asyncio.gather(watch_task, return_exceptions=True)
+
+    tasks = []
+    if shared_watchdog is not None:
+        # the first probe (and repair) happens before the first run
+        await asyncio.to_thread(shared_watchdog.ensure_healthy)
+        tasks.append(asyncio.create_task(shared_watchdog.watch()))
+    worker_tasks = [asyncio.create_task(worker(i, cluster)) for i, cluster in enumerate(workers)]
+    tasks.extend(worker_tasks)
+    try:
+        await asyncio.gather(*worker_tasks)
+    finally:
+        # an error in one run stops the sweep, the other runs are cancelled (and torn down)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if queue.stolen:
+        print(f"{queue.stolen} runs were stolen by idle workers")
+    return results
@@ -1,103 +1,89 @@
 """
 This module contains parsing function to convert jsonnet files to yaml files for the chaos experiments
+
+Templates are evaluated in-process with the jsonnet python binding (the jsonnet binary is the fallback),
+the manifest is built as python objects and written with a yaml dumper that quotes the selectors.
 """
 import json
+import subprocess
 import yaml
-import re 
 import os
 from chaos_lib_utils.constants import JSONNET_FOLDER, YAML_FOLDER
 
 
-def convert_jsonnet_single_to_yaml(jsonnet_content):
-    """
-    This function converts a jsonnet single experiment to a yaml.
-    Generate the yaml file using ugly parsing!
-    Parsing steps explained:
-    1. Load the jsonnet file by using "jsonnet filename.jsonnet"
-    2. Parse the output:
-       a) omit the outermost brackets "workflow = { ... }"
-       
-    Parameters:
-    jsonnet_content (str): The content of the jsonnet file
-    Returns:
-    str: The content of the yaml file
-    """
-    # Load jsonnet as json
-    data = json.loads(jsonnet_content)
-    
-    # Extract the key (e.g., "networkChaosWorkflow")
-    key = next(iter(data))
-    workflow_data = data[key]
-    yaml_dump = yaml.dump(workflow_data, sort_keys=False)
-    # Attatch quotes to the selector!
-    yaml_dump = add_quotes_to_relevant_selectors(yaml_dump)
-    return yaml_dump
+# Selector maps, whose keys and values have to be quoted
+# Refer to (https://chaos-mesh.org/docs/define-chaos-experiment-scope/) for more information.
+SELECTOR_KEYS = ["fieldSelectors", "annotationSelectors", "nodeSelectors", "labelSelectors"]
 
-def add_quotes_to_relevant_selectors(yaml_content):
-    """
 
-    This function adds quotes to the selectors in the yaml content that need quotes.
-    Refer to (https://chaos-mesh.org/docs/define-chaos-experiment-scope/) for more information.
+class QuotedSelectors(dict):
+    """
+    A selector map, that is written with quoted keys and values
 
     Example:
     fieldSelectors:
       metadata.name: power-kafka-
-    This function will convert this to:
+    is written as:
     fieldSelectors:
       "metadata.name": "power-kafka-"
-    
-    Parameters:
-    yaml_content (str): The content of the yaml file
-    Returns:
-    str: The content of the yaml file with the quotes added
-    """
-    # fieldSelectors
-    yaml_dump = re.sub(r'(?<=fieldSelectors:\n)(\s+)(.*): (.*)', r'\1"\2": "\3"', yaml_content)
-    # annotationSelectors
-    yaml_dump = re.sub(r'(?<=annotationSelectors:\n)(\s+)(.*): (.*)', r'\1"\2": "\3"', yaml_dump)
-    # nodeSelectors
-    yaml_dump = re.sub(r'(?<=nodeSelectors:\n)(\s+)(.*): (.*)', r'\1"\2": "\3"', yaml_dump)
-    # labelSelectors
-    yaml_dump = re.sub(r'(?<=labelSelectors:\n)(\s+)(.*): (.*)', r'\1"\2": "\3"', yaml_dump)
-    return yaml_dump
-      
-    
-def convert_jsonnet_workflow_to_yaml(jsonnet_content):
     """
-    This function converts a jsonnet workflow to a yaml workflow.
-    Generate the yaml file using ugly parsing!
+
+
+class ManifestDumper(yaml.SafeDumper):
+    """
+    Yaml dumper for the chaos experiments, selector maps (QuotedSelectors) are written with double quotes
+    """
+
+
+def _represent_quoted_selectors(dumper: ManifestDumper, data: QuotedSelectors):
+    items = [(dumper.represent_scalar("tag:yaml.org,2002:str", str(key), style='"'),
+              dumper.represent_scalar("tag:yaml.org,2002:str", str(value), style='"')) for key, value in data.items()]
+    return yaml.MappingNode("tag:yaml.org,2002:map", items)
+
+
+ManifestDumper.add_representer(QuotedSelectors, _represent_quoted_selectors)
+
+
+def quote_selectors(node):
+    """
+    Returns a copy of the manifest in which all selector maps are QuotedSelectors
+    """
+    if isinstance(node, dict):
+        return {key: QuotedSelectors(value) if key in SELECTOR_KEYS and isinstance(value, dict) else quote_selectors(value)
+                for key, value in node.items()}
+    if isinstance(node, list):
+        return [quote_selectors(value) for value in node]
+    return node
+
+
+def dump_manifest(manifest: dict) -> str:
+    """
+    Writes a manifest as yaml, in the order of its keys and with quoted selectors
+    """
+    return yaml.dump(quote_selectors(manifest), Dumper=ManifestDumper, sort_keys=False)
+
+
+def build_workflow_manifest(workflow_data: dict) -> dict:
+    """
+    This function builds a workflow manifest from the output of helpers/workflow.jsonnet.
     This was sadly necessary as the jsonnet lib cannot specify "-" lists in yaml
     Thus - since this is well defined, we have some "constant" markers in the jsonnet files,
-    which we can use to parse the jsonnet workflows into yaml
-
-    Parsing steps explained:
-    1. Load the jsonnet file by using "jsonnet filename.jsonnet"
-    2. Parse the output:
-       a) omit the outermost brackets "workflow = { ... }"
-       b) find "spec": "parent": and replace parent content with:
+    which we can use to restructure the jsonnet workflows:
+       a) find "spec": "parent": and replace parent content with:
          childreen:
            - name1: "..."
            - name2: "..."
-       c) find "spec": "childConfigs": and replace childConfigs and the array entries
+       b) find "spec": "childConfigs": and replace childConfigs and the array entries
           with the similar format:
          - name1: "..." where name1 is the name of the child1 etc. (make sure to replace the inner "config" and just take the contents)
-          
-    3. Write the output to a yaml file
-    
+
     Parameters:
-    jsonnet_content (str): The content of the jsonnet file
+    workflow_data (dict): The workflow as evaluated by jsonnet (without the outermost key)
     Returns:
-    str: The content of the yaml file
+    dict: The workflow manifest
     """
-    # JSONify content
-    data = json.loads(jsonnet_content)
-    
-    # Extract the key (e.g., "networkChaosWorkflow")
-    key = next(iter(data))
-    workflow_data = data[key]
-    
     # reformat structure
-    yaml_content = {
+    manifest = {
         'apiVersion': workflow_data['apiVersion'],
         'kind': workflow_data['kind'],
         'metadata': workflow_data['metadata'],
@@ -114,7 +100,7 @@ def convert_jsonnet_workflow_to_yaml(jsonnet_content):
         'deadline': parent['deadline'],
         'children': parent['children']
     }
-    yaml_content['spec']['templates'].append(parent_yaml)
+    manifest['spec']['templates'].append(parent_yaml)
     
     # extract children
     for child in workflow_data['spec']['templates']['childConfigs']:
@@ -125,21 +111,115 @@ def convert_jsonnet_workflow_to_yaml(jsonnet_content):
         }
         
         # We do not always have a deadline, if we have a cron schedule
-        if config.get('deadline') is None:
-            pass
-        else:
+        if config.get('deadline') is not None:
             child_yaml['deadline'] = config['deadline']
         # get other vals by iterating over the keys
         additional_keys = {k: v for k, v in config.items() if k not in ['templateType', 'deadline']}
         child_yaml.update(additional_keys)
         
-        
-        yaml_content['spec']['templates'].append(child_yaml)
-    
-    yaml_dump = yaml.dump(yaml_content, sort_keys=False)
-    # Attatch quotes to the selector!
-    yaml_dump = add_quotes_to_relevant_selectors(yaml_dump)
-    return yaml_dump
+        manifest['spec']['templates'].append(child_yaml)
+    return manifest
+
+
+def build_manifest(data: dict) -> dict:
+    """
+    Builds the manifest from an evaluated jsonnet template.
+    The templates export a single key (e.g. "chaosWorkflow"), workflows are restructured (build_workflow_manifest),
+    single experiments are used as they are.
+    """
+    # Extract the key (e.g., "networkChaosWorkflow")
+    key = next(iter(data))
+    manifest = data[key]
+    if manifest.get('kind') == 'Workflow':
+        return build_workflow_manifest(manifest)
+    return manifest
+
+
+def evaluate_jsonnet(jsonnet_file_path: str, ext_vars: dict[str, str] = None) -> dict:
+    """
+    Evaluates a jsonnet template in-process with the jsonnet python binding.
+    If the binding is not installed (pip install jsonnet), the jsonnet binary is called instead.
+
+    Parameters:
+    jsonnet_file_path (str): Path to the jsonnet file
+    ext_vars (dict): External variables, available in the template as std.extVar(name)
+    Returns:
+    dict: The evaluated template
+    """
+    ext_vars = ext_vars or {}
+    try:
+        import _jsonnet
+    except ImportError:
+        _jsonnet = None
+
+    if _jsonnet is not None:
+        return json.loads(_jsonnet.evaluate_file(jsonnet_file_path, ext_vars=ext_vars))
+
+    cmd = ["jsonnet", jsonnet_file_path]
+    for name, value in ext_vars.items():
+        cmd += ["--ext-str", f"{name}={value}"]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise Exception("Neither the jsonnet python binding nor the jsonnet binary is installed (pip install jsonnet)")
+    if result.returncode != 0:
+        raise Exception(f"Error evaluating {jsonnet_file_path}: {result.stderr.decode('utf-8')}")
+    return json.loads(result.stdout)
+
+
+def convert_jsonnet_single_to_yaml(jsonnet_content):
+    """
+    This function converts the (json) output of a jsonnet single experiment to yaml.
+
+    Parameters:
+    jsonnet_content (str): The json output of the jsonnet file
+    Returns:
+    str: The content of the yaml file
+    """
+    return dump_manifest(build_manifest(json.loads(jsonnet_content)))
+
+
+def convert_jsonnet_workflow_to_yaml(jsonnet_content):
+    """
+    This function converts the (json) output of a jsonnet workflow to a yaml workflow (see build_workflow_manifest).
+
+    Parameters:
+    jsonnet_content (str): The json output of the jsonnet file
+    Returns:
+    str: The content of the yaml file
+    """
+    data = json.loads(jsonnet_content)
+    return dump_manifest(build_workflow_manifest(data[next(iter(data))]))
+
+
+def compile_jsonnet_manifest(jsonnet_file_path: str, ext_vars: dict[str, str] = None) -> dict:
+    """
+    Evaluates a jsonnet template and returns the manifest, without writing a file
+    """
+    return build_manifest(evaluate_jsonnet(jsonnet_file_path, ext_vars))
+
+
+def compile_jsonnet_file(jsonnet_file_path: str, yaml_folder: str = YAML_FOLDER, ext_vars: dict[str, str] = None,
+                         yaml_name: str = None) -> str:
+    """
+    This function compiles a single jsonnet file to a yaml file with the same name in the yaml folder.
+    The template is evaluated in-process (see evaluate_jsonnet) and the yaml is written once.
+
+    Parameters:
+    jsonnet_file_path (str): Path to the jsonnet file
+    yaml_folder (str): The folder path to save the yaml file (relative to the working directory)
+    ext_vars (dict): External variables for the template
+    yaml_name (str): Name of the yaml file (defaults to the name of the template)
+
+    Returns:
+    str: The path of the yaml file
+    """
+    file_name = yaml_name or os.path.basename(jsonnet_file_path).replace('.jsonnet', '.yaml')
+    yaml_file_path = os.path.join(os.getcwd(), yaml_folder, file_name)
+    yaml_content = dump_manifest(compile_jsonnet_manifest(jsonnet_file_path, ext_vars))
+    with open(yaml_file_path, 'w') as yaml_file:
+        yaml_file.write(yaml_content)
+    return yaml_file_path
 
 
 def parse_all_jsonnet_files(jsonnet_folder:str = JSONNET_FOLDER, yaml_folder: str = YAML_FOLDER)-> None:
@@ -157,23 +237,8 @@ def parse_all_jsonnet_files(jsonnet_folder:str = JSONNET_FOLDER, yaml_folder: st
     None
     """
     jsonnet_folder = os.path.join(os.getcwd(), jsonnet_folder)
-    yaml_folder = os.path.join(os.getcwd(), yaml_folder)
     
     # Find all jsonnet files in the folder
     for f in os.listdir(jsonnet_folder):
         if f.endswith('.jsonnet'):
-            
-            # Gerate jsonnet output to parse for correct yaml
-            jsonnet_file_path = os.path.join(jsonnet_folder, f)
-            yaml_file_path = os.path.join(os.getcwd(), yaml_folder, f.replace('.jsonnet', '.yaml'))
-            os.system(f'jsonnet {jsonnet_file_path} > {yaml_file_path}')
-            # Parse jsonnet output to correct yaml
-            parsed_yaml_content = None 
-            with open(yaml_file_path, 'r') as yaml_file:
-                yaml_content = yaml_file.read()
-                if 'Workflow' in yaml_content:
-                    parsed_yaml_content = convert_jsonnet_workflow_to_yaml(yaml_content)
-                else:
-                    parsed_yaml_content = convert_jsonnet_single_to_yaml(yaml_content)
-            with open(yaml_file_path, 'w') as yaml_file:
-                yaml_file.write(parsed_yaml_content)
\ No newline at end of file
+            compile_jsonnet_file(os.path.join(jsonnet_folder, f), yaml_folder)
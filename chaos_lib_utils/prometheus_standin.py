@@ -0,0 +1,408 @@
+"""
+This module provides a local stand-in for the Prometheus HTTP API.
+It makes it possible to run the monitoring code (get_logs, the fetch loops of the runners) without a cluster.
+
+The stand-in answers /-/ready (503 while state.ready is False), the remote read endpoint /api/v1/read
+(raw samples every scrape_interval seconds, see remote_read.py) and /api/v1/query_range and /api/v1/query either by
+- replaying recorded runs (the .log files in experiments/runs), looped over time, or
+- generating a synthetic lag series (see synthetic_data.py)
+Latency and errors can be injected to measure throughput and the retry behaviour of the clients.
+
+With series (label sets, e.g. several consumer groups and partitions) the stand-in serves raw series like a real
+exporter: remote read returns all of them and a query like "sum by(consumergroup, topic) (kafka_consumergroup_lag >= 0)"
+is aggregated from them (one series per group, sorted by labels, the last scraped sample at every step),
+so a preview fetched with query_range can be compared with its remote read export.
+
+The module contains the following functions:
+- load_replay_runs: Loads recorded runs to be replayed
+- start_standin_server: Starts the stand-in server in a background thread
+
+Run it from the command line to point the CLI at it instead of a port forward:
+python -m chaos_lib_utils.prometheus_standin --replay experiments/runs --port 9090
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+import warnings
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from chaos_lib_utils.synthetic_data import lag_profile, periodic_fault_starts
+from chaos_lib_utils import remote_read
+
+# Prometheus refuses range queries with more points than this per series
+MAX_POINTS_PER_SERIES = 11000
+# Labels of the series we return, the same ones "sum by(consumergroup, topic)" produces
+DEFAULT_SERIES_LABELS = {"consumergroup": "heuristics-miner", "topic": "input"}
+
+
+def load_replay_runs(log_folder: str) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Loads all recorded runs from a folder (or a single file) to replay them.
+    Runs are sorted by filename, so the mapping of queries to runs is stable.
+
+    Parameters:
+    log_folder: str: Folder with .log files or path to a single .log file
+
+    Returns:
+    list[tuple[np.ndarray, np.ndarray]]: (times relative to the first sample, values) per run
+    """
+    if os.path.isdir(log_folder):
+        paths = sorted(glob.glob(os.path.join(log_folder, "*.log")))
+    else:
+        paths = [log_folder]
+
+    runs = []
+    for path in paths:
+        # Aborted runs only hold the header, skip them without the numpy warning
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            data = np.genfromtxt(path, delimiter=",", skip_header=1, usecols=(1, 2), dtype=np.float64)
+        data = np.atleast_2d(data)
+        if data.shape[0] < 2:
+            continue
+        times = data[:, 0] - data[0, 0]
+        runs.append((times, data[:, 1]))
+
+    if len(runs) == 0:
+        raise Exception(f"No replayable runs found in {log_folder}")
+    return runs
+
+
+class StandinState:
+    """
+    Holds the data source, the injected faults and counters of a running stand-in server.
+    The data source is either a list of replay runs or the parameters of a synthetic lag series.
+    """
+    def __init__(self, replay_runs: list[tuple[np.ndarray, np.ndarray]] = None, fault_period: float = 180,
+                 fault_duration: float = 30, latency: float = 0.0, latency_jitter: float = 0.0,
+                 error_rate: float = 0.0, fail_first: int = 0, seed: int = 0, scrape_interval: float = 5.0,
+                 series: list[dict] = None):
+        self.replay_runs = replay_runs
+        self.fault_period = fault_period
+        self.fault_duration = fault_duration
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.seed = seed
+        # Raw samples of remote read are "scraped" at multiples of this interval
+        self.scrape_interval = scrape_interval
+        # Labels of the raw series (without __name__), None serves a single series per query
+        self.series = series
+        # /-/ready answers 503 while this is False, e.g. to exercise the watchdog
+        self.ready = True
+        self.anchor_time = time.time()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "injected_errors": 0, "points": 0, "bytes": 0}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += amount
+
+    def should_fail(self) -> bool:
+        """
+        Decides if the current request gets an injected error.
+        The first fail_first requests always fail, afterwards with the probability error_rate
+        """
+        with self.lock:
+            self.counters["requests"] += 1
+            if self.counters["requests"] <= self.fail_first:
+                return True
+            return self.random.random() < self.error_rate
+
+    def injected_latency(self) -> float:
+        with self.lock:
+            return self.latency + self.latency_jitter * self.random.random()
+
+    def values_at(self, query: str, times: np.ndarray) -> np.ndarray:
+        """
+        Returns the values of the series behind a query at the given timestamps.
+        Every query gets its own (but stable) series, so several metrics can be fetched at once.
+        """
+        query_seed = zlib.crc32(query.encode("utf-8"))
+        if self.replay_runs is not None:
+            run_times, run_values = self.replay_runs[query_seed % len(self.replay_runs)]
+            # Loop the recorded run, starting with its first sample at the server start
+            relative = np.mod(times - self.anchor_time, run_times[-1])
+            indices = np.clip(np.searchsorted(run_times, relative, side="right") - 1, 0, len(run_values) - 1)
+            return run_values[indices]
+
+        fault_starts = periodic_fault_starts(times[0], times[-1], self.fault_period, offset=self.anchor_time)
+        return lag_profile(times, fault_starts, fault_duration=self.fault_duration, seed=self.seed + query_seed % 1000)
+
+    def raw_values(self, name: str, labels: dict, times: np.ndarray) -> np.ndarray:
+        """
+        Values of a raw series: the sample of the last scrape at or before every timestamp
+        """
+        scrapes = np.floor(np.asarray(times, dtype=np.float64) / self.scrape_interval) * self.scrape_interval
+        return self.values_at(name + json.dumps(labels, sort_keys=True), scrapes)
+
+    def aggregate(self, query: str, times: np.ndarray) -> list[tuple[dict, np.ndarray]]:
+        """
+        Evaluates "sum by(labels) (name >= 0)" over the raw series
+
+        Returns:
+        list[tuple[dict, np.ndarray]]: (group labels, values) per group sorted by labels like Prometheus,
+        None if there are no raw series or the query has another form
+        """
+        match = re.fullmatch(r"\s*sum\s+by\s*\(([^)]*)\)\s*\(\s*([a-zA-Z_:][a-zA-Z0-9_:]*)\s*>=\s*0\s*\)\s*", query)
+        if self.series is None or match is None:
+            return None
+        group_by = sorted(label.strip() for label in match.group(1).split(",") if label.strip())
+        groups = {}
+        for labels in self.series:
+            key = tuple((label, labels[label]) for label in group_by if labels.get(label))
+            values = self.raw_values(match.group(2), labels, times)
+            groups[key] = groups.get(key, 0) + np.where(values >= 0, values, 0)
+        return [(dict(key), groups[key]) for key in sorted(groups)]
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the subset of the Prometheus HTTP API we use.
+    Responses follow https://prometheus.io/docs/prometheus/latest/querying/api/
+    """
+    server_version = "PrometheusStandin/0.1"
+
+    def log_message(self, format, *args):
+        # Keep benchmark output readable
+        pass
+
+    def _params(self) -> dict:
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        if self.command == "POST":
+            length = int(self.headers.get("Content-Length", 0))
+            params.update(parse_qs(self.rfile.read(length).decode("utf-8")))
+        return {key: values[-1] for key, values in params.items()}
+
+    def _send_json(self, status: int, body: dict) -> None:
+        payload = json.dumps(body, separators=(",", ":")).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.state.count("bytes", len(payload))
+
+    def _send_error(self, status: int, error_type: str, message: str) -> None:
+        self._send_json(status, {"status": "error", "errorType": error_type, "error": message})
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        state = self.server.state
+        path = urlparse(self.path).path
+
+        delay = state.injected_latency()
+        if delay > 0:
+            time.sleep(delay)
+
+        if path not in ("/api/v1/query_range", "/api/v1/query", "/api/v1/read", "/-/ready"):
+            self._send_error(404, "not_found", f"unknown path {path}")
+            return
+        if state.should_fail():
+            state.count("injected_errors")
+            self._send_error(503, "unavailable", "injected error")
+            return
+        if path == "/-/ready":
+            self._ready()
+            return
+        if path == "/api/v1/read":
+            self._remote_read()
+            return
+
+        try:
+            params = self._params()
+            if path == "/api/v1/query_range":
+                self._query_range(params)
+            else:
+                self._query(params)
+        except (KeyError, ValueError) as e:
+            self._send_error(400, "bad_data", f"invalid parameter: {e}")
+
+    def _ready(self) -> None:
+        # Prometheus answers the readiness probe with plain text
+        ready = self.server.state.ready
+        body = b"Prometheus Server is Ready.\n" if ready else b"Service Unavailable"
+        self.send_response(200 if ready else 503)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _remote_read(self) -> None:
+        # snappy compressed protobuf in both directions, errors are plain text like in Prometheus
+        state = self.server.state
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            queries = remote_read.decode_read_request(remote_read.snappy_decompress(body))
+        except (ValueError, IndexError) as e:
+            self._send_bytes(400, f"invalid remote read request: {e}".encode("utf-8"), "text/plain; charset=utf-8")
+            return
+
+        results = []
+        for query in queries:
+            names = [value for matcher_type, name, value in query["matchers"] if name == "__name__" and matcher_type == remote_read.MATCH_EQUAL]
+            step_ms = int(state.scrape_interval * 1000)
+            first = -(-query["start_ms"] // step_ms) * step_ms
+            timestamps = np.arange(first, query["end_ms"] + 1, step_ms, dtype=np.int64)
+            if not names or len(timestamps) == 0:
+                results.append([])
+                continue
+            series_list = []
+            for labels in (state.series if state.series is not None else [DEFAULT_SERIES_LABELS]):
+                labels = {"__name__": names[0], **labels}
+                if not _matches(labels, query["matchers"]):
+                    continue
+                if state.series is None:
+                    values = state.values_at(names[0], timestamps / 1000)
+                else:
+                    values = state.raw_values(names[0], {k: v for k, v in labels.items() if k != "__name__"}, timestamps / 1000)
+                series_list.append((labels, timestamps, values))
+                state.count("points", len(timestamps))
+            results.append(series_list)
+
+        payload = remote_read.snappy_compress(remote_read.encode_read_response(results))
+        self._send_bytes(200, payload, "application/x-protobuf", {"Content-Encoding": "snappy"})
+
+    def _send_bytes(self, status: int, payload: bytes, content_type: str, headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.state.count("bytes", len(payload))
+
+    def _query_range(self, params: dict) -> None:
+        start = float(params["start"])
+        end = float(params["end"])
+        step = float(params["step"])
+        if step <= 0:
+            raise ValueError("step must be positive")
+
+        num_points = int(np.floor((end - start) / step)) + 1
+        if num_points > MAX_POINTS_PER_SERIES:
+            self._send_error(400, "bad_data", "exceeded maximum resolution of 11,000 points per timeseries. Try decreasing the query resolution (?step=XX)")
+            return
+
+        result = []
+        if num_points > 0:
+            times = start + np.arange(num_points) * step
+            groups = self.server.state.aggregate(params["query"], times)
+            if groups is None:
+                groups = [(DEFAULT_SERIES_LABELS, self.server.state.values_at(params["query"], times))]
+            for labels, values in groups:
+                result.append({
+                    "metric": labels,
+                    "values": [[round(float(t), 3), _format_value(v)] for t, v in zip(times, values)],
+                })
+                self.server.state.count("points", num_points)
+
+        self._send_json(200, {"status": "success", "data": {"resultType": "matrix", "result": result}})
+
+    def _query(self, params: dict) -> None:
+        at = float(params.get("time", time.time()))
+        value = self.server.state.values_at(params["query"], np.array([at]))[0]
+        self.server.state.count("points")
+        result = [{"metric": DEFAULT_SERIES_LABELS, "value": [round(at, 3), _format_value(value)]}]
+        self._send_json(200, {"status": "success", "data": {"resultType": "vector", "result": result}})
+
+
+def _matches(labels: dict, matchers: list[tuple[int, str, str]]) -> bool:
+    for matcher_type, name, value in matchers:
+        label = labels.get(name, "")
+        if matcher_type == remote_read.MATCH_EQUAL and label != value:
+            return False
+        if matcher_type == remote_read.MATCH_NOT_EQUAL and label == value:
+            return False
+        if matcher_type == remote_read.MATCH_REGEX and re.fullmatch(value, label) is None:
+            return False
+        if matcher_type == remote_read.MATCH_NOT_REGEX and re.fullmatch(value, label) is not None:
+            return False
+    return True
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], state: StandinState):
+        super().__init__(address, StandinRequestHandler)
+        self.state = state
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def start_standin_server(replay_folder: str = None, host: str = "127.0.0.1", port: int = 0, **state_kwargs) -> StandinServer:
+    """
+    Starts a stand-in server in a background thread.
+
+    Parameters:
+    replay_folder: str: Folder (or file) with recorded runs, if None a synthetic lag series is served
+    host: str: Host to bind to
+    port: int: Port to bind to, 0 picks a free port (see server.url)
+    state_kwargs: Passed to StandinState (latency, latency_jitter, error_rate, fail_first, fault_period, ...)
+
+    Returns:
+    StandinServer: The running server, call stop() to shut it down
+    """
+    replay_runs = load_replay_runs(replay_folder) if replay_folder else None
+    server = StandinServer((host, port), StandinState(replay_runs=replay_runs, **state_kwargs))
+    server.thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server.thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Prometheus HTTP API")
+    parser.add_argument("--replay", help="Folder or .log file to replay, synthetic data if omitted")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--latency", type=float, default=0.0, help="Injected latency per request in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="Random extra latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of an injected 503")
+    parser.add_argument("--fault-period", type=float, default=180, help="Seconds between synthetic faults")
+    parser.add_argument("--series", nargs="+", help="Raw series as label=value pairs, e.g. consumergroup=a,topic=input,partition=0")
+    args = parser.parse_args()
+    series = None
+    if args.series:
+        series = [dict(pair.split("=", 1) for pair in entry.split(",")) for entry in args.series]
+
+    server = start_standin_server(args.replay, args.host, args.port, latency=args.latency,
+                                  latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                                  fault_period=args.fault_period, series=series)
+    print(f"Prometheus stand-in listening on {server.url}")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
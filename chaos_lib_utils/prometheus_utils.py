@@ -6,14 +6,25 @@ It also defines all used metrics (obtained from the Prometheus API)
 The module contains the following functions:
 - get_metric_queries: Returns the metric queries (defined by prometheus) to fetch from the data source 
 - get_logs: This function will get logs from the data source (Prometheus) for a defined time range
+- forget_written_until: Drops what get_logs remembers about a logfile, once the run is finished
 """
-import requests
 import time
 import subprocess
 import re
 
+import numpy as np
 
-from chaos_lib_utils.constants import monitoring_start_time, TIME_GRANULARITY, PROMETHEUS_URL, PROMETHEUS_NAMESPACE, PROMETHEUS_CUSTOM_RESOURCE_NAME, PROMETHEUS_TIME_GRANULARITY
+from chaos_lib_utils.instrumentation import instrumented, timed_run
+from chaos_lib_utils.fetch_client import get_prometheus_client
+from chaos_lib_utils.matrix_stream import drop_rows
+from chaos_lib_utils.constants import TIME_GRANULARITY, PROMETHEUS_URL, PROMETHEUS_NAMESPACE, PROMETHEUS_CUSTOM_RESOURCE_NAME, PROMETHEUS_TIME_GRANULARITY
+
+# Timestamp of the last sample written per (logfile, metric), so overlapping windows do not duplicate rows.
+# Entries are dropped with forget_written_until when a run is finished (or its log is created again)
+_written_until = {}
+
+# Prometheus refuses range queries with more points per series, longer windows are fetched in several queries
+MAX_POINTS_PER_QUERY = 11000
 
 def get_metric_queries() -> list[list[str]]:
     """
@@ -28,6 +39,7 @@ def get_metric_queries() -> list[list[str]]:
     metric_queries = [["Lag_Input_Topic","sum by(consumergroup, topic) (kafka_consumergroup_lag >= 0)"]]
     return metric_queries
 
+@instrumented
 def restart_prometheus(namespace: str = PROMETHEUS_NAMESPACE) -> None:
     """
     Runs a little script to re install the prometheus namespace fully!
@@ -39,16 +51,17 @@ def restart_prometheus(namespace: str = PROMETHEUS_NAMESPACE) -> None:
     """
     cmd = f"kubectl delete namespace {namespace}"
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        timed_run(cmd, shell=True, check=True)
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error deleting namespace {namespace}: {e}")
         
     cmd = f"helm install prometheus prometheus-community/kube-prometheus-stack --create-namespace --namespace {namespace}"
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        timed_run(cmd, shell=True, check=True)
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error installing prometheus: {e}")
     
+@instrumented
 def adjust_prometheus_fetch_interval(interval: str = PROMETHEUS_TIME_GRANULARITY, namespace: str = PROMETHEUS_NAMESPACE, prometheus_process_name: str = PROMETHEUS_CUSTOM_RESOURCE_NAME)-> None:
     """
     This function will load the prometheus configuration and adjust the fetch interval in which the data is fetched
@@ -63,7 +76,7 @@ def adjust_prometheus_fetch_interval(interval: str = PROMETHEUS_TIME_GRANULARITY
     # Get the current prometheus configuration
     cmd = f"kubectl get prometheus {prometheus_process_name} -n {namespace} -o yaml"
     try:
-        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+        result = timed_run(cmd, shell=True, stdout=subprocess.PIPE)
         prometheus_config = result.stdout.decode('utf-8')
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error getting prometheus configuration: {e}")
@@ -76,56 +89,92 @@ def adjust_prometheus_fetch_interval(interval: str = PROMETHEUS_TIME_GRANULARITY
     if old_prometheus_config == prometheus_config:
         return
     
-    # Save the configuration to a file, to apply it
-    with open("prometheus_config.yaml", "w") as f:
-        f.write(prometheus_config)
-        
-    # Apply the new configuration
-    cmd = f"kubectl apply -f prometheus_config.yaml"
+    # Apply the new configuration (from stdin, a file in the working directory would be shared by all clusters of a pool)
+    cmd = f"kubectl apply -f -"
     
     try:
-        subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        subprocess.run("rm prometheus_config.yaml", shell=True)
+        timed_run(cmd, shell=True, check=True, input=prometheus_config.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         raise Exception(f"Error applying new prometheus configuration: {e}")
         
-def get_logs(logfile_path :str, start_time: int = monitoring_start_time, end_time: int = time.time(), data_source_url: str = PROMETHEUS_URL, time_granularity: int = TIME_GRANULARITY, retries=0) -> None:
+@instrumented
+def get_logs(logfile_path :str, start_time: float = None, end_time: float = None, data_source_url: str = PROMETHEUS_URL, time_granularity: int = TIME_GRANULARITY, metrics: list[list[str]] = None) -> int:
     """
     This function will get logs from the data source
     (Prometheus in this case) for a defined time range
 
+    The window is written transactionally: all metrics are fetched into a buffer first and the buffer is
+    appended to the logfile with a single write once everything succeeded. A failed fetch writes nothing,
+    so the same window can simply be fetched again. Samples that were already written for a logfile
+    (the boundary sample of the previous window) are skipped.
+    A window with more than MAX_POINTS_PER_QUERY steps (e.g. after failed fetches) is fetched in several queries.
+    The responses are parsed while they are downloaded, straight into arrays and log rows (matrix_stream.py).
+    Retries, timeouts and the circuit breaker are handled by the PrometheusClient (fetch_client.py).
+
     Parameters:
     logfile_path: str: Path to the logfile to write the data to
-    start_time: int: Start time for the logs (defaults to the start of the monitoring)
-    end_time: int: End time for the logs (defaults to the current time)
+    start_time: float: Start time for the logs (unix timestamp)
+    end_time: float: End time for the logs (defaults to the current time)
     data_source_url: str: URL of the data source (Prometheus)
+    time_granularity: int: Step between two samples in seconds
+    metrics: list[list[str]]: [name, query] pairs to fetch (defaults to get_metric_queries())
 
     Output:
     Writes data to the logfile
     Returns:
-    None
+    int: Number of rows written
+
+    Raises:
+    FetchError: If a metric could not be fetched, nothing was written in that case
+    """
+    if start_time is None:
+        raise ValueError("get_logs needs a start_time")
+    if end_time is None:
+        end_time = time.time()
+    if metrics is None:
+        metrics = get_metric_queries()
+    client = get_prometheus_client(data_source_url)
+
+    # Fetch all metrics of the window, the rows of every metric are a single bytes object
+    parts = []
+    written_until = {}
+    rows = 0
+    for query in metrics:
+        last_written = _written_until.get((logfile_path, query[0]), float("-inf"))
+        for chunk_start, chunk_end in _split_range(start_time, end_time, time_granularity):
+            # Only the first series of a query is logged, the rest of the response is not even downloaded
+            stream = client.query_range_stream(query[1], chunk_start, chunk_end, time_granularity, row_prefix=f"{query[0]},".encode("utf-8"))
+            series = next(stream, None)
+            stream.close()
+
+            # If we recieve data keep its rows (the chunks share their boundary sample, it is dropped here as well)
+            if series is not None:
+                series = drop_rows(series, int(np.searchsorted(series.timestamps, last_written, side="right")))
+                if len(series.timestamps) > 0:
+                    parts.append(series.rows)
+                    rows += len(series.timestamps)
+                    last_written = float(series.timestamps[-1])
+                    written_until[(logfile_path, query[0])] = last_written
+
+    # Commit the window
+    with open(logfile_path, 'ab') as f:
+        f.write(b"".join(parts))
+    _written_until.update(written_until)
+    return rows
+
+def _split_range(start_time: float, end_time: float, time_granularity: float) -> list[tuple[float, float]]:
+    """
+    Splits a time range into ranges of at most MAX_POINTS_PER_QUERY steps.
+    A range ends where the next one starts, on the same step grid as the whole range
+    """
+    span = (MAX_POINTS_PER_QUERY - 1) * time_granularity
+    chunks = int(np.ceil((end_time - start_time) / span)) if end_time > start_time else 1
+    return [(start_time + i * span, min(start_time + (i + 1) * span, end_time)) for i in range(max(chunks, 1))]
+
+def forget_written_until(logfile_path: str) -> None:
+    """
+    Drops the timestamps of the last written samples of a logfile,
+    so a long sweep does not keep them and a log that is written again starts from scratch
     """
-    url = data_source_url
-
-    metrics = get_metric_queries()
-    # Append to file
-    with open(logfile_path, 'a') as f:
-
-        for query in metrics:
-            response = requests.get(f"{url}/api/v1/query_range", params={"query": query[1], "start": start_time, "end": end_time, "step": time_granularity})
-            if response.status_code == 200:
-                data = response.json()['data']['result']
-
-                # If we recieve data write it to the file in csv format
-                if not data == []:
-                    values = data[0]['values']
-                    for val in values:
-                        f.write(f"{query[0]},{val[0]},{val[1]}\n")
-            else:
-                # Sleep for a bit and retry
-                time.sleep(5)
-                if retries < 3:
-                    get_logs(logfile_path, start_time, end_time, data_source_url, time_granularity, retries+1)
-                else:
-                    raise Exception(f"Error fetching logs: {response.text}")
-                
\ No newline at end of file
+    for key in [key for key in _written_until if key[0] == logfile_path]:
+        del _written_until[key]
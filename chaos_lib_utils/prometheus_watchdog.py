@@ -0,0 +1,226 @@
+"""
+This module watches the health of Prometheus and repairs it in stages, instead of re-installing it right away.
+
+Every probe checks /-/ready and the latency of the metric query of the runs. If probes keep failing the watchdog
+escalates:
+1. retry: the next WATCHDOG_RETRIES probes may still fail (a slow query, a compaction, ...)
+2. pod restart: the Prometheus pod is deleted, the operator re-creates it (the stored series are kept)
+3. re-install: after WATCHDOG_POD_RESTARTS pod restarts did not help, the namespace is re-installed (restart_prometheus)
+After every action the watchdog waits WATCHDOG_RECOVERY_SECONDS for Prometheus to come back before it escalates further.
+
+While Prometheus is degraded the orchestrator does not start new runs, skips fetch windows (they are fetched with
+the next window) and waits with the last fetch of a run, so the data of the run is not lost.
+Note that deleting the pod ends a kubectl port-forward, keep the port-forward in a loop if PROMETHEUS_URL uses one.
+
+The module contains the following classes and functions:
+- PrometheusWatchdog: Probes Prometheus and escalates, blocking (ensure_healthy) or as asyncio task (watch)
+- restart_prometheus_pod: Deletes the Prometheus pod
+"""
+import asyncio
+import subprocess
+import time
+
+from chaos_lib_utils.constants import (PROMETHEUS_URL, PROMETHEUS_NAMESPACE, PROMETHEUS_POD_SELECTOR, WATCHDOG_INTERVAL_SECONDS,
+                                       WATCHDOG_MAX_QUERY_SECONDS, WATCHDOG_RETRIES, WATCHDOG_POD_RESTARTS, WATCHDOG_RECOVERY_SECONDS)
+from chaos_lib_utils.fetch_client import PrometheusClient, CircuitBreaker, FetchError
+from chaos_lib_utils.instrumentation import instrumented, timed_run, count
+from chaos_lib_utils.prometheus_utils import get_metric_queries, restart_prometheus, adjust_prometheus_fetch_interval
+
+
+@instrumented
+def restart_prometheus_pod(namespace: str = PROMETHEUS_NAMESPACE, selector: str = PROMETHEUS_POD_SELECTOR) -> None:
+    """
+    Deletes the Prometheus pod, the statefulset of the operator re-creates it with the same volume
+    """
+    cmd = f"kubectl delete pod -n {namespace} -l {selector} --wait=false"
+    try:
+        timed_run(cmd, shell=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"Error deleting the prometheus pod ({selector}) in namespace {namespace}: {e}")
+
+
+class PrometheusWatchdog:
+    """
+    Probes Prometheus and repairs it in stages (retry, pod restart, re-install).
+
+    Parameters:
+    url: str: URL of Prometheus
+    namespace: str: Namespace of Prometheus
+    interval: float: Seconds between two probes
+    max_query_seconds: float: A probe with a slower query counts as failed
+    retries: int: Failed probes in a row before the pod is restarted
+    pod_restarts: int: Pod restarts before Prometheus is re-installed
+    recovery_seconds: float: Time Prometheus gets to come back after a restart / re-install
+    allow_reinstall: bool: Re-install as last resort, otherwise the watchdog gives up (state failed)
+    query: str: Query whose latency is probed (defaults to the first metric query of the runs)
+    """
+    def __init__(self, url: str = PROMETHEUS_URL, namespace: str = PROMETHEUS_NAMESPACE, interval: float = WATCHDOG_INTERVAL_SECONDS,
+                 max_query_seconds: float = WATCHDOG_MAX_QUERY_SECONDS, retries: int = WATCHDOG_RETRIES,
+                 pod_restarts: int = WATCHDOG_POD_RESTARTS, recovery_seconds: float = WATCHDOG_RECOVERY_SECONDS,
+                 allow_reinstall: bool = True, query: str = None):
+        if query is None:
+            query = get_metric_queries()[0][1]
+        self.url = url
+        self.namespace = namespace
+        self.interval = interval
+        self.max_query_seconds = max_query_seconds
+        self.retries = retries
+        self.pod_restarts = pod_restarts
+        self.recovery_seconds = recovery_seconds
+        self.allow_reinstall = allow_reinstall
+        self.query = query
+        # No retries and a breaker that never opens: every probe sends exactly one request
+        self.client = PrometheusClient(url, timeout=max(max_query_seconds * 2, 1), max_retries=0,
+                                       circuit_breaker=CircuitBreaker(failure_threshold=float("inf")))
+
+        self.state = "healthy"
+        self.failures = 0
+        self.restarts = 0
+        self.reinstalls = 0
+        self.grace_until = 0.0
+        self.last_probe = None
+        # What the watchdog did, as (timestamp, action, reason)
+        self.actions = []
+        self._healthy_event = None
+
+    def probe(self) -> dict:
+        """
+        Checks /-/ready and runs the query once
+
+        Returns:
+        dict: healthy, ready, query_seconds (None if the query failed) and error
+        """
+        result = {"healthy": False, "ready": False, "query_seconds": None, "error": None}
+        try:
+            self.client.get("/-/ready", {})
+            result["ready"] = True
+            start = time.perf_counter()
+            self.client.query(self.query)
+            result["query_seconds"] = time.perf_counter() - start
+        except FetchError as e:
+            result["error"] = str(e)
+            return result
+        if result["query_seconds"] > self.max_query_seconds:
+            result["error"] = f"query took {result['query_seconds']:.2f}s (max {self.max_query_seconds}s)"
+            return result
+        result["healthy"] = True
+        return result
+
+    @property
+    def healthy(self) -> bool:
+        return self.state == "healthy"
+
+    def _act(self, action: str, reason: str) -> None:
+        print(f"Prometheus watchdog: {action} ({reason})")
+        self.actions.append((time.time(), action, reason))
+        count(f"prometheus_{action.replace(' ', '_')}")
+        self.failures = 0
+        self.grace_until = time.monotonic() + self.recovery_seconds
+
+    def step(self) -> str:
+        """
+        Probes once and escalates if needed. Blocks only for the kubectl / helm calls of a repair.
+
+        Returns:
+        str: The state afterwards: healthy, degraded (retrying), recovering (waiting after a repair) or failed
+        """
+        probe = self.last_probe = self.probe()
+        if probe["healthy"]:
+            if self.state != "healthy":
+                print("Prometheus watchdog: prometheus is healthy again")
+            self.state = "healthy"
+            self.failures = self.restarts = self.reinstalls = 0
+            return self.state
+        if self.state == "failed":
+            return self.state
+
+        if time.monotonic() < self.grace_until:
+            self.state = "recovering"
+            return self.state
+        self.failures += 1
+        self.state = "degraded"
+        if self.failures <= self.retries:
+            return self.state
+
+        if self.restarts < self.pod_restarts:
+            self.restarts += 1
+            self._act("pod restart", probe["error"])
+            restart_prometheus_pod(self.namespace)
+            self.state = "recovering"
+        elif self.allow_reinstall and self.reinstalls == 0:
+            self.reinstalls += 1
+            self._act("reinstall", probe["error"])
+            restart_prometheus(self.namespace)
+            # a fresh install scrapes with the default interval again
+            adjust_prometheus_fetch_interval(namespace=self.namespace)
+            self.state = "recovering"
+        else:
+            self._act("give up", probe["error"])
+            self.state = "failed"
+        return self.state
+
+    def ensure_healthy(self, timeout: float = None) -> None:
+        """
+        Probes (and repairs) until Prometheus is healthy.
+
+        Raises:
+        Exception: If the watchdog gave up or the timeout passed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.step() != "healthy":
+            if self.state == "failed" or (deadline is not None and time.monotonic() > deadline):
+                raise Exception(f"Prometheus at {self.url} is not healthy ({self.state}): {self.last_probe['error']}")
+            time.sleep(self.interval)
+
+    def _event(self) -> asyncio.Event:
+        # created on first use, so it belongs to the running event loop
+        if self._healthy_event is None:
+            self._healthy_event = asyncio.Event()
+            if self.healthy:
+                self._healthy_event.set()
+        return self._healthy_event
+
+    async def watch(self) -> None:
+        """
+        Probes every interval seconds until it is cancelled (run it as asyncio task)
+        """
+        event = self._event()
+        while True:
+            try:
+                state = await asyncio.to_thread(self.step)
+            except Exception as e:
+                # a failed repair (e.g. kubectl is not reachable) is retried with the next probe
+                print(f"Prometheus watchdog: repair failed: {e}")
+                state = self.state = "degraded"
+            if state == "healthy":
+                event.set()
+            else:
+                event.clear()
+            await asyncio.sleep(self.interval)
+
+    async def wait_until_healthy(self, timeout: float = None) -> bool:
+        """
+        Waits until the watchdog considers Prometheus healthy
+
+        Returns:
+        bool: False if the timeout passed first
+
+        Raises:
+        Exception: If the watchdog gave up on Prometheus
+        """
+        event = self._event()
+        if event.is_set():
+            return True
+        print("Prometheus is degraded, waiting for it to recover")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not event.is_set():
+            if self.state == "failed":
+                raise Exception(f"Prometheus at {self.url} did not recover: {self.last_probe['error']}")
+            wait = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if wait <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        return True
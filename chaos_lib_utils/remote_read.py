@@ -0,0 +1,548 @@
+"""
+This module exports the raw samples of a run in bulk through the Prometheus remote read API (/api/v1/read),
+instead of polling query_range as JSON. Remote read returns the stored samples (no resampling to a step) as snappy
+compressed protobuf, which is much cheaper to encode and decode than JSON.
+
+With REMOTE_READ_EXPORT=1 the runs only poll a low resolution preview (PREVIEW_TIME_GRANULARITY) while they are
+running, and export_run replaces the preview rows in the log with the exact samples once the run is over.
+The preview is kept next to the log (<log name>.preview.csv).
+
+Remote read works on series selectors, not on PromQL: every metric of the log is defined by a selector and the labels
+of the "sum by" of its metric query (get_remote_read_metrics). The series are summed per group and timestamp, and
+like get_logs only the first group (in the order Prometheus sorts the result by labels) is written, so the export
+holds the same series as the preview.
+
+The protobuf messages (prometheus/prompb/remote.proto and types.proto) are encoded and decoded by hand, only the
+fields we need. The samples of a series mostly have the same layout and are decoded with numpy, run by run.
+Snappy uses python-snappy if it is installed, otherwise a pure python implementation of the block format
+(the compression only writes literals: valid snappy, but not smaller).
+
+The module contains the following functions:
+- snappy_compress / snappy_decompress: Snappy block format
+- parse_selector: 'name{label="value"}' -> label matchers
+- encode_read_request / decode_read_request: ReadRequest
+- encode_read_response / decode_read_response: ReadResponse (decoding yields one series at a time)
+- read_samples: Runs remote read queries, window by window
+- export_run: Replaces the preview rows of a log with the exact samples
+"""
+import os
+import re
+import struct
+
+import numpy as np
+
+from chaos_lib_utils.constants import PROMETHEUS_URL, REMOTE_READ_WINDOW_SECONDS
+from chaos_lib_utils.fetch_client import FetchError
+from chaos_lib_utils.file_utils import get_sidecar_path, update_run_metadata
+from chaos_lib_utils.instrumentation import span
+
+# LabelMatcher.Type
+MATCH_EQUAL, MATCH_NOT_EQUAL, MATCH_REGEX, MATCH_NOT_REGEX = 0, 1, 2, 3
+MATCHER_TYPES = {"=": MATCH_EQUAL, "!=": MATCH_NOT_EQUAL, "=~": MATCH_REGEX, "!~": MATCH_NOT_REGEX}
+# ReadRequest.ResponseType, we only accept plain samples
+RESPONSE_TYPE_SAMPLES = 0
+
+PREVIEW_SUFFIX = ".preview.csv"
+
+
+def get_remote_read_metrics() -> list[list]:
+    """
+    Returns the metrics to export with remote read, like get_metric_queries
+
+    Returns:
+    list[list]: [metric name in the log, series selector, minimum value (smaller values are dropped, like ">= 0"),
+    labels of the "sum by" (None sums all series)]
+    """
+    return [["Lag_Input_Topic", "kafka_consumergroup_lag", 0, ["consumergroup", "topic"]]]
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Snappy (block format, https://github.com/google/snappy/blob/main/format_description.txt)
+# ---------------------------------------------------------------------------------------------------------------------
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _decode_varint(buffer, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _snappy_compress_literals(data: bytes) -> bytes:
+    # Only literal elements, at most 64 KiB each
+    out = bytearray(_encode_varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        elif n < 256:
+            out += bytes([60 << 2, n])
+        else:
+            out += bytes([61 << 2]) + n.to_bytes(2, "little")
+        out += chunk
+    return bytes(out)
+
+
+def _snappy_decompress(data: bytes) -> bytes:
+    length, pos = _decode_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        element = tag & 3
+        if element == 0:
+            # literal, the length is in the tag or in the next 1-4 bytes
+            n = tag >> 2
+            if n >= 60:
+                size = n - 59
+                n = int.from_bytes(data[pos:pos + size], "little")
+                pos += size
+            n += 1
+            out += data[pos:pos + n]
+            pos += n
+            continue
+        if element == 1:
+            n = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif element == 2:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], "little")
+            pos += 2
+        else:
+            n = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+        if offset == 0 or offset > len(out):
+            raise ValueError("Invalid snappy data: copy before the start of the output")
+        start = len(out) - offset
+        if offset >= n:
+            out += out[start:start + n]
+        else:
+            # overlapping copy, repeats the last offset bytes
+            for i in range(n):
+                out.append(out[start + i])
+    if len(out) != length:
+        raise ValueError(f"Invalid snappy data: expected {length} bytes, got {len(out)}")
+    return bytes(out)
+
+
+def snappy_compress(data: bytes) -> bytes:
+    try:
+        import snappy
+    except ImportError:
+        return _snappy_compress_literals(data)
+    return snappy.compress(data)
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    try:
+        import snappy
+    except ImportError:
+        return _snappy_decompress(data)
+    return snappy.uncompress(data)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Protobuf
+# ---------------------------------------------------------------------------------------------------------------------
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _encode_varint((field << 3) | wire_type)
+
+
+def _length_delimited(field: int, payload: bytes) -> bytes:
+    return _key(field, 2) + _encode_varint(len(payload)) + payload
+
+
+def _int64(field: int, value: int) -> bytes:
+    # negative int64 are encoded as 10 byte two's complement
+    return _key(field, 0) + _encode_varint(value & 0xFFFFFFFFFFFFFFFF)
+
+
+def _to_int64(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _next_field(buffer, pos: int) -> tuple[int, int, object, int]:
+    """
+    Decodes the field at buffer[pos], returns (field number, wire type, value, position of the next field).
+    The value is an int for varints, the position for fixed64 / fixed32 and (start, end) for length delimited fields.
+    """
+    key, pos = _decode_varint(buffer, pos)
+    field, wire_type = key >> 3, key & 7
+    if wire_type == 0:
+        value, pos = _decode_varint(buffer, pos)
+    elif wire_type == 1:
+        value = pos
+        pos += 8
+    elif wire_type == 2:
+        size, pos = _decode_varint(buffer, pos)
+        value = (pos, pos + size)
+        pos += size
+    elif wire_type == 5:
+        value = pos
+        pos += 4
+    else:
+        raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+    return field, wire_type, value, pos
+
+
+def _fields(buffer, start: int, end: int):
+    """
+    Yields (field number, wire type, value) of a message in buffer[start:end], see _next_field
+    """
+    pos = start
+    while pos < end:
+        field, wire_type, value, pos = _next_field(buffer, pos)
+        yield field, wire_type, value
+
+
+# Sample messages in a TimeSeries: 0x12 <length> [0x09 <value, 8 bytes>] 0x10 <timestamp varint>.
+# The value is left out if it is 0 (proto3 default), the timestamp varint is 6 bytes for current timestamps in ms.
+_SAMPLE_TAG, _VALUE_TAG, _TIMESTAMP_TAG = 0x12, 0x09, 0x10
+# Samples checked at once by _decode_sample_run, doubled while they all fit, so a short run (e.g. lag alternating
+# with 0) does not check the whole series
+_SAMPLE_RUN_CHUNK = 16
+
+
+def _decode_sample_run(data: np.ndarray, pos: int, end: int) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Decodes the run of samples starting at data[pos] that all have the same layout (so the same length) with numpy.
+    Consecutive samples usually do, only a value of 0 or a timestamp varint that gets a byte longer ends a run.
+
+    Returns:
+    tuple: timestamps in ms, values and the position after the run (pos if the sample there does not fit the layout)
+    """
+    empty = (np.empty(0, dtype=np.int64), np.empty(0), pos)
+    if pos + 3 > end or data[pos + 1] >= 0x80:
+        return empty
+    stride = int(data[pos + 1]) + 2
+    with_value = data[pos + 2] == _VALUE_TAG
+    # key, length, [value key, value], timestamp key, at least one varint byte
+    timestamp_at = 11 if with_value else 2
+    if stride < timestamp_at + 2:
+        return empty
+    shifts = np.arange(stride - timestamp_at - 1, dtype=np.uint64) * np.uint64(7)
+
+    timestamps, values = [], []
+    chunk = _SAMPLE_RUN_CHUNK
+    while True:
+        n = min((end - pos) // stride, chunk)
+        if n == 0:
+            break
+        records = data[pos:pos + n * stride].reshape(n, stride)
+        varint = records[:, timestamp_at + 1:]
+        fits = ((records[:, 0] == _SAMPLE_TAG) & (records[:, 1] == stride - 2) & (records[:, 2] == records[0, 2]) &
+                (records[:, timestamp_at] == _TIMESTAMP_TAG) & (varint[:, -1] < 0x80) & (varint[:, :-1] >= 0x80).all(axis=1))
+        # the run ends at the first sample that does not fit
+        fitting = n if fits.all() else int(np.argmin(fits))
+        if fitting > 0:
+            # the sum wraps around like the int64 of the protobuf, so negative timestamps come out right as well
+            timestamps.append(((varint[:fitting] & 0x7F).astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64).view(np.int64))
+            values.append(records[:fitting, 3:11].copy().view("<f8").ravel() if with_value else np.zeros(fitting))
+            pos += fitting * stride
+        if fitting < n:
+            break
+        chunk *= 2
+    if len(timestamps) == 0:
+        return empty
+    return np.concatenate(timestamps), np.concatenate(values), pos
+
+
+def _decode_string(buffer, position: tuple[int, int]) -> str:
+    return bytes(buffer[position[0]:position[1]]).decode("utf-8")
+
+
+def parse_selector(selector: str) -> list[tuple[int, str, str]]:
+    """
+    Parses a series selector like kafka_consumergroup_lag{topic="input",consumergroup=~"heuristics.*"}
+
+    Returns:
+    list: (matcher type, label name, value) per matcher, the metric name is a matcher on __name__
+    """
+    match = re.fullmatch(r'\s*([a-zA-Z_:][a-zA-Z0-9_:]*)?\s*(?:\{(.*)\})?\s*', selector)
+    if match is None:
+        raise ValueError(f"Invalid series selector {selector}")
+    matchers = []
+    if match.group(1):
+        matchers.append((MATCH_EQUAL, "__name__", match.group(1)))
+    body = match.group(2) or ""
+    for label in re.finditer(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*,?', body):
+        matchers.append((MATCHER_TYPES[label.group(2)], label.group(1), label.group(3).encode("utf-8").decode("unicode_escape")))
+    if len(matchers) == 0:
+        raise ValueError(f"The series selector {selector} has no matchers")
+    return matchers
+
+
+def encode_read_request(queries: list[dict]) -> bytes:
+    """
+    Encodes a ReadRequest
+
+    Parameters:
+    queries: list[dict]: start_ms, end_ms and matchers (see parse_selector) per query
+    """
+    out = bytearray()
+    for query in queries:
+        payload = _int64(1, query["start_ms"]) + _int64(2, query["end_ms"])
+        for matcher_type, name, value in query["matchers"]:
+            matcher = _int64(1, matcher_type) + _length_delimited(2, name.encode("utf-8")) + _length_delimited(3, value.encode("utf-8"))
+            payload += _length_delimited(3, matcher)
+        out += _length_delimited(1, payload)
+    # accepted_response_types, packed
+    out += _length_delimited(2, _encode_varint(RESPONSE_TYPE_SAMPLES))
+    return bytes(out)
+
+
+def decode_read_request(buffer: bytes) -> list[dict]:
+    """
+    Decodes a ReadRequest into a list of queries (start_ms, end_ms, matchers)
+    """
+    queries = []
+    for field, _, value in _fields(buffer, 0, len(buffer)):
+        if field != 1:
+            continue
+        query = {"start_ms": 0, "end_ms": 0, "matchers": []}
+        for query_field, _, query_value in _fields(buffer, *value):
+            if query_field == 1:
+                query["start_ms"] = _to_int64(query_value)
+            elif query_field == 2:
+                query["end_ms"] = _to_int64(query_value)
+            elif query_field == 3:
+                matcher = [MATCH_EQUAL, "", ""]
+                for matcher_field, _, matcher_value in _fields(buffer, *query_value):
+                    if matcher_field == 1:
+                        matcher[0] = matcher_value
+                    elif matcher_field in (2, 3):
+                        matcher[matcher_field - 1] = _decode_string(buffer, matcher_value)
+                query["matchers"].append(tuple(matcher))
+        queries.append(query)
+    return queries
+
+
+def encode_read_response(results: list[list[tuple[dict, np.ndarray, np.ndarray]]]) -> bytes:
+    """
+    Encodes a ReadResponse
+
+    Parameters:
+    results: list: One list per query of (labels, timestamps in ms, values) per series
+    """
+    out = bytearray()
+    for series_list in results:
+        result = bytearray()
+        for labels, timestamps_ms, values in series_list:
+            series = bytearray()
+            for name in sorted(labels):
+                series += _length_delimited(1, _length_delimited(1, name.encode("utf-8")) + _length_delimited(2, str(labels[name]).encode("utf-8")))
+            for timestamp, value in zip(np.asarray(timestamps_ms, dtype=np.int64).tolist(), np.asarray(values, dtype=float).tolist()):
+                series += _length_delimited(2, b"\x09" + struct.pack("<d", value) + _int64(2, timestamp))
+            result += _length_delimited(1, bytes(series))
+        out += _length_delimited(1, bytes(result))
+    return bytes(out)
+
+
+def decode_read_response(buffer: bytes):
+    """
+    Decodes a ReadResponse one series at a time.
+    Runs of samples with the same layout are decoded with numpy (_decode_sample_run), the rest field by field.
+
+    Yields:
+    tuple: query index, labels (dict), timestamps in ms (int64 array), values (float64 array)
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    buffer = memoryview(buffer)
+    unpack_double = struct.Struct("<d").unpack_from
+    query_index = 0
+    for field, _, result in _fields(buffer, 0, len(buffer)):
+        if field != 1:
+            continue
+        for result_field, _, series in _fields(buffer, *result):
+            if result_field != 1:
+                continue
+            labels = {}
+            # numpy runs and, between them, samples decoded field by field
+            timestamps, values = [], []
+            field_timestamps, field_values = [], []
+            # a short run costs more with numpy than field by field, after one the next samples are decoded field by field
+            by_field = 0
+            pos, end = series
+            while pos < end:
+                if buffer[pos] == _SAMPLE_TAG and by_field == 0:
+                    run_timestamps, run_values, pos = _decode_sample_run(data, pos, end)
+                    if len(run_timestamps) < _SAMPLE_RUN_CHUNK:
+                        by_field = _SAMPLE_RUN_CHUNK
+                    if len(run_timestamps) > 0:
+                        if field_timestamps:
+                            timestamps.append(np.array(field_timestamps, dtype=np.int64))
+                            values.append(np.array(field_values, dtype=np.float64))
+                            field_timestamps, field_values = [], []
+                        timestamps.append(run_timestamps)
+                        values.append(run_values)
+                        continue
+                series_field, _, value, pos = _next_field(buffer, pos)
+                if series_field == 1:
+                    label = {label_field: _decode_string(buffer, label_value) for label_field, _, label_value in _fields(buffer, *value)}
+                    labels[label.get(1, "")] = label.get(2, "")
+                elif series_field == 2:
+                    timestamp, sample_value = 0, 0.0
+                    for sample_field, _, sample in _fields(buffer, *value):
+                        if sample_field == 1:
+                            sample_value = unpack_double(buffer, sample)[0]
+                        elif sample_field == 2:
+                            timestamp = _to_int64(sample)
+                    field_timestamps.append(timestamp)
+                    field_values.append(sample_value)
+                    by_field = max(by_field - 1, 0)
+            timestamps.append(np.array(field_timestamps, dtype=np.int64))
+            values.append(np.array(field_values, dtype=np.float64))
+            yield query_index, labels, np.concatenate(timestamps), np.concatenate(values)
+        query_index += 1
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Export
+# ---------------------------------------------------------------------------------------------------------------------
+
+def read_samples(selectors: list[str], start_time: float, end_time: float, url: str = PROMETHEUS_URL,
+                 window_seconds: float = REMOTE_READ_WINDOW_SECONDS):
+    """
+    Reads the raw samples of the selectors with one remote read request per time window, so a long run does not
+    hit the sample limit of Prometheus and only one window is in memory.
+    The requests go through the shared PrometheusClient, with its timeout, retries and circuit breaker.
+
+    Yields:
+    list: The series of a window, as (selector index, labels, timestamps in ms, values)
+
+    Raises:
+    FetchError: If a request failed
+    """
+    from chaos_lib_utils.fetch_client import get_prometheus_client
+
+    client = get_prometheus_client(url)
+    matchers = [parse_selector(selector) for selector in selectors]
+    headers = {"Content-Encoding": "snappy", "Content-Type": "application/x-protobuf",
+               "Accept-Encoding": "snappy", "X-Prometheus-Remote-Read-Version": "0.1.0"}
+    # both ends of a query are inclusive, the next window starts 1 ms later
+    start_ms, end_ms, window_ms = int(start_time * 1000), int(end_time * 1000), max(int(window_seconds * 1000), 1)
+    for window_start in range(start_ms, end_ms + 1, window_ms):
+        window_end = min(window_start + window_ms - 1, end_ms)
+        queries = [{"start_ms": window_start, "end_ms": window_end, "matchers": m} for m in matchers]
+        response = client.post("/api/v1/read", snappy_compress(encode_read_request(queries)), headers)
+        try:
+            yield list(decode_read_response(snappy_decompress(response.content)))
+        except (ValueError, IndexError) as e:
+            raise FetchError(f"Invalid remote read response for {selectors}: {e}")
+
+
+def _sum_per_timestamp(timestamps: list[np.ndarray], values: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    timestamps = np.concatenate(timestamps)
+    values = np.concatenate(values)
+    unique, inverse = np.unique(timestamps, return_inverse=True)
+    sums = np.zeros(len(unique))
+    np.add.at(sums, inverse, values)
+    return unique, sums
+
+
+def _group_series(series: list[tuple[dict, np.ndarray, np.ndarray]], group_by: list[str]) -> dict:
+    """
+    Groups series by the labels of a "sum by" (all series are one group if group_by is None)
+
+    Returns:
+    dict: (label, value) pairs of the group (without empty labels, like the result of the query) -> its (timestamps, values)
+    Sorting the keys gives the order of the series in the result of Prometheus
+    """
+    groups = {}
+    for labels, timestamps, values in series:
+        key = () if group_by is None else tuple((label, labels[label]) for label in sorted(group_by) if labels.get(label))
+        groups.setdefault(key, []).append((timestamps, values))
+    return groups
+
+
+def _format_rows(metric: str, timestamps_ms: np.ndarray, values: np.ndarray) -> str:
+    # the same format as the JSON of query_range: seconds with up to 3 decimals, integer values without decimals
+    rows = []
+    for timestamp, value in zip(timestamps_ms.tolist(), values.tolist()):
+        time_str = f"{timestamp // 1000}" if timestamp % 1000 == 0 else f"{timestamp / 1000:.3f}".rstrip("0")
+        value_str = str(int(value)) if value.is_integer() else repr(value)
+        rows.append(f"{metric},{time_str},{value_str}\n")
+    return "".join(rows)
+
+
+def export_run(logfile_path: str, start_time: float, end_time: float, url: str = PROMETHEUS_URL, metrics: list[list] = None) -> dict:
+    """
+    Replaces the preview rows of the exported metrics in a log with the exact samples from remote read.
+    Rows of other metrics are kept. The log is replaced at once, the preview is kept as <log name>.preview.csv.
+
+    Parameters:
+    logfile_path: str: The log of the run
+    start_time / end_time: float: Time range of the run (unix timestamps)
+    url: str: Prometheus URL
+    metrics: list[list]: See get_remote_read_metrics
+
+    Returns:
+    dict: rows, series (of the written group), groups and the labels of the written group per metric,
+    also stored as "export" in the run metadata
+    """
+    if metrics is None:
+        metrics = get_remote_read_metrics()
+    exported = {metric[0] for metric in metrics}
+    summary = {"source": "remote_read", "start_time": start_time, "end_time": end_time,
+               "metrics": {metric[0]: {"series": 0, "groups": 0, "group": None, "rows": 0} for metric in metrics}}
+    tmp_path = f"{logfile_path}.{os.getpid()}.tmp"
+
+    with span("remote_read_export"):
+        try:
+            with open(logfile_path, "r") as preview, open(tmp_path, "w") as f:
+                # keep the header and the rows of metrics we do not export
+                f.write(preview.readline())
+                for line in preview:
+                    if line.split(",", 1)[0] not in exported:
+                        f.write(line)
+
+                # Windows do not overlap, so every window is summed and written on its own
+                for window in read_samples([metric[1] for metric in metrics], start_time, end_time, url):
+                    for index, (name, _, min_value, group_by) in enumerate(metrics):
+                        series = []
+                        for i, labels, timestamps, values in window:
+                            keep = values >= min_value if min_value is not None else np.isfinite(values)
+                            # a series without samples left is not part of the result, like in PromQL
+                            if i == index and keep.any():
+                                series.append((labels, timestamps[keep], values[keep]))
+                        groups = _group_series(series, group_by)
+                        if not groups:
+                            continue
+                        # get_logs only writes the first series of the query, so does the export
+                        first = min(groups)
+                        timestamps, values = _sum_per_timestamp([t for t, _ in groups[first]], [v for _, v in groups[first]])
+                        f.write(_format_rows(name, timestamps, values))
+                        metric_summary = summary["metrics"][name]
+                        metric_summary["series"] = max(metric_summary["series"], len(groups[first]))
+                        metric_summary["groups"] = max(metric_summary["groups"], len(groups))
+                        metric_summary["group"] = dict(first)
+                        metric_summary["rows"] += int(len(timestamps))
+        except BaseException:
+            # the log is untouched until the very end, only the partial export has to go
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        os.replace(logfile_path, get_sidecar_path(logfile_path, PREVIEW_SUFFIX))
+        os.replace(tmp_path, logfile_path)
+    update_run_metadata(logfile_path, {"export": summary})
+    return summary
@@ -0,0 +1,221 @@
+"""
+This module renders the runs of a sweep headless (matplotlib Agg backend), without opening a window per run.
+
+- Every series is decimated before it is drawn: per pixel column only the minimum and the maximum are kept,
+  so the plot looks the same as with all points (peaks are not lost) but only ~2 points per pixel are drawn.
+  Long runs are drawn from their stored levels (<log name>.levels.npz, see reporting.build_multiresolution),
+  the level with the finest resolution that still fits the pixels is used as it is
+- Runs are drawn as small multiples, several runs per page, into PNG files or a single PDF
+- Loading, chaos event detection and decimation run in worker processes, for PNG output the pages are drawn there too
+
+Example:
+render_report(["single_*"], "report.pdf")
+render_report(["single_*"], "plots/", columns=3, rows=3)
+
+The module contains the following functions:
+- use_headless_backend: Switches matplotlib to Agg (call before pyplot is imported)
+- minmax_decimate: Keeps the minimum and maximum of every bucket
+- level_points: The minimum and maximum of every bucket of a stored level, as points to draw
+- prepare_run: Loads, detects and decimates a single run
+- draw_run: Draws a prepared run into an axis
+- render_page: Draws a grid of prepared runs
+- render_report: Renders all matching runs into a PDF or a folder of PNG files
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from chaos_lib_utils.constants import LOG_FOLDER
+
+# Width of a small multiple in pixels, the series is decimated to two points per pixel
+DEFAULT_PIXELS = 400
+
+
+def use_headless_backend() -> None:
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+
+
+def minmax_decimate(x: np.ndarray, y: np.ndarray, buckets: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Min/max decimation: x is split into buckets of equal width, for every bucket the points with the smallest
+    and the largest y are kept (in their original order). Series with less than 2 * buckets points are returned as is.
+
+    Parameters:
+    x: np.ndarray: Sorted x values (time)
+    y: np.ndarray: y values
+    buckets: int: Number of buckets (e.g. the width of the plot in pixels)
+
+    Returns:
+    tuple: The decimated x and y
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= 2 * buckets or buckets < 1:
+        return x, y
+
+    span = x[-1] - x[0]
+    if span <= 0:
+        bucket = np.arange(len(x)) * buckets // len(x)
+    else:
+        bucket = np.minimum(((x - x[0]) / span * buckets).astype(np.int64), buckets - 1)
+    # Sorting by (bucket, y): the first entry of a bucket is its minimum, the last its maximum
+    order = np.lexsort((y, bucket))
+    starts = np.flatnonzero(np.r_[True, bucket[order][1:] != bucket[order][:-1]])
+    ends = np.r_[starts[1:], len(order)] - 1
+    keep = np.unique(np.concatenate([order[starts], order[ends]]))
+    return x[keep], y[keep]
+
+
+def level_points(level: np.ndarray, resolution: float, start: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the minimum and the maximum of every bucket of a level (see reporting.bucket_aggregates) as two points,
+    at the start and at the end of the bucket. The order inside a bucket is not stored, the one closer to the last
+    value of the bucket is drawn second, so the line continues from where the bucket ended
+
+    Parameters:
+    level: np.ndarray: The level
+    resolution: float: Resolution of the level in seconds
+    start: float: Start of the run, the times are returned relative to it
+
+    Returns:
+    tuple: The times and values
+    """
+    min_first = np.abs(level["last"] - level["max"]) <= np.abs(level["last"] - level["min"])
+    first = np.where(min_first, level["min"], level["max"])
+    second = np.where(min_first, level["max"], level["min"])
+    # the first bucket starts before the first sample
+    times = np.column_stack([np.maximum(level["time"], start), level["time"] + resolution]) - start
+    return times.ravel(), np.column_stack([first, second]).ravel()
+
+
+def prepare_run(logfile_path: str, pixels: int = DEFAULT_PIXELS, prominence: float = 50, detect: bool = True) -> dict:
+    """
+    Loads a run, detects its chaos events on the full resolution and decimates the series for drawing.
+    Runs with more than 2 * pixels samples are drawn from the level of the run with the finest resolution that
+    has at most pixels buckets (built and stored next to the log if it is missing), not from the samples.
+
+    Returns:
+    dict: name, times (relative to the start, decimated), values (decimated), events (list of [start, end] in seconds)
+    """
+    from chaos_lib_utils.run_archive import RunView
+    from chaos_lib_utils.reporting import RESOLUTIONS, choose_resolution, load_multiresolution
+
+    run = RunView(logfile_path)
+    times = run.times
+    start = float(times[0]) if len(times) else 0.0
+
+    events = []
+    if detect and len(times) > 2:
+        from chaos_lib_utils.reporting import identify_chaos_around_maxima, find_number_of_chaos_groups
+        df = identify_chaos_around_maxima(run.to_dataframe(), 'Value', prominence=prominence)
+        _, chaos_groups = find_number_of_chaos_groups(df)
+        events = [[times[group[0]] - start, times[group[1]] - start] for group in chaos_groups]
+
+    if len(times) <= 2 * pixels:
+        decimated_times, decimated_values = np.array(times) - start, np.array(run.values)
+    else:
+        try:
+            resolution = choose_resolution(float(times[-1]) - start, pixels, RESOLUTIONS)
+            decimated_times, decimated_values = level_points(load_multiresolution(logfile_path, resolution), resolution, start)
+            # the last bucket ends after the last sample
+            decimated_times = np.minimum(decimated_times, float(times[-1]) - start)
+        except OSError as e:
+            # e.g. the levels can not be written next to the log, decimate the samples instead
+            print(f"Could not load the levels of {logfile_path}: {e}")
+            decimated_times, decimated_values = np.array(times) - start, np.array(run.values)
+        # only does something if even the coarsest level has more buckets than pixels
+        decimated_times, decimated_values = minmax_decimate(decimated_times, decimated_values, pixels)
+    return {"name": run.name, "times": decimated_times, "values": decimated_values, "events": events, "samples": len(times)}
+
+
+def draw_run(ax, prepared: dict, title: str = None) -> None:
+    """
+    Draws a prepared run like reporting.plot_chaos_events: the data in blue, starts of chaos events in red
+    and ends in green
+    """
+    ax.plot(prepared["times"], prepared["values"], color='blue', linewidth=0.8)
+    for start, end in prepared["events"]:
+        ax.axvline(x=start, color='red', linestyle='--', linewidth=0.8)
+        ax.axvline(x=end, color='green', linestyle='--', linewidth=0.8)
+    ax.set_title(title or prepared["name"], fontsize=8)
+    ax.tick_params(labelsize=6)
+
+
+def render_page(prepared_runs: list[dict], output_path: str = None, columns: int = 4, rows: int = 6, dpi: int = 100):
+    """
+    Draws up to columns * rows prepared runs into one figure.
+    The figure is saved to output_path (and closed) if it is given, otherwise it is returned.
+    """
+    use_headless_backend()
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(rows, columns, figsize=(columns * DEFAULT_PIXELS / dpi, rows * 2.2), dpi=dpi, squeeze=False)
+    for ax, prepared in zip(axes.flat, prepared_runs):
+        draw_run(ax, prepared)
+    for ax in axes.flat[len(prepared_runs):]:
+        ax.axis("off")
+    fig.supxlabel('Time in Seconds')
+    fig.supylabel('Consumer Group Lag')
+    fig.tight_layout()
+    if output_path is None:
+        return fig
+    fig.savefig(output_path)
+    plt.close(fig)
+    return output_path
+
+
+def _render_png_page(logfile_paths: list[str], output_path: str, columns: int, rows: int, pixels: int, prominence: float, detect: bool) -> str:
+    prepared = [prepare_run(path, pixels, prominence, detect) for path in logfile_paths]
+    return render_page(prepared, output_path, columns, rows)
+
+
+def render_report(patterns: list[str], output: str, columns: int = 4, rows: int = 6, pixels: int = DEFAULT_PIXELS,
+                  prominence: float = 50, detect: bool = True, min_rows: int = 0, workers: int = None,
+                  log_folder: str = LOG_FOLDER) -> list[str]:
+    """
+    Renders all runs matching the patterns as small multiples
+
+    Parameters:
+    patterns: list[str]: Globs of logs in the log folder
+    output: str: A .pdf file (one page per grid) or a folder for PNG files (page_001.png, ...)
+    columns / rows: int: Runs per page
+    pixels: int: Width of a single plot in points after decimation
+    prominence: float: Prominence of the chaos event detection
+    detect: bool: Mark the detected chaos events
+    min_rows: int: Skip runs with less samples
+    workers: int: Worker processes (default: all cores)
+
+    Returns:
+    list[str]: The written files
+    """
+    from chaos_lib_utils.run_archive import RunArchive
+
+    log_files = [run.logfile_path for run in RunArchive(log_folder).runs(patterns, min_rows=min_rows)]
+    per_page = columns * rows
+    pages = [log_files[i:i + per_page] for i in range(0, len(log_files), per_page)]
+    if len(pages) == 0:
+        return []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if not output.endswith(".pdf"):
+            os.makedirs(output, exist_ok=True)
+            paths = [os.path.join(output, f"page_{i + 1:03d}.png") for i in range(len(pages))]
+            render = partial(_render_png_page, columns=columns, rows=rows, pixels=pixels, prominence=prominence, detect=detect)
+            return list(executor.map(render, pages, paths))
+
+        # A PDF is written by a single process, the workers prepare the data
+        use_headless_backend()
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        prepare = partial(prepare_run, pixels=pixels, prominence=prominence, detect=detect)
+        prepared = executor.map(prepare, log_files, chunksize=4)
+        with PdfPages(output) as pdf:
+            for page in pages:
+                fig = render_page([next(prepared) for _ in page], None, columns, rows)
+                pdf.savefig(fig)
+                plt.close(fig)
+    return [output]
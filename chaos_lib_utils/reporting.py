@@ -1,13 +1,21 @@
 """
 This module contains functions for generating reports and plots for the chaos experiments
+
+Long runs can be analysed on a coarser level: build_multiresolution / load_multiresolution keep min, max, mean and
+last per 1s, 10s and 60s bucket (stored next to the log), locate_peaks refines peaks found on a coarse level exactly.
+
+Two sweeps (e.g. before and after a change to the miner) are compared with compare_sweeps: runs are matched by
+experiment and latency, the recovery time and the peak lag of the chaos events are compared with Welch t-tests
+(all experiments at once) and a significant increase above a threshold is flagged as regression.
+
+matplotlib and scipy are only imported by the functions that need them,
+so worker processes that only analyse data do not pay for importing them.
 """
 import pandas as pd
 import os 
+import re
 import numpy as np
-import matplotlib.pyplot as plt 
-from scipy.signal import find_peaks
 from chaos_lib_utils.constants import LOG_FOLDER
-from matplotlib.lines import Line2D
 
 
 def read_csv(filename: str) -> pd.DataFrame:
@@ -58,7 +66,7 @@ def identify_chaos_events_derivative(df: pd.DataFrame, column: str, threshold: f
     # Ensure continuity of chaos events
     # If the previous value is a chaos event and the current values is above the threshold, it is a chaos event
     df['Chaos'] = df['Chaos'].rolling(window=2).max()
-    df['Chaos'].fillna(0, inplace=True)
+    df['Chaos'] = df['Chaos'].fillna(0)
     return df
 
 def identify_chaos_events_quantiles(df: pd.DataFrame, column: str, upper_quantile: float) -> pd.DataFrame:
@@ -81,7 +89,7 @@ def identify_chaos_events_quantiles(df: pd.DataFrame, column: str, upper_quantil
     # Ensure continuity of chaos events
     # If the previous value is a chaos event and the current values is above the threshold, it is a chaos event
     df['Chaos'] = df['Chaos'].rolling(window=2).max()
-    df['Chaos'].fillna(0, inplace=True)
+    df['Chaos'] = df['Chaos'].fillna(0)
     return df
 
 def identify_chaos_events_moving_average(df: pd.DataFrame, column: str, window_size: int, k: float=2) -> pd.DataFrame:
@@ -167,16 +175,21 @@ def find_number_of_chaos_groups(df: pd.DataFrame) -> Tuple[int, List[List[int]]]
     return number_of_chaos_groups, chaos_groups
 
 # Plot the data as a line graph
-def plot_chaos_events(df: pd.DataFrame, chaos_events: list[list[int]], title : str = "Chaos Events", figsize: Tuple[int, int]=(15, 5), legend : bool = False) -> None:
+def plot_chaos_events(df: pd.DataFrame, chaos_events: list[list[int]], title : str = "Chaos Events", figsize: Tuple[int, int]=(15, 5), legend : bool = False, save_path: str = None) -> None:
     """
     This function plots the chaos experiment on a line graph
     It returns a plot, with the start and end of the chaos events marked
     The start is marked with a red horizontal line and the end is marked with a green horizontal line
+    For many runs use rendering.render_report, it draws them headless into a grid
     
     Parameters:
     df: A pandas dataframe
     chaos_events: A list of lists containing lists with the start and end indices
+    save_path: If given, the plot is saved to this file instead of shown
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+
     # Plot the data as a line graph with different colors for chaos events
     plt.figure(figsize=figsize)
     plt.plot(df['Time'], df['Value'], color='blue')
@@ -206,16 +219,25 @@ def plot_chaos_events(df: pd.DataFrame, chaos_events: list[list[int]], title : s
     plt.xlabel('Time in Seconds')
     plt.ylabel('Consumer Group Lag')
     plt.title(title)
-    plt.show()
+    _show_or_save(plt, save_path)
     
-def plot_time_series(df: pd.DataFrame, label: str=None) -> None:
+def plot_time_series(df: pd.DataFrame, label: str=None, save_path: str = None) -> None:
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(15, 5))
     plt.plot(df['Time'], df['Value'], color='blue')
     plt.xlabel('Time')
     plt.ylabel('Value')
     if label:
         plt.title(label)
-    plt.show()
+    _show_or_save(plt, save_path)
+
+def _show_or_save(plt, save_path: str = None) -> None:
+    if save_path is None:
+        plt.show()
+        return
+    plt.savefig(save_path)
+    plt.close()
     
 def get_duration(df: pd.DataFrame, chaos_event: list[int, int]) -> float:
     """
@@ -372,6 +394,7 @@ def identify_chaos_around_maxima(df: pd.DataFrame, column: str, median_fraction:
     Returns:
     df: pd.DataFrame with a new column 'Chaos' indicating identified chaos events
     """
+    from scipy.signal import find_peaks
     
     # Calculate the series median
     median_value = df[column].median()
@@ -414,6 +437,330 @@ def identify_chaos_around_maxima(df: pd.DataFrame, column: str, median_fraction:
     return df
 
 
+# Multi resolution representation of a run
+# Long runs have hundreds of thousands of points at TIME_GRANULARITY=1. Every level holds per bucket the
+# min, max, mean and last value (and the number of samples), coarse analyses and plots use a coarse level.
+# The maxima of every bucket are kept, so peaks can be located on a coarse level and refined exactly.
+RESOLUTIONS = [1, 10, 60]
+LEVEL_DTYPE = np.dtype([("time", "<f8"), ("min", "<f8"), ("max", "<f8"), ("mean", "<f8"), ("last", "<f8"), ("count", "<i8")])
+
+def bucket_aggregates(times: np.ndarray, values: np.ndarray, bucket_seconds: float) -> np.ndarray:
+    """
+    Aggregates a series into buckets of bucket_seconds (aligned to multiples of bucket_seconds)
+    
+    Parameters:
+    times: np.ndarray: Sorted timestamps in seconds
+    values: np.ndarray: The values
+    bucket_seconds: float: Width of a bucket
+    
+    Returns:
+    np.ndarray: One row per non empty bucket with time (start of the bucket), min, max, mean, last and count
+    """
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    level = np.empty(0, dtype=LEVEL_DTYPE)
+    if len(times) == 0:
+        return level
+    buckets = np.floor(times / bucket_seconds)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    level = np.empty(len(starts), dtype=LEVEL_DTYPE)
+    level["time"] = buckets[starts] * bucket_seconds
+    level["min"] = np.minimum.reduceat(values, starts)
+    level["max"] = np.maximum.reduceat(values, starts)
+    level["count"] = np.diff(np.r_[starts, len(values)])
+    level["mean"] = np.add.reduceat(values, starts) / level["count"]
+    level["last"] = values[np.r_[starts[1:], len(values)] - 1]
+    return level
+
+def coarsen_level(level: np.ndarray, bucket_seconds: float) -> np.ndarray:
+    """
+    Aggregates a level into coarser buckets (bucket_seconds has to be a multiple of the resolution of level),
+    the mean is weighted with the number of samples
+    """
+    if len(level) == 0:
+        return level.copy()
+    buckets = np.floor(level["time"] / bucket_seconds)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    coarse = np.empty(len(starts), dtype=LEVEL_DTYPE)
+    coarse["time"] = buckets[starts] * bucket_seconds
+    coarse["min"] = np.minimum.reduceat(level["min"], starts)
+    coarse["max"] = np.maximum.reduceat(level["max"], starts)
+    coarse["count"] = np.add.reduceat(level["count"], starts)
+    coarse["mean"] = np.add.reduceat(level["mean"] * level["count"], starts) / coarse["count"]
+    coarse["last"] = level["last"][np.r_[starts[1:], len(level)] - 1]
+    return coarse
+
+def build_multiresolution(times: np.ndarray, values: np.ndarray, resolutions: list[float] = RESOLUTIONS) -> dict[float, np.ndarray]:
+    """
+    Builds all levels, the finest from the samples and every coarser level from the previous one
+    
+    Returns:
+    dict: resolution in seconds -> level (see bucket_aggregates)
+    """
+    resolutions = sorted(resolutions)
+    levels = {resolutions[0]: bucket_aggregates(times, values, resolutions[0])}
+    for finer, coarser in zip(resolutions, resolutions[1:]):
+        if coarser % finer == 0:
+            levels[coarser] = coarsen_level(levels[finer], coarser)
+        else:
+            levels[coarser] = bucket_aggregates(times, values, coarser)
+    return levels
+
+def get_multiresolution_path(logfile_path: str) -> str:
+    from chaos_lib_utils.file_utils import get_sidecar_path
+    return get_sidecar_path(logfile_path, ".levels.npz")
+
+def save_multiresolution(logfile_path: str, times: np.ndarray = None, values: np.ndarray = None, resolutions: list[float] = RESOLUTIONS) -> str:
+    """
+    Builds the levels of a run and stores them next to its log (<log name>.levels.npz)
+    If times and values are not given they are read from the log (through run_archive)
+    """
+    if times is None or values is None:
+        from chaos_lib_utils.run_archive import RunView
+        run = RunView(logfile_path)
+        times, values = run.times, run.values
+    levels = build_multiresolution(times, values, resolutions)
+    path = get_multiresolution_path(logfile_path)
+    with open(path, "wb") as f:
+        np.savez(f, **{f"res_{resolution:g}": level for resolution, level in levels.items()})
+    return path
+
+def load_multiresolution(logfile_path: str, resolution: float = None) -> dict[float, np.ndarray] | np.ndarray:
+    """
+    Loads the levels of a run (they are built if they are missing or older than the log)
+    
+    Returns:
+    All levels as dict, or the level of resolution if it is given
+    """
+    path = get_multiresolution_path(logfile_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(logfile_path):
+        save_multiresolution(logfile_path)
+    with np.load(path) as data:
+        levels = {float(name[len("res_"):]): data[name] for name in data.files}
+    if resolution is None:
+        return levels
+    return levels[float(resolution)]
+
+def choose_resolution(span_seconds: float, max_points: int, resolutions: list[float] = RESOLUTIONS) -> float:
+    """
+    Returns the finest resolution that has at most max_points buckets over span_seconds
+    (the coarsest resolution if none of them is coarse enough)
+    """
+    for resolution in sorted(resolutions):
+        if span_seconds / resolution <= max_points:
+            return resolution
+    return max(resolutions)
+
+def level_to_dataframe(level: np.ndarray, value: str = "max") -> pd.DataFrame:
+    """
+    Returns a level with the columns of a log (Time, Value), Value is the chosen aggregate (min, max, mean or last)
+    so the functions of this module can be used on it
+    """
+    return pd.DataFrame({"Metric": "Lag_Input_Topic", "Time": level["time"], "Value": level[value]})
+
+def locate_peaks(times: np.ndarray, values: np.ndarray, level: np.ndarray, resolution: float, prominence: float = 1) -> np.ndarray:
+    """
+    Finds peaks on the max aggregate of a coarse level and returns their exact indices in the full resolution series.
+    A peak of the coarse level is refined to the position of the maximum inside its bucket, so the value at
+    every returned index is exactly the maximum of the bucket.
+    
+    Parameters:
+    times / values: np.ndarray: The full resolution series
+    level: np.ndarray: A level of the series (see build_multiresolution)
+    resolution: float: Resolution of the level in seconds
+    prominence: float: Prominence for scipy.signal.find_peaks on the level
+    
+    Returns:
+    np.ndarray: Indices into times / values
+    """
+    from scipy.signal import find_peaks
+
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    coarse_peaks, _ = find_peaks(level["max"], prominence=prominence)
+    starts = np.searchsorted(times, level["time"][coarse_peaks], side="left")
+    ends = np.searchsorted(times, level["time"][coarse_peaks] + resolution, side="left")
+    return np.array([start + int(np.argmax(values[start:end])) for start, end in zip(starts, ends)], dtype=np.int64)
+
+
+def get_latency_from_filename(filename: str) -> int:
+    """
+    Extracts the injected latency from a log name (single_{latency}_{datetime}.log).
+    Runs without latency (e.g. single_pod_failure_...) have a latency of 0.
+    """
+    match = re.search(r"single_(\d+)_", os.path.basename(filename))
+    if match is None:
+        return 0
+    return int(match.group(1))
+
+def analyze_log_file(filename: str, prominence: float = 50, min_rows: int = 300) -> list[dict]:
+    """
+    Computes the recovery time of every chaos event in a log, the same way the notebook does
+    (identify_chaos_around_maxima and the duration of every chaos group).
+    The log is read through its numpy cache (run_archive.py), short logs are skipped without parsing them.
+    
+    Parameters:
+    filename: str: Name of the log in the log folder (or a path)
+    prominence: float: Prominence for the peak detection
+    min_rows: int: Logs with less rows are skipped (an empty list is returned)
+    
+    Returns:
+    list[dict]: One row per chaos event with File, Latency, Event, RecoveryTime and PeakLag
+    """
+    from chaos_lib_utils.run_archive import RunView
+
+    # only bare names are in the log folder, paths (also relative ones) are used as they are
+    if os.path.dirname(filename) == "":
+        filename = os.path.join(os.getcwd(), LOG_FOLDER, filename)
+    run = RunView(filename)
+    if len(run) < min_rows:
+        return []
+    return analyze_run(run, prominence)
+
+def analyze_run(run, prominence: float = 50) -> list[dict]:
+    """
+    Same as analyze_log_file for a run_archive.RunView
+    """
+    df = identify_chaos_around_maxima(run.to_dataframe(), 'Value', prominence=prominence)
+    _, chaos_groups = find_number_of_chaos_groups(df)
+    rows = []
+    for i, group in enumerate(chaos_groups):
+        rows.append({
+            "File": run.name,
+            "Latency": get_latency_from_filename(run.name),
+            "Event": i,
+            "RecoveryTime": float(compute_td(df, group[0], group[1])),
+            "PeakLag": float(df['Value'].iloc[group[0]:group[1] + 1].max()),
+        })
+    return rows
+
+
+# Sweep comparison
+COMPARISON_METRICS = ["RecoveryTime", "PeakLag"]
+
+
+def get_run_parameters(logfile_path: str) -> dict:
+    """
+    Experiment and latency of a run, from its manifest or (older runs) from the file name
+    """
+    from chaos_lib_utils.catalogue import build_row
+
+    row = build_row(logfile_path)
+    return {"Experiment": row["experiment"], "Latency": row["latency_ms"] if row["latency_ms"] is not None else 0.0}
+
+
+def collect_sweep_events(log_files: list[str], prominence: float = 50, min_rows: int = 300, workers: int = None) -> pd.DataFrame:
+    """
+    The chaos events of a set of runs (log paths), with the parameters of their run
+
+    Returns:
+    pd.DataFrame: File, Experiment, Latency, Event, RecoveryTime, PeakLag
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    analyze = partial(analyze_log_file, prominence=prominence, min_rows=min_rows)
+    if workers == 1 or len(log_files) < 2:
+        results = [analyze(log_file) for log_file in log_files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(analyze, log_files, chunksize=16))
+
+    rows = []
+    for log_file, run_rows in zip(log_files, results):
+        parameters = get_run_parameters(log_file)
+        rows.extend({**row, **parameters} for row in run_rows)
+    return pd.DataFrame(rows, columns=["File", "Experiment", "Latency", "Event"] + COMPARISON_METRICS)
+
+
+def _group_moments(events: pd.DataFrame, keys: list[str], metric: str) -> pd.DataFrame:
+    # count, mean and sample variance of a metric per group
+    grouped = events.groupby(keys)[metric]
+    return pd.DataFrame({"n": grouped.count(), "mean": grouped.mean(), "var": grouped.var(ddof=1)})
+
+
+def welch_t_test(mean_a: np.ndarray, var_a: np.ndarray, n_a: np.ndarray, mean_b: np.ndarray, var_b: np.ndarray,
+                 n_b: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Welch's t-test (unequal variances) for many pairs of samples at once, given their moments.
+    Gives the same results as scipy.stats.ttest_ind(a, b, equal_var=False) per pair.
+
+    Returns:
+    tuple: t statistic, degrees of freedom and two sided p-value per pair (NaN with less than 2 values on a side)
+    """
+    from scipy import stats
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        se_a = np.asarray(var_a, dtype=float) / n_a
+        se_b = np.asarray(var_b, dtype=float) / n_b
+        t = (np.asarray(mean_a, dtype=float) - mean_b) / np.sqrt(se_a + se_b)
+        df = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+    p_value = 2 * stats.t.sf(np.abs(t), df)
+    return t, df, p_value
+
+
+def compare_sweeps(baseline: pd.DataFrame, candidate: pd.DataFrame, threshold: float = 0.1, alpha: float = 0.05,
+                   metrics: list[str] = COMPARISON_METRICS, keys: list[str] = ["Experiment", "Latency"]) -> pd.DataFrame:
+    """
+    Compares the chaos events of two sweeps (see collect_sweep_events), experiment by experiment.
+    Higher recovery times and peaks are worse: an experiment regressed on a metric if the candidate mean is more than
+    threshold (relative) above the baseline mean and the difference is significant (Welch t-test, p < alpha).
+
+    Parameters:
+    baseline / candidate: pd.DataFrame: The events of both sweeps
+    threshold: float: Relative increase that counts as regression (0.1 = 10 %)
+    alpha: float: Significance level
+    metrics: list[str]: Columns to compare
+    keys: list[str]: Columns runs are matched by
+
+    Returns:
+    pd.DataFrame: One row per experiment and metric with the counts, means, delta, relative delta, t, p-value and
+    status (regression, improvement, unchanged, or missing if one sweep has less than 2 events of the experiment)
+    """
+    tables = []
+    for metric in metrics:
+        a = _group_moments(baseline, keys, metric)
+        b = _group_moments(candidate, keys, metric)
+        table = a.join(b, how="outer", lsuffix="_baseline", rsuffix="_candidate")
+        table[["n_baseline", "n_candidate"]] = table[["n_baseline", "n_candidate"]].fillna(0).astype(int)
+        table.insert(0, "metric", metric)
+        tables.append(table)
+    table = pd.concat(tables).reset_index()
+
+    t, _, p_value = welch_t_test(table["mean_candidate"], table["var_candidate"], table["n_candidate"],
+                                 table["mean_baseline"], table["var_baseline"], table["n_baseline"])
+    table["delta"] = table["mean_candidate"] - table["mean_baseline"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        table["delta_pct"] = 100 * table["delta"] / table["mean_baseline"].abs()
+    table["t"] = t
+    table["p_value"] = p_value
+
+    significant = table["p_value"] < alpha
+    relative = table["delta_pct"] / 100
+    table["status"] = "unchanged"
+    table.loc[significant & (relative > threshold), "status"] = "regression"
+    table.loc[significant & (relative < -threshold), "status"] = "improvement"
+    # without two values on each side there is no variance to test against
+    table.loc[(table["n_baseline"] < 2) | (table["n_candidate"] < 2), "status"] = "missing"
+    columns = keys + ["metric", "n_baseline", "n_candidate", "mean_baseline", "mean_candidate", "delta", "delta_pct", "t", "p_value", "status"]
+    return table[columns].sort_values(keys + ["metric"]).reset_index(drop=True)
+
+
+def format_comparison(comparison: pd.DataFrame) -> str:
+    """
+    Compact text table of compare_sweeps, with a summary line
+    """
+    lines = [f"{'experiment':<28} {'latency':>7} {'metric':<12} {'n':>7} {'baseline':>10} {'candidate':>10} {'delta':>8} {'p':>7}  status"]
+    for row in comparison.itertuples(index=False):
+        delta = f"{row.delta_pct:+.1f}%" if np.isfinite(row.delta_pct) else "-"
+        p_value = f"{row.p_value:.3f}" if np.isfinite(row.p_value) else "-"
+        means = [f"{m:.1f}" if np.isfinite(m) else "-" for m in (row.mean_baseline, row.mean_candidate)]
+        lines.append(f"{str(row.Experiment)[:28]:<28} {row.Latency:>7.0f} {row.metric:<12} {f'{row.n_baseline}/{row.n_candidate}':>7} "
+                     f"{means[0]:>10} {means[1]:>10} {delta:>8} {p_value:>7}  {row.status}")
+    counts = comparison["status"].value_counts()
+    lines.append(", ".join(f"{counts.get(status, 0)} {status}" for status in ["regression", "improvement", "unchanged", "missing"]))
+    return "\n".join(lines)
+
 
 # If you want to test the processing code but juypter notebook updates of modules are too infrequent
 """
@@ -0,0 +1,239 @@
+"""
+This module gives access to all runs in the log folder without loading them all into memory.
+
+The times and values of a metric are cached per run as a numpy file next to the log
+(<log name>.Lag_Input_Topic.npy, a structured array with the fields time and value). The cache is built on the
+first access and rebuilt if the log changed. The cache is opened memory mapped, so the length of a run is read from
+the file header and the samples are only paged in when they are used.
+
+Example:
+archive = RunArchive()
+for run in archive.runs("single_*", min_rows=300):
+    df = run.to_dataframe()   # only this run is in memory
+    ...
+for results in archive.stream(analyze, chunk_size=32, workers=8):
+    ...
+
+The module contains the following classes and functions:
+- RunView: A lazy view on a single run (length, times, values, metadata, DataFrame)
+- RunArchive: All runs of a log folder, filtered and streamed one at a time or in chunks
+- build_cache: Converts a log to its numpy cache
+"""
+import fnmatch
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from chaos_lib_utils.constants import LOG_FOLDER
+from chaos_lib_utils.file_utils import get_sidecar_path, load_run_metadata
+
+DEFAULT_METRIC = "Lag_Input_Topic"
+SAMPLE_DTYPE = np.dtype([("time", "<f8"), ("value", "<f8")])
+
+
+def get_cache_path(logfile_path: str, metric: str = DEFAULT_METRIC) -> str:
+    return get_sidecar_path(logfile_path, f".{metric}.npy")
+
+
+def build_cache(logfile_path: str, metric: str = DEFAULT_METRIC) -> str:
+    """
+    Parses the samples of a metric from a log and stores them as numpy file next to it.
+    The file is written to a temporary file first and then moved, so a reader never sees half a cache.
+
+    Returns:
+    str: Path of the cache
+    """
+    import pandas as pd
+
+    df = pd.read_csv(logfile_path, usecols=["Metric", "Time", "Value"])
+    df = df[df["Metric"] == metric]
+    samples = np.empty(len(df), dtype=SAMPLE_DTYPE)
+    samples["time"] = df["Time"].to_numpy(dtype=float)
+    samples["value"] = df["Value"].to_numpy(dtype=float)
+
+    cache_path = get_cache_path(logfile_path, metric)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, samples)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+class RunView:
+    """
+    Lazy view on a run. Nothing is read until it is needed:
+    - len(run) opens the cache memory mapped (only the header is read)
+    - run.times / run.values are memory mapped arrays
+    - run.level(60) returns the 60s aggregates of the run
+    - run.metadata reads the manifest (<log name>.meta.json)
+
+    Parameters:
+    logfile_path: str: Path of the log
+    metric: str: The metric to look at
+    """
+    def __init__(self, logfile_path: str, metric: str = DEFAULT_METRIC):
+        self.logfile_path = logfile_path
+        self.metric = metric
+        self._samples = None
+        self._metadata = None
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.logfile_path)
+
+    @property
+    def samples(self) -> np.memmap:
+        if self._samples is None:
+            cache_path = get_cache_path(self.logfile_path, self.metric)
+            if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(self.logfile_path):
+                build_cache(self.logfile_path, self.metric)
+            self._samples = np.load(cache_path, mmap_mode="r")
+        return self._samples
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.samples["time"]
+
+    @property
+    def values(self) -> np.ndarray:
+        return self.samples["value"]
+
+    @property
+    def metadata(self) -> dict:
+        if self._metadata is None:
+            self._metadata = load_run_metadata(self.logfile_path)
+        return self._metadata
+
+    @property
+    def latency(self) -> float:
+        """
+        Latency of the network delay in ms, from the manifest or the file name (0 if there is none)
+        """
+        experiment = self.metadata.get("experiment")
+        latency = experiment.get("parameters", {}).get("latency_ms") if isinstance(experiment, dict) else None
+        if latency is None:
+            from chaos_lib_utils.reporting import get_latency_from_filename
+            latency = get_latency_from_filename(self.name)
+        return latency
+
+    def level(self, resolution: float) -> np.ndarray:
+        """
+        Returns the min / max / mean / last aggregates of the run at resolution seconds (see reporting.load_multiresolution)
+        """
+        from chaos_lib_utils.reporting import load_multiresolution
+        return load_multiresolution(self.logfile_path, resolution)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def to_dataframe(self):
+        """
+        Returns the run as DataFrame with the columns of the log (Metric, Time, Value), like reporting.read_csv.
+        The DataFrame holds a copy, the reporting functions add columns to it.
+        """
+        import pandas as pd
+        return pd.DataFrame({"Metric": self.metric, "Time": np.array(self.times), "Value": np.array(self.values)})
+
+    def release(self) -> None:
+        """
+        Drops the memory map and the metadata, the next access opens them again
+        """
+        self._samples = None
+        self._metadata = None
+
+    def __getstate__(self) -> dict:
+        # memory maps are not sent to worker processes, the worker opens the cache itself
+        return {"logfile_path": self.logfile_path, "metric": self.metric}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["logfile_path"], state["metric"])
+
+    def __repr__(self) -> str:
+        return f"RunView({self.name!r})"
+
+
+def _apply(function, runs: list[RunView]) -> list:
+    results = [function(run) for run in runs]
+    for run in runs:
+        run.release()
+    return results
+
+
+class RunArchive:
+    """
+    All runs in a log folder.
+
+    Parameters:
+    log_folder: str: The folder with the logs (defaults to LOG_FOLDER)
+    metric: str: The metric of the runs
+    """
+    def __init__(self, log_folder: str = LOG_FOLDER, metric: str = DEFAULT_METRIC):
+        self.log_folder = log_folder
+        self.metric = metric
+
+    def log_files(self, patterns: list[str] = None) -> list[str]:
+        """
+        Returns the sorted paths of all logs matching one of the glob patterns (all logs by default)
+        """
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        names = sorted(f for f in os.listdir(self.log_folder) if f.endswith(".log"))
+        if patterns:
+            names = [f for f in names if any(fnmatch.fnmatch(f, p) or fnmatch.fnmatch(f[:-len(".log")], p) for p in patterns)]
+        return [os.path.join(self.log_folder, f) for f in names]
+
+    def runs(self, patterns: list[str] = None, min_rows: int = 0, where=None):
+        """
+        Yields a RunView per log, one at a time. Runs with less than min_rows samples or where where(run) is False are
+        skipped, both checks only touch the cache header and the manifest.
+        The memory map of a skipped run is released right away.
+        """
+        for logfile_path in self.log_files(patterns):
+            run = RunView(logfile_path, self.metric)
+            if len(run) < min_rows or (where is not None and not where(run)):
+                run.release()
+                continue
+            yield run
+
+    def chunks(self, chunk_size: int, patterns: list[str] = None, min_rows: int = 0, where=None):
+        """
+        Yields lists of at most chunk_size RunViews
+        """
+        chunk = []
+        for run in self.runs(patterns, min_rows, where):
+            chunk.append(run)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def stream(self, function, chunk_size: int = 16, workers: int = None, patterns: list[str] = None, min_rows: int = 0, where=None):
+        """
+        Applies function to every run and yields the results chunk by chunk (a list per chunk, in the order of the runs).
+        At most one chunk per worker is in flight, so the memory does not grow with the size of the archive.
+
+        Parameters:
+        function: callable: Gets a RunView, has to be picklable (a module level function) if workers > 1
+        chunk_size: int: Runs per chunk
+        workers: int: Worker processes, 1 runs everything in this process (default: all cores)
+        patterns / min_rows / where: see runs()
+        """
+        chunks = self.chunks(chunk_size, patterns, min_rows, where)
+        if workers == 1:
+            for chunk in chunks:
+                yield _apply(function, chunk)
+            return
+
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for chunk in chunks:
+                for run in chunk:
+                    run.release()
+                pending.append(executor.submit(_apply, function, chunk))
+                if len(pending) >= workers:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
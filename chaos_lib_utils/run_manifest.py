@@ -0,0 +1,203 @@
+"""
+This module writes the manifest of a run, so a run can be identified by more than its file name.
+
+The manifest is stored in the metadata file of the run (<log name>.meta.json, see file_utils.update_run_metadata)
+and holds:
+- experiment: name, path and sha256 of the chaos test yaml (and of the companion), the parameters read from it
+  (kind, actions, latency, duration, schedule, label selectors) and the cleanup strategy
+- timings: start of the run, when the chaos test was applied, start of monitoring, end of the run
+- events: the chaos events of the run (start, end and recovery time), measured from the recorded injections
+  (injection_timeline.py) or, without them, detected in the log (see reporting.py)
+- config: the settings from config.env and the kube context the run was done on (and the cluster of a cluster pool)
+
+The module contains the following functions:
+- hash_file: sha256 of a file
+- get_experiment_parameters: Reads the parameters of a chaos test yaml
+- get_cluster_snapshot: The settings and the kube context
+- start_run_manifest: Writes the experiment and config part when a run starts
+- finish_run_manifest: Adds timings, status and the detected events when a run is done
+"""
+import hashlib
+import os
+import re
+import subprocess
+import time
+
+import yaml
+
+from chaos_lib_utils.constants import settings
+from chaos_lib_utils.file_utils import update_run_metadata, load_run_metadata
+from chaos_lib_utils.instrumentation import timed_run
+from chaos_lib_utils.cluster_pool import current_cluster
+
+MANIFEST_VERSION = 1
+
+
+def hash_file(path: str) -> str:
+    """
+    Returns the sha256 of a file as hex string
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_milliseconds(value) -> float:
+    # Chaos mesh durations: "20ms", "1.5s", "2m"
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", str(value))
+    if match is None:
+        return None
+    factor = {"ms": 1, None: 1, "s": 1000, "m": 60000, "h": 3600000}[match.group(2)]
+    return float(match.group(1)) * factor
+
+
+def _walk(node, visit) -> None:
+    if isinstance(node, dict):
+        visit(node)
+        for value in node.values():
+            _walk(value, visit)
+    elif isinstance(node, list):
+        for value in node:
+            _walk(value, visit)
+
+
+def get_experiment_parameters(yaml_file: str) -> dict:
+    """
+    Reads the parameters of a chaos test yaml.
+    For workflows the parameters of all templates are collected, the latency is the highest delay of all templates.
+
+    Returns:
+    dict: kind, name, actions, latency_ms (None without a network delay), durations, schedules, label_selectors
+    """
+    with open(yaml_file, "r") as f:
+        experiment = yaml.safe_load(f) or {}
+
+    parameters = {
+        "kind": experiment.get("kind"),
+        "name": experiment.get("metadata", {}).get("name"),
+        "actions": [],
+        "latency_ms": None,
+        "durations": [],
+        "schedules": [],
+        "label_selectors": [],
+    }
+
+    def visit(node: dict) -> None:
+        if isinstance(node.get("action"), str):
+            parameters["actions"].append(node["action"])
+        if isinstance(node.get("delay"), dict) and "latency" in node["delay"]:
+            latency = _parse_milliseconds(node["delay"]["latency"])
+            if latency is not None and (parameters["latency_ms"] is None or latency > parameters["latency_ms"]):
+                parameters["latency_ms"] = latency
+        if isinstance(node.get("duration"), str):
+            parameters["durations"].append(node["duration"])
+        if isinstance(node.get("schedule"), str):
+            parameters["schedules"].append(node["schedule"])
+        if isinstance(node.get("selector"), dict) and node["selector"].get("labelSelectors"):
+            parameters["label_selectors"].append(node["selector"]["labelSelectors"])
+
+    _walk(experiment.get("spec", {}), visit)
+    return parameters
+
+
+def get_cluster_snapshot() -> dict:
+    """
+    Returns the settings (config.env) and the current kube context
+    """
+    cluster = current_cluster.get()
+    if cluster is not None:
+        # current-context ignores --context, it is the context of the worker
+        snapshot = {"kube_context": cluster.context, "cluster": cluster._asdict()}
+    else:
+        result = timed_run("kubectl config current-context", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        snapshot = {"kube_context": result.stdout.decode("utf-8").strip() if result.returncode == 0 else None}
+    snapshot["settings"] = {name: value for name, value in settings.load().items()}
+    return snapshot
+
+
+def start_run_manifest(logfile_path: str, yaml_file: str, run_number: int = 1, companion_yaml_file: str = None,
+                       cleanup_strategy: str = None) -> dict:
+    """
+    Writes the experiment and config part of the manifest, right after the log file was created
+    """
+    experiment = {
+        "name": os.path.splitext(os.path.basename(yaml_file))[0],
+        "yaml_file": yaml_file,
+        "yaml_sha256": hash_file(yaml_file),
+        "parameters": get_experiment_parameters(yaml_file),
+        "cleanup_strategy": cleanup_strategy,
+        "run_number": run_number,
+        "companion": None,
+    }
+    if companion_yaml_file is not None:
+        experiment["companion"] = {
+            "yaml_file": companion_yaml_file,
+            "yaml_sha256": hash_file(companion_yaml_file),
+            "parameters": get_experiment_parameters(companion_yaml_file),
+        }
+
+    manifest = {
+        "manifest_version": MANIFEST_VERSION,
+        "log_file": os.path.basename(logfile_path),
+        "experiment": experiment,
+        "config": get_cluster_snapshot(),
+        "timings": {"started_at": time.time()},
+    }
+    update_run_metadata(logfile_path, manifest)
+    return manifest
+
+
+def detect_events(logfile_path: str, prominence: float = 50) -> list[dict]:
+    """
+    Detects the chaos events of a log the same way the notebook does
+
+    Returns:
+    list[dict]: start, end (unix timestamps) and recovery_time (seconds) of every chaos event
+    """
+    # pandas and scipy are only needed here, not while the run is going
+    from chaos_lib_utils.reporting import read_csv, identify_chaos_around_maxima, find_number_of_chaos_groups, compute_td
+
+    df = read_csv(logfile_path)
+    if len(df) < 3:
+        return []
+    df = identify_chaos_around_maxima(df, 'Value', prominence=prominence)
+    _, chaos_groups = find_number_of_chaos_groups(df)
+    return [{"start": float(df["Time"].iloc[start]), "end": float(df["Time"].iloc[end]),
+             "recovery_time": float(compute_td(df, start, end))} for start, end in chaos_groups]
+
+
+def finish_run_manifest(logfile_path: str, status: str, timings: dict, detect: bool = True) -> dict:
+    """
+    Adds the timings, the status and the detected chaos events to the manifest
+
+    Parameters:
+    logfile_path: str: The log of the run
+    status: str: Status of the run (completed, incomplete)
+    timings: dict: Timestamps of the run (e.g. chaos_applied_at, monitoring_start_time)
+    detect: bool: Measure (or detect) the chaos events of the run
+
+    Returns:
+    dict: The entries that were added
+    """
+    entries = {
+        "status": status,
+        "timings": {**load_run_metadata(logfile_path).get("timings", {}), **timings, "finished_at": time.time()},
+    }
+    if detect:
+        try:
+            from chaos_lib_utils.injection_timeline import measure_run_events
+
+            # Measured from the recorded injections if there are any, the peak detection is the fallback
+            entries["events"] = measure_run_events(logfile_path)
+            entries["event_source"] = "injection_timeline"
+            if entries["events"] is None:
+                entries["events"] = detect_events(logfile_path)
+                entries["event_source"] = "peaks"
+        except Exception as e:
+            # A broken log should not fail the run, the events can be detected later on
+            print(f"Could not detect the chaos events of {logfile_path}: {e}")
+            entries["events"] = None
+    update_run_metadata(logfile_path, entries)
+    return entries
@@ -0,0 +1,153 @@
+"""
+This module runs chaos experiments. It is the single implementation behind the CLI and the overnight runners,
+so every entry point gets the same cleanup, monitoring and fetching.
+
+A run consists of:
+1. Making sure prometheus is healthy and scrapes often enough
+2. Deleting running chaos tests and resetting the deployments, so we get a clean start (see cleanup_strategies.py)
+3. Waiting until the lag is steady (steady_state.py), the baseline is stored in the run manifest
+4. Applying the chaos test (at a good time if it has a cron schedule)
+5. Fetching the logs from prometheus in an interval until all runs of the chaos test are over
+6. Completing the run manifest (run_manifest.py) and adding the run to the catalogue (catalogue.py)
+The phases are asyncio tasks of the orchestrator (orchestrator.py), these functions run them to completion.
+
+The module contains the following functions:
+- find_experiments: Resolves experiment names / globs to yaml files (compiling jsonnet templates on the way)
+- generate_latency_experiments: Creates a network delay experiment per latency from a template
+- run_experiment: Runs a single experiment and writes its log
+- run_sweep: Runs several experiments several times, repeating runs that did not complete
+  (all experiments are validated first, see manifest_validation.py), on several clusters if CLUSTER_CONTEXTS is set
+"""
+import asyncio
+import fnmatch
+import os
+import re
+
+from chaos_lib_utils.constants import NUMBER_OF_RUNS, YAML_FOLDER, JSONNET_FOLDER, CLUSTER_CONTEXTS
+from chaos_lib_utils.parser import compile_jsonnet_file
+from chaos_lib_utils.manifest_validation import validate_before_sweep
+from chaos_lib_utils.cluster_pool import Cluster, parse_clusters, use_cluster
+from chaos_lib_utils.orchestrator import run_experiment_async, run_sweep_async
+
+
+def find_experiments(patterns: list[str], yaml_folder: str = YAML_FOLDER, jsonnet_folder: str = JSONNET_FOLDER,
+                     compile_templates: bool = True) -> list[str]:
+    """
+    Resolves experiment names, globs or paths to yaml files.
+    Patterns are matched against the file names in the yaml and jsonnet folder, with or without extension
+    (e.g. "single_*", "pod_failure.jsonnet", "experiments/single_100.yaml").
+    Matching jsonnet templates are compiled, templates win over yaml files with the same name.
+
+    Parameters:
+    patterns: list[str]: Names, globs or paths
+    yaml_folder: str: Folder with the yaml files
+    jsonnet_folder: str: Folder with the jsonnet templates
+    compile_templates: bool: Compile matching jsonnet templates to yaml
+
+    Returns:
+    list[str]: Sorted paths of the yaml files
+    """
+    yaml_folder = os.path.join(os.getcwd(), yaml_folder)
+    jsonnet_folder = os.path.join(os.getcwd(), jsonnet_folder)
+    yaml_names = [f for f in os.listdir(yaml_folder) if f.endswith('.yaml')]
+    jsonnet_names = [f for f in os.listdir(jsonnet_folder) if f.endswith('.jsonnet')] if os.path.isdir(jsonnet_folder) else []
+
+    def matches(file_name: str, pattern: str) -> bool:
+        pattern = os.path.basename(pattern)
+        stem = os.path.splitext(file_name)[0]
+        return fnmatch.fnmatch(file_name, pattern) or fnmatch.fnmatch(stem, pattern)
+
+    experiments = {}
+    for pattern in patterns:
+        for f in yaml_names:
+            if matches(f, pattern):
+                experiments.setdefault(os.path.splitext(f)[0], os.path.join(yaml_folder, f))
+        for f in jsonnet_names:
+            if matches(f, pattern):
+                template = os.path.join(jsonnet_folder, f)
+                experiments[os.path.splitext(f)[0]] = compile_jsonnet_file(template, yaml_folder) if compile_templates else template
+
+    return [experiments[name] for name in sorted(experiments)]
+
+
+def generate_latency_experiments(template_yaml: str, latencies: list[int], yaml_folder: str = YAML_FOLDER) -> list[str]:
+    """
+    Creates a network delay experiment per latency from a template.
+    The file for a latency is called single_{latency}.yaml, an existing file is replaced.
+
+    Parameters:
+    template_yaml: str: The network delay template (e.g. experiments/single_delay.yaml)
+    latencies: list[int]: Latencies in milliseconds
+    yaml_folder: str: Folder to write the experiments to
+
+    Returns:
+    list[str]: Paths of the experiments, in the order of the latencies
+    """
+    with open(template_yaml, 'r') as f:
+        template = f.read()
+
+    yaml_files = []
+    for latency in latencies:
+        # replace network-delay with network-delay-{latency}ms
+        content = re.sub(r"name: network-delay\b", f"name: network-delay-{latency}ms", template)
+        # Replace "latency: '20ms' -> latency: '{latency}ms'"
+        content = re.sub(r"latency: '?\d+ms'?", f"latency: '{latency}ms'", content)
+
+        yaml_file = os.path.join(os.getcwd(), yaml_folder, f"single_{latency}.yaml")
+        with open(yaml_file, 'w') as f:
+            f.write(content)
+        yaml_files.append(yaml_file)
+    return yaml_files
+
+
+def run_experiment(yaml_file: str, run_number: int = 1, companion_yaml_file: str = None, check_prometheus: bool = True,
+                   timeout: float = None, load_rate: float = None) -> dict:
+    """
+    Runs a single chaos experiment and writes its log to the log folder (see orchestrator.run_experiment_async).
+
+    Parameters:
+    yaml_file: str: The chaos test to run, the log file is named after it
+    run_number: int: Number of this run (only used for printing)
+    companion_yaml_file: str: Optional scheduled chaos test, that is applied at a good time after yaml_file was applied
+    -> e.g. a pod failure while the network delay of yaml_file is active
+    check_prometheus: bool: Repair prometheus if it is not healthy (see prometheus_watchdog.py)
+    timeout: float: Seconds after which the monitoring is stopped (status timeout), None waits for all runs
+    load_rate: float: Input rate of a load sweep, the run waits until it is reached (see load_sweep.py)
+
+    Returns:
+    dict: "logfile_path" and "status" (completed, incomplete, timeout)
+    """
+    return asyncio.run(run_experiment_async(yaml_file, run_number, companion_yaml_file, check_prometheus, timeout,
+                                            load_rate=load_rate))
+
+
+def run_sweep(yaml_files: list[str], number_of_runs: int = NUMBER_OF_RUNS, companion_yaml_file: str = None,
+              check_prometheus: bool = True, max_repeats: int = 3, validate: bool = True, timeout: float = None,
+              concurrency: int = 1, clusters: list[Cluster] = None) -> list[dict]:
+    """
+    Runs every experiment number_of_runs times.
+    Runs that did not complete are repeated at the end (at most max_repeats times per experiment).
+
+    Parameters:
+    yaml_files: list[str]: The experiments, in the order they should run
+    number_of_runs: int: Runs per experiment
+    companion_yaml_file: str: Scheduled chaos test applied with every experiment (see run_experiment)
+    check_prometheus: bool: Watch prometheus during the sweep and repair it if it is not healthy
+    max_repeats: int: How often the runs of an experiment may be repeated
+    validate: bool: Validate all experiments (schema and selectors) before the first run, raises if one is invalid
+    timeout: float: Timeout of a single run
+    concurrency: int: Runs at the same time, only use > 1 with separate clusters
+    clusters: list[Cluster]: Clusters to run on, one run at a time per cluster (defaults to CLUSTER_CONTEXTS, see cluster_pool.py)
+
+    Returns:
+    list[dict]: The results of all runs (see run_experiment), with the cluster of the run
+    """
+    if clusters is None and CLUSTER_CONTEXTS:
+        clusters = parse_clusters(CLUSTER_CONTEXTS)
+    if validate:
+        # the selectors are checked against the pods of every cluster
+        for cluster in clusters or [None]:
+            with use_cluster(cluster):
+                validate_before_sweep(yaml_files + [companion_yaml_file])
+    return asyncio.run(run_sweep_async(yaml_files, number_of_runs, companion_yaml_file, check_prometheus, max_repeats, timeout, concurrency,
+                                       clusters))
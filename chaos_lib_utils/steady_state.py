@@ -0,0 +1,149 @@
+"""
+This module holds the steady state gate, that is passed before a chaos test is applied.
+
+After the deployments were reset the heuristics miner still drains the backlog of the restart.
+Injecting chaos right away starts the run with a peak that is counted as a chaos event.
+The gate watches the lag and releases the experiment once the mean and the standard deviation of the lag
+over the last STEADY_STATE_WINDOW_SECONDS are inside the configured bounds, or gives up after
+STEADY_STATE_TIMEOUT_SECONDS.
+
+The module contains the following functions:
+- window_stats: Mean, standard deviation and trend of a window of samples
+- is_steady: Checks the stats of a window against the bounds
+- poll_window: Polls the last window of a query until its stats fulfil a predicate (or the timeout is reached)
+- wait_for_steady_state: Polls prometheus until the lag is steady (or the timeout is reached)
+"""
+import time
+
+import numpy as np
+
+from chaos_lib_utils.constants import (PROMETHEUS_URL, TIME_GRANULARITY, STEADY_STATE_WINDOW_SECONDS, STEADY_STATE_MAX_MEAN,
+                                       STEADY_STATE_MAX_STD, STEADY_STATE_TIMEOUT_SECONDS, STEADY_STATE_POLL_SECONDS)
+from chaos_lib_utils.fetch_client import get_prometheus_client, FetchError
+from chaos_lib_utils.prometheus_utils import get_metric_queries
+from chaos_lib_utils.instrumentation import instrumented, sleep
+
+
+def window_stats(values: np.ndarray, times: np.ndarray = None) -> dict:
+    """
+    Returns the statistics of a window of samples
+
+    Parameters:
+    values: np.ndarray: The samples
+    times: np.ndarray: Timestamps of the samples, used for the trend (per second)
+
+    Returns:
+    dict: samples, mean, std, min, max and slope (least squares, lag per second)
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {"samples": 0, "mean": None, "std": None, "min": None, "max": None, "slope": None}
+    if times is None:
+        times = np.arange(len(values), dtype=float)
+    times = np.asarray(times, dtype=float)
+    slope = float(np.polyfit(times - times[0], values, 1)[0]) if len(values) > 1 else 0.0
+    return {
+        "samples": int(len(values)),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "slope": slope,
+    }
+
+
+def is_steady(stats: dict, max_mean: float = STEADY_STATE_MAX_MEAN, max_std: float = STEADY_STATE_MAX_STD,
+              min_samples: int = 2) -> bool:
+    """
+    Returns True if the window has enough samples and its mean and standard deviation are inside the bounds
+    """
+    if stats["samples"] < min_samples:
+        return False
+    return stats["mean"] <= max_mean and stats["std"] <= max_std
+
+
+def poll_window(predicate, query: str, data_source_url: str = PROMETHEUS_URL, window_seconds: float = STEADY_STATE_WINDOW_SECONDS,
+                timeout: float = STEADY_STATE_TIMEOUT_SECONDS, poll_interval: float = STEADY_STATE_POLL_SECONDS,
+                time_granularity: float = TIME_GRANULARITY, progress=None, poll_phase: str = "steady_state_poll") -> dict:
+    """
+    Fetches the last window_seconds of a query every poll_interval until predicate(stats) is True.
+    A failed fetch counts as a check that did not pass.
+
+    Parameters:
+    predicate: Function (stats of the window, see window_stats) -> bool, only called for windows with enough samples
+    query: str: The query to watch, the first series of the result is used
+    data_source_url: str: URL of prometheus
+    window_seconds: float: Length of the sliding window
+    timeout: float: Give up after this many seconds
+    poll_interval: float: Seconds between two checks
+    time_granularity: float: Step of the samples in seconds
+    progress: Function (stats) -> str, printed after every check that did not pass
+    poll_phase: str: Name of the sleeps in the instrumentation
+
+    Returns:
+    dict: "passed" (False if the timeout was reached), "waited_seconds", "checks" and the stats of the last window
+    """
+    client = get_prometheus_client(data_source_url)
+    # A window needs at least half of its samples, so a window right after a restart (no data yet) does not pass
+    min_samples = max(2, int(window_seconds / time_granularity / 2))
+
+    started = time.time()
+    checks = 0
+    stats = window_stats([])
+    passed = False
+    while True:
+        now = time.time()
+        checks += 1
+        try:
+            data = client.query_range(query, now - window_seconds, now, time_granularity)
+        except FetchError as e:
+            print(f"Could not fetch {query}: {e}")
+            data = None
+        if data:
+            samples = np.array(data[0]["values"], dtype=float)
+            stats = window_stats(samples[:, 1], samples[:, 0])
+            passed = stats["samples"] >= min_samples and predicate(stats)
+
+        if passed or time.time() - started + poll_interval > timeout:
+            break
+        if progress is not None:
+            print(progress(stats))
+        sleep(poll_interval, poll_phase)
+
+    return {"passed": passed, "waited_seconds": time.time() - started, "checks": checks, **stats}
+
+
+@instrumented
+def wait_for_steady_state(data_source_url: str = PROMETHEUS_URL, query: str = None, window_seconds: float = STEADY_STATE_WINDOW_SECONDS,
+                          max_mean: float = STEADY_STATE_MAX_MEAN, max_std: float = STEADY_STATE_MAX_STD,
+                          timeout: float = STEADY_STATE_TIMEOUT_SECONDS, poll_interval: float = STEADY_STATE_POLL_SECONDS,
+                          time_granularity: float = TIME_GRANULARITY) -> dict:
+    """
+    Waits until the lag is steady, checking the last window_seconds every poll_interval.
+
+    Parameters:
+    data_source_url: str: URL of prometheus
+    query: str: The query to watch (defaults to the first metric of get_metric_queries, the input topic lag)
+    window_seconds: float: Length of the sliding window
+    max_mean: float: Upper bound for the mean of the window
+    max_std: float: Upper bound for the standard deviation of the window
+    timeout: float: Give up after this many seconds
+    poll_interval: float: Seconds between two checks
+    time_granularity: float: Step of the samples in seconds
+
+    Returns:
+    dict: The baseline, with "steady" (False if the timeout was reached), "waited_seconds", "checks",
+    the bounds and the stats of the last window (see window_stats)
+    """
+    if query is None:
+        query = get_metric_queries()[0][1]
+    result = poll_window(lambda stats: is_steady(stats, max_mean, max_std), query, data_source_url, window_seconds, timeout,
+                         poll_interval, time_granularity,
+                         progress=lambda stats: f"Waiting for a steady state: mean {stats['mean']}, std {stats['std']} (bounds {max_mean}, {max_std})")
+    steady = result.pop("passed")
+
+    if steady:
+        print(f"Steady state reached after {result['waited_seconds']:.0f}s: mean {result['mean']:.1f}, std {result['std']:.1f}")
+    else:
+        print(f"No steady state after {result['waited_seconds']:.0f}s, continuing anyway")
+    return {"steady": steady, "window_seconds": window_seconds, "max_mean": max_mean, "max_std": max_std, **result}
@@ -0,0 +1,150 @@
+"""
+This module generates synthetic consumer group lag series that look like the ones we record during chaos tests.
+They are used to exercise the monitoring and analysis code without a running cluster.
+
+A fault makes the lag grow with the input rate (the miner stops consuming), after the fault the backlog is
+drained with the drain rate until the lag is back at the baseline. This is the shape we see in experiments/runs.
+
+The module contains the following functions:
+- lag_profile: Lag values for arbitrary timestamps and known fault start times
+- periodic_fault_starts: Fault start times for a fault that is repeated in a fixed period (like a cron schedule)
+- generate_lag_series: A full run with known fault windows (ground truth)
+- generate_runs: Several runs in the dataframe format returned by reporting.read_csv
+- write_log_file: Write a run in the csv log format used by get_logs
+"""
+import numpy as np
+import pandas as pd
+
+DEFAULT_METRIC_NAME = "Lag_Input_Topic"
+
+
+def _hash_noise(times: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    Deterministic noise in [-1, 1] for a timestamp.
+    The same timestamp always yields the same value, so a server can answer overlapping windows consistently.
+    """
+    x = np.sin((np.asarray(times, dtype=np.float64) + seed * 7919.0) * 12.9898) * 43758.5453
+    return (x - np.floor(x)) * 2 - 1
+
+
+def lag_profile(times: np.ndarray, fault_starts: list[float], fault_duration: float = 30, input_rate: float = 5000,
+                drain_rate: float = 2500, baseline: float = 300, noise: float = 50, warmup_backlog: float = 0,
+                seed: int = 0) -> np.ndarray:
+    """
+    Computes the lag for each timestamp given the start times of all faults.
+
+    Parameters:
+    times: np.ndarray: Unix timestamps (or seconds) to compute the lag for
+    fault_starts: list[float]: Start time of every fault
+    fault_duration: float: Duration of a single fault in seconds
+    input_rate: float: Messages per second that pile up while the fault is active
+    drain_rate: float: Messages per second the miner catches up after the fault
+    baseline: float: Lag without any fault
+    noise: float: Amplitude of the noise added to the baseline
+    warmup_backlog: float: Backlog at times[0] that is drained first (e.g. after re-creating the deployments)
+    seed: int: Seed of the noise
+
+    Returns:
+    np.ndarray: The lag for every timestamp (never negative)
+    """
+    times = np.asarray(times, dtype=np.float64)
+    lag = baseline + noise * _hash_noise(times, seed)
+
+    peak = input_rate * fault_duration
+    for start in fault_starts:
+        elapsed = times - start
+        rising = (elapsed >= 0) & (elapsed < fault_duration)
+        draining = elapsed >= fault_duration
+        lag[rising] += input_rate * elapsed[rising]
+        lag[draining] += np.maximum(0.0, peak - drain_rate * (elapsed[draining] - fault_duration))
+
+    if warmup_backlog > 0 and len(times) > 0:
+        lag += np.maximum(0.0, warmup_backlog - drain_rate * (times - times[0]))
+
+    return np.maximum(lag, 0.0).round()
+
+
+def periodic_fault_starts(start_time: float, end_time: float, period: float, offset: float = 0) -> list[float]:
+    """
+    Returns the start times of a fault repeated every period seconds in [start_time, end_time].
+    The faults are aligned to multiples of the period (plus offset), the same way a cron schedule would be.
+    A fault that started before start_time is included, since its drain can still be visible.
+    """
+    first = np.floor((start_time - offset) / period) * period + offset
+    if first > start_time:
+        first -= period
+    return list(np.arange(first, end_time + period, period))
+
+
+def generate_lag_series(num_samples: int, step: float = 1.0, start_time: float = 0.0, num_faults: int = 3,
+                        fault_duration: float = 30, input_rate: float = 5000, drain_rate: float = 2500,
+                        baseline: float = 300, noise: float = 50, warmup_backlog: float = 0,
+                        seed: int = 0) -> tuple[np.ndarray, np.ndarray, list[list[int]]]:
+    """
+    Generates a single run with evenly spaced faults and returns the fault windows as ground truth.
+
+    Parameters:
+    num_samples: int: Number of samples of the run
+    step: float: Seconds between two samples (TIME_GRANULARITY)
+    start_time: float: Timestamp of the first sample
+    num_faults: int: Number of faults that are injected, evenly spaced over the run
+    (the other parameters are passed to lag_profile)
+
+    Returns:
+    times: np.ndarray: The timestamps
+    values: np.ndarray: The lag values
+    fault_windows: list[list[int]]: [start, end] indices of every fault including the drain of the backlog,
+    the same format find_number_of_chaos_groups returns
+    """
+    times = start_time + np.arange(num_samples, dtype=np.float64) * step
+    duration = num_samples * step
+    recovery = fault_duration + input_rate * fault_duration / drain_rate
+
+    fault_starts = []
+    if num_faults > 0:
+        spacing = duration / num_faults
+        # Place the fault in the first part of its slot, so the drain fits before the next fault
+        fault_starts = [start_time + i * spacing + spacing * 0.25 for i in range(num_faults)]
+
+    values = lag_profile(times, fault_starts, fault_duration, input_rate, drain_rate, baseline, noise,
+                         warmup_backlog, seed)
+
+    fault_windows = []
+    for start in fault_starts:
+        start_index = int(np.searchsorted(times, start))
+        end_index = int(np.searchsorted(times, start + recovery)) - 1
+        if start_index < num_samples:
+            fault_windows.append([start_index, min(end_index, num_samples - 1)])
+
+    return times, values, fault_windows
+
+
+def generate_runs(num_runs: int, num_samples: int, seed: int = 0, **kwargs) -> list[pd.DataFrame]:
+    """
+    Generates several runs with slightly shifted faults in the format of reporting.read_csv
+
+    Parameters:
+    num_runs: int: Number of runs to generate
+    num_samples: int: Number of samples per run
+    seed: int: Seed for the noise and the shift of the runs
+    kwargs: Passed to generate_lag_series
+
+    Returns:
+    list[pd.DataFrame]: Dataframes with the columns Metric, Time and Value
+    """
+    rng = np.random.default_rng(seed)
+    runs = []
+    for i in range(num_runs):
+        start_time = 1734616088.0 + float(rng.integers(0, 60))
+        times, values, _ = generate_lag_series(num_samples, start_time=start_time, seed=seed + i, **kwargs)
+        runs.append(pd.DataFrame({"Metric": DEFAULT_METRIC_NAME, "Time": times, "Value": values.astype(np.int64)}))
+    return runs
+
+
+def write_log_file(path: str, times: np.ndarray, values: np.ndarray, metric: str = DEFAULT_METRIC_NAME) -> None:
+    """
+    Writes a run to path, in the same csv format get_logs produces
+    """
+    with open(path, "w") as f:
+        f.write("Metric,Time,Value\n")
+        f.writelines(f"{metric},{t:.3f},{int(v)}\n" for t, v in zip(times, values))
@@ -17,138 +17,533 @@ This script has three main tasks:
     From the data logged during tests:
     - generate a report
     - generate plots
-"""
 
+Without arguments the CLI asks which experiment to run (interactive mode).
+For scripting, use the subcommands (python3 chaos_wizard_cli.py <command> --help for all options):
+    compile   Compile jsonnet templates to yaml
+    validate  Check experiments against the chaos mesh schemas and the labels in the cluster
+    run       Run one or more experiments
+    sweep     Run all matching experiments several times (what the overnight runners do), also on several clusters at once
+    load-sweep Run an experiment at several input rates of the load generator, reports the maximum sustainable throughput
+    fetch     Fetch logs for a time range from prometheus
+    export    Replace the lag of a log with the exact samples from the prometheus remote read endpoint
+    analyze   Compute the recovery times of all logs
+    aggregate Recovery time per latency with bootstrap confidence intervals and a regression
+    compare   Compare two sweeps (folders or catalogue queries), exits with 1 if the candidate regressed
+    render    Plot all runs headless into a PDF or PNG files
+    catalogue Query the index of all runs (latency, start time, status, ...)
+    bench     Run a benchmark from /benchmarks
+
+All commands that run experiments share chaos_lib_utils/runner.py
+"""
+import argparse
 import os
-from chaos_lib_utils.parser import convert_jsonnet_single_to_yaml, convert_jsonnet_workflow_to_yaml, parse_all_jsonnet_files
-from chaos_lib_utils.clean_run import cleanup_containers, delete_running_chaos_tests, wait_for_pods_ready
-from chaos_lib_utils.prometheus_utils import get_logs, adjust_prometheus_fetch_interval
-from chaos_lib_utils.file_utils import get_log_path
-from chaos_lib_utils.chaos_logging import monitor_chaos_tests, apply_chaos_tests_at_good_time
-from chaos_lib_utils.constants import OFFSET_IN_SECONDS, DATA_FETCH_INTERVAL_SECONDS, logfile_path, monitoring_start_time, JSONNET_FOLDER, YAML_FOLDER
-import dotenv   
-import time
-import threading
-from datetime import datetime
+import sys
 
+from chaos_lib_utils.constants import JSONNET_FOLDER, YAML_FOLDER, LOG_FOLDER, NUMBER_OF_RUNS
 
-"""
-1. Loading expermient files & cleaning up old files
+# Heavy modules (kubectl helpers, requests, pandas) are imported by the commands that need them,
+# so the menu and --help show up right away.
 
-The user will be presented with a list of available experiments to choose from.
-The user can either select a jsonnet file to compile a yaml file from (via the jsonnet templates)
-or just use the chaos dashboard to define tests and inject the corresponding yaml file.
 
-The system will then detect the needed options and make sure there is a yaml file to run the tests from.
-HOWEVER a naming issue can arise if the user has a yaml file with the same name as a jsonnet file containing different tests.!
-"""
-# Parse all Jsonnet files to yaml before running anything
-parse_all_jsonnet_files(JSONNET_FOLDER, YAML_FOLDER)
-
-
-yaml_folder = os.path.join(os.getcwd(), YAML_FOLDER)
-yaml_files = [f for f in os.listdir(yaml_folder) if f.endswith('.yaml')]
-# Provide options to the user, make him select a file
-print("Available experiments:")
-for i, f in enumerate(yaml_files):
-    print(f'({i}): {f}')
-
-selected_file = input("Select a file: ")
-try:
-    yaml_file = os.path.join(yaml_folder, yaml_files[int(selected_file)])
-except:
-    print("Invalid selection")
-    exit(1)
-    
-# Before each run we make sure, that no chaos tests are running in 
-# Ask the user if they want to run the chaos tests
-# Print the yaml file to the user
-print("Chaos test yaml file:")
-print("-"*20)
-with open(yaml_file, 'r') as f:
-    print(f.read())
-print("-"*20,"\n",)
-run_tests = input("Run tests? (y/n): ")
-"""
-2. Running the chaos tests & getting data
+def interactive() -> int:
+    """
+    1. Loading expermient files
 
-First the user will see the yaml file he is about to run.
-Then he will be asked if he wants to run the tests!
+    The user will be presented with a list of available experiments to choose from.
+    The user can either select a jsonnet file to compile a yaml file from (via the jsonnet templates)
+    or just use the chaos dashboard to define tests and inject the corresponding yaml file.
+    Jsonnet templates are only compiled once they are selected, templates win over yaml files with the same name.
 
-Before actually running the tests, metrics are 
+    2. Running the chaos tests & getting data
 
-If the user selects he wants to run the chaos test, a few setup steps are done:
-a) Before each delete all chaos tests running in the cluster (name specified in the config.env file)
-b) Delete the specified containers in the config.env file so that we get a clean start
--> Depending on your kubernetes setup they will be re-created automatically
-NOTE: My code assumes automatic re-creation 
+    First the user will see the yaml file he is about to run.
+    Then he will be asked if he wants to run the tests!
+    The run itself is done by runner.run_experiment
+    """
+    from chaos_lib_utils.parser import compile_jsonnet_file
 
+    # Experiment name -> jsonnet template (None if there is only a yaml file)
+    yaml_folder = os.path.join(os.getcwd(), YAML_FOLDER)
+    jsonnet_folder = os.path.join(os.getcwd(), JSONNET_FOLDER)
+    experiments = {f[:-len('.yaml')]: None for f in os.listdir(yaml_folder) if f.endswith('.yaml')}
+    experiments.update({f[:-len('.jsonnet')]: os.path.join(jsonnet_folder, f) for f in os.listdir(jsonnet_folder) if f.endswith('.jsonnet')})
+    experiment_names = sorted(experiments)
 
-"""
-if run_tests.lower() == 'y':
+    # Provide options to the user, make him select a file
+    print("Available experiments:")
+    for i, name in enumerate(experiment_names):
+        source = "jsonnet" if experiments[name] else "yaml"
+        print(f'({i}): {name} ({source})')
+
+    selected_file = input("Select a file: ")
+    try:
+        selected_name = experiment_names[int(selected_file)]
+    except (ValueError, IndexError):
+        print("Invalid selection")
+        return 1
+
+    if experiments[selected_name] is not None:
+        yaml_file = compile_jsonnet_file(experiments[selected_name], YAML_FOLDER)
+    else:
+        yaml_file = os.path.join(yaml_folder, f"{selected_name}.yaml")
+
+    # Print the yaml file to the user
+    print("Chaos test yaml file:")
+    print("-"*20)
+    with open(yaml_file, 'r') as f:
+        print(f.read())
+    print("-"*20,"\n",)
+    run_tests = input("Run tests? (y/n): ")
+    if run_tests.lower() != 'y':
+        print("Chaos tests not started")
+        return 0
+
+    from chaos_lib_utils.runner import run_experiment
     print("Starting soon, doing some cleanup first")
-    
-    # Adjust the prometheus fetch interval, so we get more data points
-    adjust_prometheus_fetch_interval()
-    
-    # Delete all chaos thests running in the cluster
-    print("Deleting running chaos tests")
-    delete_running_chaos_tests()
-    # Cleanup containers for a clean start
-    print("Deleting an re-creating Pods so we get a clean start")
-    cleanup_containers()
-    wait_for_pods_ready()
-    print("All pods are ready, starting chaos tests, and monitoring")
-
-    # Get a name for the logfile and initialize with headers (csv)
-    logfile_path = get_log_path(yaml_file)
-    with open(logfile_path, 'w') as f:
-        f.write("Metric,Time,Value\n")
-
-
-
-    # Apply the chaos tests, dpending on wether we have a cron schedule or not
-    apply_chaos_tests_at_good_time(yaml_file)
-    
-    # Mark a start and run our offset for chaos tests
-    monitoring_start_time = time.time()
-    time.sleep(OFFSET_IN_SECONDS)
-    
-else:
-    print("Chaos tests not started")
-    exit(0)
+    result = run_experiment(yaml_file, check_prometheus=False)
+    return 0 if result["status"] == "completed" else 1
 
-"""
-3. Monitoring the chaos tests and injecting re-runs
 
-The programm will spawn a thread, that will monitor time and re-start the chaos tests if there is more than one run
-The thread will terminate after everything has run correclty.
+def compile_command(args) -> int:
+    from concurrent.futures import ThreadPoolExecutor
+    from chaos_lib_utils.parser import compile_jsonnet_file
 
-The main thread will get logs in a set interval from prometheus or any other logging system configured 
-(NOTE: prometheus is the standard, you would neet to define your own RestAPI)
-and generate a report and plots from the data.
-"""
-stop_signal = threading.Event()
-monitor_thread = threading.Thread(target=monitor_chaos_tests, args=(yaml_file, stop_signal))
-monitor_thread.start()
+    jsonnet_folder = os.path.join(os.getcwd(), JSONNET_FOLDER)
+    templates = [os.path.join(jsonnet_folder, f) for f in sorted(os.listdir(jsonnet_folder)) if f.endswith('.jsonnet')]
+    if args.experiments:
+        from fnmatch import fnmatch
+        templates = [t for t in templates if any(fnmatch(os.path.basename(t), p) or fnmatch(os.path.basename(t)[:-len('.jsonnet')], p) for p in args.experiments)]
+
+    # --ext-str name=value, available in the templates as std.extVar('name')
+    ext_vars = dict(ext_var.split("=", 1) for ext_var in args.ext_str)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for yaml_file in executor.map(lambda t: compile_jsonnet_file(t, YAML_FOLDER, ext_vars), templates):
+            print(f"Compiled {yaml_file}")
+    return 0
+
+
+def validate_command(args) -> int:
+    from chaos_lib_utils.runner import find_experiments
+    from chaos_lib_utils.manifest_validation import validate_manifests
+
+    yaml_files = find_experiments(args.experiments or ["*"])
+    results = validate_manifests(yaml_files, check_cluster=not args.offline, workers=args.concurrency)
+    for yaml_file, errors in results.items():
+        print(f"{'OK     ' if not errors else 'INVALID'} {yaml_file}")
+        for error in errors:
+            print(f"    {error}")
+    invalid = sum(1 for errors in results.values() if errors)
+    print(f"{len(results) - invalid} of {len(results)} experiments are valid")
+    return 0 if invalid == 0 else 1
+
+
+def run_command(args) -> int:
+    from chaos_lib_utils.runner import find_experiments, run_sweep
+
+    yaml_files = find_experiments(args.experiments)
+    if len(yaml_files) == 0:
+        print(f"No experiments match {args.experiments}")
+        return 1
+    if not args.yes:
+        print("Experiments to run:")
+        for yaml_file in yaml_files:
+            print(f"- {yaml_file}")
+        if input(f"Run {args.runs} time(s) each? (y/n): ").lower() != 'y':
+            print("Chaos tests not started")
+            return 0
+
+    results = run_sweep(yaml_files, args.runs, check_prometheus=args.check_prometheus, max_repeats=0, validate=args.validate,
+                        timeout=args.timeout)
+    return 0 if all(r["status"] == "completed" for r in results) else 1
+
+
+def sweep_command(args) -> int:
+    from chaos_lib_utils.runner import find_experiments, generate_latency_experiments, run_sweep
+
+    if args.latencies:
+        yaml_files = generate_latency_experiments(args.template, args.latencies)
+    else:
+        yaml_files = find_experiments(args.experiments or ["*"])
+        # make sure the pod_chaos is first in the list
+        yaml_files = sorted(yaml_files, key=lambda x: "pod_failure" in x)
+    if len(yaml_files) == 0:
+        print("No experiments to run")
+        return 1
+
+    clusters = None
+    if args.clusters:
+        from chaos_lib_utils.cluster_pool import parse_clusters
+        clusters = parse_clusters(args.clusters)
+
+    results = run_sweep(yaml_files, args.runs, companion_yaml_file=args.companion, check_prometheus=args.check_prometheus,
+                        validate=args.validate, timeout=args.timeout, clusters=clusters)
+    completed = sum(1 for r in results if r["status"] == "completed")
+    print(f"Sweep finished, {completed} of {len(results)} runs completed")
+    return 0 if completed == len(results) else 1
+
+
+def load_sweep_command(args) -> int:
+    from chaos_lib_utils.constants import LOAD_MAX_RECOVERY_SECONDS
+    from chaos_lib_utils.load_sweep import run_load_sweep, summarize_load_sweep, format_load_summary
+
+    if args.summarize:
+        log_files = resolve_runs(args.summarize)
+    else:
+        from chaos_lib_utils.runner import find_experiments
+        from chaos_lib_utils.manifest_validation import validate_before_sweep
+
+        if args.experiment is None:
+            print("Give an experiment to run, or --summarize to summarize runs")
+            return 1
+        yaml_files = find_experiments([args.experiment])
+        if len(yaml_files) != 1:
+            print(f"{args.experiment} has to match exactly one experiment, it matches {len(yaml_files)}")
+            return 1
+        if not args.rates:
+            print("No load levels given (--rates)")
+            return 1
+        if args.validate:
+            validate_before_sweep(yaml_files + [args.companion])
+        results = run_load_sweep(yaml_files[0], args.rates, args.runs, companion_yaml_file=args.companion,
+                                 check_prometheus=args.check_prometheus, timeout=args.timeout)
+        log_files = [r["logfile_path"] for r in results if r["logfile_path"] is not None]
+
+    max_recovery = LOAD_MAX_RECOVERY_SECONDS if args.max_recovery is None else args.max_recovery
+    summary = summarize_load_sweep(log_files, max_recovery)
+    if summary["levels"].empty:
+        print("No runs of a load sweep found")
+        return 2
+    print(format_load_summary(summary))
+    if args.output:
+        summary["levels"].to_csv(args.output)
+    return 0
+
+
+def fetch_command(args) -> int:
+    import time
+    from chaos_lib_utils.constants import PROMETHEUS_URL
+    from chaos_lib_utils.file_utils import get_log_path
+    from chaos_lib_utils.prometheus_utils import get_logs
+
+    end_time = args.end if args.end is not None else time.time()
+    start_time = args.start if args.start is not None else end_time - args.minutes * 60
+    logfile_path = args.logfile or get_log_path(args.name)
+    if not os.path.exists(logfile_path):
+        with open(logfile_path, 'w') as f:
+            f.write("Metric,Time,Value\n")
+
+    # Fetch in windows, to not make the requests too large
+    rows = 0
+    window_start = start_time
+    while window_start < end_time:
+        window_end = min(end_time, window_start + args.window)
+        rows += get_logs(logfile_path, start_time=window_start, end_time=window_end, data_source_url=args.url or PROMETHEUS_URL)
+        window_start = window_end
+    print(f"Wrote {rows} rows to {logfile_path}")
+    return 0
+
+
+def export_command(args) -> int:
+    from chaos_lib_utils.constants import PROMETHEUS_URL
+    from chaos_lib_utils.file_utils import load_run_metadata
+    from chaos_lib_utils.remote_read import export_run
+
+    # Without a time range, the run is exported from the chaos injection to its end (or the first to the last row of the log)
+    timings = load_run_metadata(args.logfile).get("timings") or {}
+    start_time = args.start if args.start is not None else timings.get("chaos_applied_at")
+    end_time = args.end if args.end is not None else timings.get("finished_at")
+    if start_time is None or end_time is None:
+        import pandas as pd
+        times = pd.read_csv(args.logfile, usecols=["Time"])["Time"]
+        start_time = times.min() if start_time is None else start_time
+        end_time = times.max() if end_time is None else end_time
+    summary = export_run(args.logfile, float(start_time), float(end_time), url=args.url or PROMETHEUS_URL)
+    for metric, result in summary["metrics"].items():
+        group = ", ".join(f"{label}={value}" for label, value in (result["group"] or {}).items())
+        print(f"{metric}: {result['rows']} rows from {result['series']} series of {group or 'all series'} ({result['groups']} groups)")
+    return 0
+
+
+def analyze_command(args) -> int:
+    from functools import partial
+    import pandas as pd
+    from chaos_lib_utils.reporting import analyze_run
+    from chaos_lib_utils.run_archive import RunArchive
+
+    # Runs are streamed through the workers in chunks, short runs are skipped before they are parsed
+    archive = RunArchive(LOG_FOLDER)
+    analyze = partial(analyze_run, prominence=args.prominence)
+    rows = []
+    for chunk in archive.stream(analyze, chunk_size=args.chunk_size, workers=args.concurrency, patterns=args.logs, min_rows=args.min_rows):
+        rows.extend(row for run_rows in chunk for row in run_rows)
+
+    df = pd.DataFrame(rows, columns=["File", "Latency", "Event", "RecoveryTime"])
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"Wrote {len(df)} chaos events of {df['File'].nunique()} runs to {args.output}")
+    summary = df.groupby("Latency")["RecoveryTime"].agg(["count", "mean", "median", "std"])
+    print(summary.to_string())
+    return 0
+
+
+def aggregate_command(args) -> int:
+    from chaos_lib_utils.aggregation import build_summary
+
+    tables = build_summary(args.logs, prominence=args.prominence, min_rows=args.min_rows, replicates=args.replicates,
+                           confidence=args.confidence, workers=args.concurrency, cache=not args.no_cache)
+    print(tables["by_latency"].round(2).to_string())
+    print()
+    print(tables["regression"].round(4).T.to_string(header=False))
+    if args.output_folder:
+        os.makedirs(args.output_folder, exist_ok=True)
+        for name, table in tables.items():
+            table.to_csv(os.path.join(args.output_folder, f"{name}.csv"), index=(name == "by_latency"))
+        print(f"Wrote the tables to {args.output_folder}")
+    return 0
+
+
+def render_command(args) -> int:
+    from chaos_lib_utils.rendering import render_report
+
+    files = render_report(args.logs, args.output, columns=args.columns, rows=args.rows, pixels=args.pixels,
+                          prominence=args.prominence, detect=not args.no_events, min_rows=args.min_rows, workers=args.concurrency)
+    print(f"Wrote {len(files)} file(s) to {args.output}")
+    return 0
+
+
+def parse_since(value: str) -> float:
+    """
+    A date (2024-12-19, 2024-12-19T13:00) or an age like 7d, 12h, 30m, returned as unix timestamp
+    """
+    import re
+    import time
+    from datetime import datetime
+
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([dhm])", value)
+    if match:
+        return time.time() - float(match.group(1)) * {"d": 86400, "h": 3600, "m": 60}[match.group(2)]
+    return datetime.fromisoformat(value).timestamp()
+
+
+def catalogue_command(args) -> int:
+    from datetime import datetime
+    from chaos_lib_utils.catalogue import update_catalogue, query_runs
+
+    if not args.no_update:
+        updated = update_catalogue()
+        if updated:
+            print(f"Indexed {updated} new or changed runs")
+
+    runs = query_runs(experiment=args.experiment, min_latency=args.min_latency, max_latency=args.max_latency,
+                      since=parse_since(args.since) if args.since else None,
+                      until=parse_since(args.until) if args.until else None, status=args.status, cluster=args.cluster)
+    if args.paths:
+        for run in runs:
+            print(os.path.join(LOG_FOLDER, run["log_file"]))
+        return 0
+
+    print(f"{'log file':<45} {'latency':>8} {'started':>17} {'status':>10} {'events':>6} {'recovery':>9}")
+    for run in runs:
+        started = datetime.fromtimestamp(run["started_at"]).strftime("%Y-%m-%d %H:%M") if run["started_at"] else "-"
+        latency = f"{run['latency_ms']:.0f}" if run["latency_ms"] is not None else "-"
+        recovery = f"{run['mean_recovery_time']:.1f}" if run["mean_recovery_time"] is not None else "-"
+        events = run["events"] if run["events"] is not None else "-"
+        print(f"{run['log_file']:<45} {latency:>8} {started:>17} {run['status'] or '-':>10} {events:>6} {recovery:>9}")
+    print(f"{len(runs)} runs")
+    return 0
+
+
+def resolve_runs(source: str) -> list[str]:
+    """
+    The logs of a sweep: all logs of a folder, or the runs of a catalogue query
+    like "experiment=single_*,since=2024-12-19,until=2024-12-20,status=completed"
+    (keys: experiment, min_latency, max_latency, since, until, status, cluster)
+    """
+    import glob
+    from chaos_lib_utils.catalogue import update_catalogue, query_runs
+
+    if os.path.isdir(source):
+        return sorted(os.path.abspath(path) for path in glob.glob(os.path.join(source, "*.log")))
+
+    filters = {}
+    for part in source.split(","):
+        key, _, value = part.partition("=")
+        key = key.strip().replace("-", "_")
+        if key in ("since", "until"):
+            filters[key] = parse_since(value.strip())
+        elif key in ("min_latency", "max_latency"):
+            filters[key] = float(value)
+        elif key in ("experiment", "status", "cluster"):
+            filters[key] = value.strip()
+        else:
+            raise ValueError(f"{source} is neither a folder nor a catalogue query (unknown key {key!r})")
+    update_catalogue()
+    return [os.path.join(LOG_FOLDER, run["log_file"]) for run in query_runs(**filters)]
+
+
+def compare_command(args) -> int:
+    from chaos_lib_utils.reporting import collect_sweep_events, compare_sweeps, format_comparison
+
+    events = {}
+    for name, source in (("baseline", args.baseline), ("candidate", args.candidate)):
+        log_files = resolve_runs(source)
+        if not log_files:
+            print(f"No runs found for the {name} ({source})")
+            return 2
+        events[name] = collect_sweep_events(log_files, prominence=args.prominence, min_rows=args.min_rows, workers=args.concurrency)
+        print(f"{name}: {len(log_files)} runs, {len(events[name])} chaos events")
+
+    comparison = compare_sweeps(events["baseline"], events["candidate"], threshold=args.threshold, alpha=args.alpha)
+    print(format_comparison(comparison))
+    if args.output:
+        comparison.to_csv(args.output, index=False)
+    # a sweep can be used as a gate: 1 if anything got significantly worse
+    return 1 if (comparison["status"] == "regression").any() else 0
+
+
+def bench_command(args) -> int:
+    import importlib
+    benchmark = importlib.import_module(f"benchmarks.bench_{args.benchmark}")
+    return benchmark.main(args.benchmark_args) or 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run chaos tests with chaos mesh and analyze them. Without a command the experiment is selected interactively.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    compile_parser = subparsers.add_parser("compile", help="Compile jsonnet templates to yaml")
+    compile_parser.add_argument("experiments", nargs="*", help="Names or globs of the templates (default: all)")
+    compile_parser.add_argument("--concurrency", type=int, default=4, help="Templates compiled in parallel")
+    compile_parser.add_argument("--ext-str", action="append", default=[], help="External variable name=value for the templates (repeatable)")
+    compile_parser.set_defaults(function=compile_command)
+
+    validate_parser = subparsers.add_parser("validate", help="Validate experiments before running them")
+    validate_parser.add_argument("experiments", nargs="*", help="Names, globs or paths of experiments (default: all)")
+    validate_parser.add_argument("--offline", action="store_true", help="Only check the schemas, not the selectors against the cluster")
+    validate_parser.add_argument("--concurrency", type=int, default=8, help="Experiments validated in parallel")
+    validate_parser.set_defaults(function=validate_command)
+
+    run_parser = subparsers.add_parser("run", help="Run experiments")
+    run_parser.add_argument("experiments", nargs="+", help="Names, globs or paths of experiments (yaml or jsonnet)")
+    run_parser.add_argument("--runs", type=int, default=1, help="Runs per experiment")
+    run_parser.add_argument("--yes", "-y", action="store_true", help="Do not ask for confirmation")
+    run_parser.add_argument("--check-prometheus", action="store_true", help="Watch prometheus and repair it if it is not healthy")
+    run_parser.add_argument("--no-validate", dest="validate", action="store_false", help="Do not validate the experiments first")
+    run_parser.add_argument("--timeout", type=float, help="Stop a run after this many seconds of monitoring")
+    run_parser.set_defaults(function=run_command)
+
+    sweep_parser = subparsers.add_parser("sweep", help="Run experiments several times, repeating failed runs")
+    sweep_parser.add_argument("experiments", nargs="*", help="Names, globs or paths of experiments (default: all)")
+    sweep_parser.add_argument("--runs", type=int, default=NUMBER_OF_RUNS, help="Runs per experiment")
+    sweep_parser.add_argument("--latencies", type=int, nargs="+", help="Generate a network delay experiment per latency (ms) from --template")
+    sweep_parser.add_argument("--template", default=os.path.join(YAML_FOLDER, "single_delay.yaml"), help="Network delay template for --latencies")
+    sweep_parser.add_argument("--companion", help="Scheduled chaos test applied at a good time with every experiment (e.g. experiments/single_pod_failure.yaml)")
+    sweep_parser.add_argument("--no-check-prometheus", dest="check_prometheus", action="store_false", help="Do not watch and repair prometheus")
+    sweep_parser.add_argument("--no-validate", dest="validate", action="store_false", help="Do not validate the experiments first")
+    sweep_parser.add_argument("--timeout", type=float, help="Stop a run after this many seconds of monitoring")
+    sweep_parser.add_argument("--clusters", nargs="+", help="Run on several clusters at once, 'context=prometheus_url' per cluster (default: CLUSTER_CONTEXTS)")
+    sweep_parser.set_defaults(function=sweep_command)
+
+    load_sweep_parser = subparsers.add_parser("load-sweep", help="Run an experiment at several input rates, find the maximum sustainable throughput")
+    load_sweep_parser.add_argument("experiment", nargs="?", help="Name, glob or path of the experiment")
+    load_sweep_parser.add_argument("--rates", type=float, nargs="+", help="Input rates (events/s) in the order they are run, e.g. 100 200 400")
+    load_sweep_parser.add_argument("--runs", type=int, default=1, help="Runs per load level")
+    load_sweep_parser.add_argument("--companion", help="Scheduled chaos test applied at a good time with every run")
+    load_sweep_parser.add_argument("--max-recovery", type=float, help="Slowest recovery (s) of a sustainable level (default: LOAD_MAX_RECOVERY_SECONDS)")
+    load_sweep_parser.add_argument("--summarize", help="Only summarize the runs of a folder or catalogue query, nothing is run")
+    load_sweep_parser.add_argument("--output", help="Also write the table per load level to this csv file")
+    load_sweep_parser.add_argument("--no-check-prometheus", dest="check_prometheus", action="store_false", help="Do not repair prometheus")
+    load_sweep_parser.add_argument("--no-validate", dest="validate", action="store_false", help="Do not validate the experiment first")
+    load_sweep_parser.add_argument("--timeout", type=float, help="Stop a run after this many seconds of monitoring")
+    load_sweep_parser.set_defaults(function=load_sweep_command)
+
+    fetch_parser = subparsers.add_parser("fetch", help="Fetch logs for a time range from prometheus")
+    fetch_parser.add_argument("--start", type=float, help="Start as unix timestamp (default: now - minutes)")
+    fetch_parser.add_argument("--end", type=float, help="End as unix timestamp (default: now)")
+    fetch_parser.add_argument("--minutes", type=float, default=30, help="Minutes to fetch if --start is not given")
+    fetch_parser.add_argument("--window", type=float, default=600, help="Seconds fetched per request")
+    fetch_parser.add_argument("--logfile", help="Log file to append to (default: a new log in the log folder)")
+    fetch_parser.add_argument("--name", default="manual_fetch", help="Name of the new log file")
+    fetch_parser.add_argument("--url", help="Prometheus URL (default: PROMETHEUS_URL)")
+    fetch_parser.set_defaults(function=fetch_command)
+
+    export_parser = subparsers.add_parser("export", help="Replace the lag of a log with the exact samples (remote read)")
+    export_parser.add_argument("logfile", help="The log of the run, the old rows are kept as <log name>.preview.csv")
+    export_parser.add_argument("--start", type=float, help="Start as unix timestamp (default: chaos_applied_at of the manifest)")
+    export_parser.add_argument("--end", type=float, help="End as unix timestamp (default: finished_at of the manifest)")
+    export_parser.add_argument("--url", help="Prometheus URL (default: PROMETHEUS_URL)")
+    export_parser.set_defaults(function=export_command)
+
+    analyze_parser = subparsers.add_parser("analyze", help="Compute the recovery times of all chaos events")
+    analyze_parser.add_argument("logs", nargs="*", default=["*.log"], help="Globs of logs in the log folder")
+    analyze_parser.add_argument("--prominence", type=float, default=50, help="Prominence of the peak detection")
+    analyze_parser.add_argument("--min-rows", type=int, default=300, help="Skip logs with less rows")
+    analyze_parser.add_argument("--concurrency", type=int, default=None, help="Worker processes (default: all cores)")
+    analyze_parser.add_argument("--chunk-size", type=int, default=16, help="Runs sent to a worker at once")
+    analyze_parser.add_argument("--output", help="Write all chaos events to this csv file")
+    analyze_parser.set_defaults(function=analyze_command)
+
+    aggregate_parser = subparsers.add_parser("aggregate", help="Recovery time statistics per latency (cached)")
+    aggregate_parser.add_argument("logs", nargs="*", default=["*.log"], help="Globs of logs in the log folder")
+    aggregate_parser.add_argument("--prominence", type=float, default=50, help="Prominence of the peak detection")
+    aggregate_parser.add_argument("--min-rows", type=int, default=300, help="Skip logs with less rows")
+    aggregate_parser.add_argument("--replicates", type=int, default=2000, help="Bootstrap replicates")
+    aggregate_parser.add_argument("--confidence", type=float, default=0.95, help="Level of the confidence intervals")
+    aggregate_parser.add_argument("--concurrency", type=int, default=None, help="Worker processes (default: all cores)")
+    aggregate_parser.add_argument("--no-cache", action="store_true", help="Compute the tables again")
+    aggregate_parser.add_argument("--output-folder", help="Also write the tables as csv files to this folder")
+    aggregate_parser.set_defaults(function=aggregate_command)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two sweeps, exit code 1 on a regression")
+    compare_parser.add_argument("baseline", help="Folder of logs or catalogue query (e.g. 'experiment=single_*,since=2024-12-19,until=2024-12-20')")
+    compare_parser.add_argument("candidate", help="Folder of logs or catalogue query")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative increase that counts as regression (0.1 = 10%%)")
+    compare_parser.add_argument("--alpha", type=float, default=0.05, help="Significance level of the Welch t-tests")
+    compare_parser.add_argument("--prominence", type=float, default=50, help="Prominence of the peak detection")
+    compare_parser.add_argument("--min-rows", type=int, default=300, help="Skip logs with less rows")
+    compare_parser.add_argument("--concurrency", type=int, default=None, help="Worker processes (default: all cores)")
+    compare_parser.add_argument("--output", help="Also write the comparison to this csv file")
+    compare_parser.set_defaults(function=compare_command)
+
+    render_parser = subparsers.add_parser("render", help="Plot all runs headless as small multiples")
+    render_parser.add_argument("logs", nargs="*", default=["*.log"], help="Globs of logs in the log folder")
+    render_parser.add_argument("--output", default="report.pdf", help="A .pdf file or a folder for PNG pages")
+    render_parser.add_argument("--columns", type=int, default=4, help="Plots per row")
+    render_parser.add_argument("--rows", type=int, default=6, help="Rows per page")
+    render_parser.add_argument("--pixels", type=int, default=400, help="Points per plot after min/max decimation (x2)")
+    render_parser.add_argument("--prominence", type=float, default=50, help="Prominence of the chaos event detection")
+    render_parser.add_argument("--no-events", action="store_true", help="Do not mark the chaos events")
+    render_parser.add_argument("--min-rows", type=int, default=0, help="Skip logs with less rows")
+    render_parser.add_argument("--concurrency", type=int, default=None, help="Worker processes (default: all cores)")
+    render_parser.set_defaults(function=render_command)
+
+    catalogue_parser = subparsers.add_parser("catalogue", help="Query the index of all runs")
+    catalogue_parser.add_argument("--experiment", help="Experiment name, wildcards allowed (e.g. 'single_*')")
+    catalogue_parser.add_argument("--min-latency", type=float, help="Minimum latency in ms")
+    catalogue_parser.add_argument("--max-latency", type=float, help="Maximum latency in ms")
+    catalogue_parser.add_argument("--since", help="Runs started after a date (2024-12-19) or within an age (7d, 12h)")
+    catalogue_parser.add_argument("--until", help="Runs started before a date or age")
+    catalogue_parser.add_argument("--status", help="Only runs with this status (completed, incomplete)")
+    catalogue_parser.add_argument("--cluster", help="Only runs of this cluster of a cluster pool")
+    catalogue_parser.add_argument("--paths", action="store_true", help="Only print the paths of the logs")
+    catalogue_parser.add_argument("--no-update", action="store_true", help="Do not index new runs first")
+    catalogue_parser.set_defaults(function=catalogue_command)
 
-start_time = monitoring_start_time
-# Get logs in a set interval to not make the requests too large
-# If this fails we can always get the logs via the prometheus dashboard
-while monitor_thread.is_alive():
-    time.sleep(DATA_FETCH_INTERVAL_SECONDS)
-    end_time = time.time()
-    get_logs(logfile_path, start_time=start_time, end_time=end_time)
-    start_time = end_time
+    bench_parser = subparsers.add_parser("bench", help="Run a benchmark from /benchmarks")
+    bench_parser.add_argument("benchmark", choices=["detectors", "fetch", "reporting"], help="The benchmark to run")
+    bench_parser.add_argument("benchmark_args", nargs=argparse.REMAINDER, help="Arguments passed to the benchmark")
+    bench_parser.set_defaults(function=bench_command)
 
-    
-# Wait for the monitor thread to finish, get missing logs if there are any
-monitor_thread.join()
-get_logs(logfile_path, start_time=start_time, end_time=end_time)
-print("Finished getting logs")
+    return parser
 
-# Remove the chaos tests
-delete_running_chaos_tests()
 
+def main(argv: list[str] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.command is None:
+        return interactive()
+    return args.function(args)
 
 
+if __name__ == "__main__":
+    sys.exit(main())